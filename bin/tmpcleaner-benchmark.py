@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Benchmark of tmpcleaner on generated trees.
+
+Tree of given depth and fanout is generated in temporary directory for each
+run, files are split between rules and aged by given distribution. Results
+(entries per second, syscalls per entry, peak RSS and phase times) are
+logged and can be saved as JSON to compare runs.
+
+Example:
+
+    tmpcleaner-benchmark.py --depth 3 --fanout 10 --files 50 \\
+        --ages 1:3,48:1 --rule logs:0.3:24 --rule keep:0.2:0:noRemove \\
+        --workers 4 --latency lstat:0.005,scandir:0.02 --output before.json
+"""
+
+import sys
+import json
+import argparse
+
+import logging
+import gdctmpcleaner.logger
+
+from gdctmpcleaner.benchmark import Spec, benchmark
+from gdctmpcleaner.export import write_atomic
+
+global lg
+
+
+def parse_ages(value):
+    """
+    Parse age distribution HOURS:WEIGHT,...
+    """
+    try:
+        return [tuple(float(part) for part in age.split(':'))
+                for age in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid age distribution %s' % value)
+
+
+def parse_rule(value):
+    """
+    Parse rule NAME:SHARE[:MTIME[:noRemove]]
+    """
+    parts = value.split(':')
+    try:
+        rule = {'name': parts[0], 'share': float(parts[1])}
+        if len(parts) > 2 and float(parts[2]):
+            rule['mtime'] = float(parts[2])
+    except (IndexError, ValueError):
+        raise argparse.ArgumentTypeError('Invalid rule %s' % value)
+    if len(parts) > 3 and parts[3] == 'noRemove':
+        rule['noRemove'] = True
+    return rule
+
+
+def parse_latency(value):
+    """
+    Parse latency OPERATION:SECONDS,...
+    """
+    try:
+        return dict((operation, float(seconds)) for operation, seconds
+                    in (latency.split(':') for latency in value.split(',')))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid latency %s' % value)
+
+
+def parse_error(value):
+    """
+    Parse error OPERATION:ERROR:PROBABILITY
+    """
+    try:
+        operation, name, probability = value.split(':')
+        return operation, name, float(probability)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid error %s' % value)
+
+
+def main():
+    """
+    Main entrance
+    """
+    global lg
+
+    parser = argparse.ArgumentParser(description='Benchmark of temp cleaner')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Number of directory levels (default 3)')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='Number of subdirectories of each directory '
+                             '(default 10)')
+    parser.add_argument('--files', type=int, default=10,
+                        help='Number of files in each directory (default 10)')
+    parser.add_argument('--ages', type=parse_ages, default=[(0, 1)],
+                        metavar='HOURS:WEIGHT,...',
+                        help='Distribution of file ages (default all new)')
+    parser.add_argument('--rule', type=parse_rule, action='append',
+                        default=[], metavar='NAME:SHARE[:MTIME[:noRemove]]',
+                        help='Definition matching given share of files, can '
+                             'be repeated')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of random generator')
+    parser.add_argument('--mode', choices=('dry', 'real', 'both'),
+                        default='both', help='Run mode (default both)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of runs of each mode')
+    parser.add_argument('--workers', type=int,
+                        help='Config option workers')
+    parser.add_argument('--remove-workers', type=int,
+                        help='Config option removeWorkers')
+    parser.add_argument('--processes', type=int,
+                        help='Config option processes')
+    parser.add_argument('--latency', type=parse_latency,
+                        metavar='OPERATION:SECONDS,...',
+                        help='Latency added to filesystem operations')
+    parser.add_argument('--jitter', type=float, metavar='SECONDS',
+                        help='Maximum of random latency added to filesystem '
+                             'operations')
+    parser.add_argument('--error', type=parse_error, action='append',
+                        default=[], metavar='OPERATION:ERROR:PROBABILITY',
+                        help='Inject error (EACCES, ENOENT, EIO) to '
+                             'filesystem operation, can be repeated')
+    parser.add_argument('--dir', help='Directory where trees are generated')
+    parser.add_argument('--output', metavar='PATH',
+                        help='Write results to JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Be verbose')
+    args = parser.parse_args()
+
+    lg = gdctmpcleaner.logger.init(name='tmpcleaner', syslog=False)
+    if args.verbose:
+        lg.setLevel(logging.INFO)
+
+    options = {}
+    for option, value in (('workers', args.workers),
+                          ('removeWorkers', args.remove_workers),
+                          ('processes', args.processes)):
+        if value is not None:
+            options[option] = value
+
+    if args.latency or args.jitter or args.error:
+        errors = {}
+        for operation, name, probability in args.error:
+            errors.setdefault(operation, {})[name] = probability
+        options['filesystem'] = {
+            'backend': 'faulty',
+            'latency': args.latency,
+            'jitter': args.jitter or 0.0,
+            'errors': errors,
+        }
+
+    try:
+        spec = Spec(depth=args.depth, fanout=args.fanout, files=args.files,
+                    ages=args.ages, rules=args.rule, seed=args.seed)
+    except ValueError as e:
+        parser.error(e)
+
+    modes = ('dry', 'real') if args.mode == 'both' else (args.mode,)
+    results = benchmark(spec, modes=modes, options=options,
+                        directory=args.dir, repeat=args.repeat)
+
+    for result in results['results']:
+        lg.warn('Benchmark: mode={0} entries={entries} duration={duration:.3f} '
+                'entries_per_second={entries_per_second:.0f} '
+                'syscalls_per_entry={syscalls_per_entry:.2f} '
+                'peak_rss_kb={peak_rss_kb} {1}'.format(
+                    'dry' if result['dry'] else 'real',
+                    ' '.join('phase_{0}={1:.3f}'.format(phase, seconds)
+                             for phase, seconds
+                             in sorted(result['phases'].iteritems())),
+                    **result))
+
+    if args.output:
+        write_atomic(args.output,
+                     json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Reader of tmpcleaner journal.
+
+Prints records of removed entries from journal files (ndjson or binary,
+detected automatically) filtered by definition, outcome, path and time of
+removal, or only their totals.
+
+Example:
+
+    tmpcleaner-journal.py --definition users --since '2014-10-24 06:00' \\
+        /var/log/tmpcleaner.journal.1 /var/log/tmpcleaner.journal
+"""
+
+import sys
+import re
+import json
+import time
+import argparse
+from datetime import datetime
+
+from gdctmpcleaner.journal import read
+
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_time(value):
+    """
+    Parse unix time or local date and time
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in TIME_FORMATS:
+        try:
+            return time.mktime(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Invalid time %s' % value)
+
+
+def parse_regex(value):
+    """
+    Compile regular expression
+    """
+    try:
+        return re.compile(value)
+    except re.error as e:
+        raise argparse.ArgumentTypeError('Invalid regular expression %s: %s' % (value, e))
+
+
+def main():
+    """
+    Main entrance
+    """
+    parser = argparse.ArgumentParser(description='Reader of temp cleaner journal')
+    parser.add_argument('journal', nargs='+',
+                        help='Journal files, rotated files first')
+    parser.add_argument('--definition', action='append',
+                        help='Only records of definition, can be repeated')
+    parser.add_argument('--outcome', choices=('removed', 'failed'),
+                        help='Only records of given outcome')
+    parser.add_argument('--path', type=parse_regex, metavar='REGEX',
+                        help='Only records with path matching regular '
+                             'expression')
+    parser.add_argument('--since', type=parse_time, metavar='TIME',
+                        help='Only records removed since time (unix time or '
+                             'YYYY-MM-DD [HH:MM[:SS]])')
+    parser.add_argument('--until', type=parse_time, metavar='TIME',
+                        help='Only records removed before time')
+    parser.add_argument('--json', action='store_true',
+                        help='Print records as JSON lines')
+    parser.add_argument('--summary', action='store_true',
+                        help='Print only totals per definition and outcome')
+    args = parser.parse_args()
+
+    # (definition, outcome, type): [count, size]
+    totals = {}
+    for path in args.journal:
+        try:
+            for record in read(path):
+                if args.definition and record['definition'] not in args.definition:
+                    continue
+                if args.outcome and record['outcome'] != args.outcome:
+                    continue
+                if args.path and not args.path.match(record['path']):
+                    continue
+                if args.since and record['time'] < args.since:
+                    continue
+                if args.until and record['time'] >= args.until:
+                    continue
+
+                if args.summary:
+                    total = totals.setdefault((record['definition'],
+                                               record['outcome'],
+                                               record['type']), [0, 0])
+                    total[0] += 1
+                    total[1] += record['size']
+                elif args.json:
+                    if isinstance(record['path'], str):
+                        record['path'] = record['path'].decode('utf-8', 'replace')
+                    print json.dumps(record, sort_keys=True)
+                else:
+                    print '{0} {outcome} {type} {size} {definition} {path}'.format(
+                        datetime.fromtimestamp(record['time']).strftime(TIME_FORMATS[0]),
+                        **record)
+        except (IOError, ValueError) as e:
+            sys.stderr.write('Can\'t read journal %s: %s\n' % (path, e))
+            sys.exit(1)
+
+    for (definition, outcome, ftype), (count, size) in sorted(totals.items()):
+        print 'definition={0} outcome={1} type={2} count={3} size={4}'.format(
+            definition, outcome, ftype, count, size)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
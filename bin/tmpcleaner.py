@@ -11,12 +11,49 @@ Definition options have to be matched all, otherwise file/directory won't pass t
 that is also used for statistics grouping)
 Don't use definitions without atime/mtime/ctime or it may remove all items in directory tree.
 
-This tool currently supports only files and directories, it will just skip other file types with error.
+This tool currently supports only files and directories, it will just skip other file types (including symlinks) with error.
 
 Config options:
     pidfile - file for PID, if empty, then PID won't be saved
     path    - path to pass and cleanup
-    pathIgnore - regular expression for path to ignore, eg. '.*/\.snapshot(/.*|$)' to ignore directories named .snapshot
+    pathIgnore - regular expression for path to ignore, eg. '.*/\.snapshot$' to ignore directories named .snapshot,
+                 matching directories are not walked at all
+    pruneUnmatched - don't walk directories where no path can match pathMatch of any definition, requires all
+                     definitions to have pathMatch starting with literal path, eg. '/tmp/users/.*'
+    removeSubtrees - remove content of directory without evaluating entries when every entry below it would be removed
+                     by the same definition without time criteria, eg. pathMatch: '.*/test/'
+    workers - number of threads listing directories and stat'ing files (default 1)
+    statistics - full (default) or minimal, in minimal statistics files matching no definition by path are not
+                 stat'ed and their size is not counted to unspecified definition
+    stateFile - SQLite file with index of directories, directory with unchanged mtime and no file old enough
+                to match any definition won't be listed again by next run
+    processes - number of processes cleaning top-level subdirectories of path in parallel (default 1),
+                maxOps and maxUnlinks are divided between processes, stateFile is not used with more processes
+    removeWorkers - number of threads removing files while walking continues (default 0, remove in walking thread)
+    removeQueue - maximum number of files waiting for removal threads (default 1000)
+    maxOps - maximum number of filesystem operations (listing, stat, unlink, rmdir) per second
+    maxUnlinks - maximum number of removals per second
+    adaptiveLatency - slow down while average latency of filesystem operations is above this number of seconds
+    ioprio - I/O scheduling priority to set, idle or best-effort level 0-7
+    schedIdle - set SCHED_IDLE CPU scheduling policy
+    coordinationDir - directory shared by instances cleaning the same path from several hosts, top-level
+                      subdirectories are split between them by lease files in its subdirectory named by run id
+    leaseTime - seconds after which lease of crashed instance can be taken over (default 300)
+    maxRuntime - stop walking after this number of seconds, the last processed directory is stored to checkpointFile
+    rescanInterval - seconds between passes of daemon mode when changes can't be watched by inotify (default 3600)
+    maxWatches - maximum number of directories watched by daemon mode (default system limit)
+    aggregateLog - log removals once per directory with number of removed files and directories (verbose mode)
+    checkpointFile - JSON file with position and statistics of interrupted sweep, next run resumes the sweep after
+                     the last processed directory, directories are walked in order of sorted names by single thread
+    journalFile - append-only journal of removed and failed entries with their size, times and definition, read it by
+                  tmpcleaner-journal.py, not written in dry-run
+    journalFormat - ndjson (default) or binary (length-prefixed records)
+    journalMaxSize - rotate journal exceeding this number of bytes
+    journalBackups - number of rotated journals kept (default 5)
+    filesystem - backend of listing, stat and removal, {backend: dirfd, maxOpen: 64} runs operations relative to open
+                 descriptors of directories (at most maxOpen unused are kept), for testing {backend: faulty,
+                 latency: {lstat: 0.005}, jitter: 0.002, errors: {unlink: {EIO: 0.01}}} adds latency and errors to local
+                 filesystem calls
 
 Config options per definition:
     name    - friendly name for classification (otherwise id will be used)
@@ -50,15 +87,48 @@ Example yaml config file:
 """
 
 import sys
+import signal
 import argparse
 
 import logging
 import gdctmpcleaner.logger
 
 from gdctmpcleaner import TmpCleaner, InvalidConfiguration, PIDExists, NoConfigFile
+from gdctmpcleaner.coordinate import merge_summaries
+from gdctmpcleaner.daemon import Daemon
+from gdctmpcleaner.export import Exporter
+from gdctmpcleaner.plan import PlanWriter, apply as apply_plan
+from gdctmpcleaner.watermark import Watermark
 
 global lg
 
+SUMMARY_FMT = (
+    'Summary: path={0} definition={1} removed_files={removed[files]} '
+    'removed_dirs={removed[dirs]} removed_size={removed[size]} '
+    'existing_files={existing[files]} existing_dirs={existing[dirs]} '
+    'existing_size={existing[size]}')
+
+def report_merged(directory):
+    """
+    Log merged partial summaries of cooperating instances
+
+    :param directory: coordination directory of one run
+    :return: False if there is no partial summary
+    """
+    merged = merge_summaries(directory)
+    if merged is None:
+        lg.error('No partial summaries found in %s' % directory)
+        return False
+
+    for name, definition in sorted(merged['definitions'].iteritems()):
+        lg.warn(SUMMARY_FMT.format(merged['path'], name, **definition))
+    lg.warn('Summary totals: path={path} instances={instances} '
+            'time={duration:.0f} entries={entries} '
+            'removed_size={removed_size} syscalls_saved={syscalls_saved} '
+            'stats_skipped={stats_skipped} pruned_dirs={pruned_dirs} '
+            'complete={final}'.format(**merged))
+    return True
+
 def main():
     """
     Main entrance
@@ -66,7 +136,7 @@ def main():
     global lg
 
     parser = argparse.ArgumentParser(description='Smart temp cleaner')
-    parser.add_argument('config', help='Config file to use')
+    parser.add_argument('config', nargs='?', help='Config file to use')
     parser.add_argument('--dry', action='store_true', help='Dry run only')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Be verbose')
@@ -74,9 +144,78 @@ def main():
                         help='Debug mode')
     parser.add_argument('-q', '--quiet', action='store_true', default=False,
                         help='Be quiet (no console logging)')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of threads listing directories '
+                             '(overrides config option workers)')
+    parser.add_argument('--remove-workers', type=int,
+                        help='Number of threads removing files '
+                             '(overrides config option removeWorkers)')
+    parser.add_argument('--processes', type=int,
+                        help='Number of processes cleaning top-level '
+                             'subdirectories (overrides config option '
+                             'processes)')
+    parser.add_argument('--max-runtime', type=float, metavar='SECONDS',
+                        help='Stop walking after given time (overrides '
+                             'config option maxRuntime)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running after initial pass and remove '
+                             'entries when they expire, changes are '
+                             'watched by inotify')
+    parser.add_argument('--target-free', type=float, metavar='PERCENT',
+                        help='Remove the oldest files allowed by definitions '
+                             'regardless of their time filters until given '
+                             'percentage of space is free')
+    parser.add_argument('--target-free-inodes', type=float, metavar='PERCENT',
+                        help='Remove the oldest files until given percentage '
+                             'of inodes is free, can be combined with '
+                             '--target-free')
+    parser.add_argument('--candidates', type=int, default=10000,
+                        help='Number of the oldest files kept for removal '
+                             'per batch of walk with --target-free or '
+                             '--target-free-inodes (default 10000)')
+    parser.add_argument('--plan-out', metavar='FILE',
+                        help='Write candidates of dry-run with their '
+                             'fingerprints to plan file')
+    parser.add_argument('--apply-plan', metavar='FILE',
+                        help='Remove candidates of plan which weren\'t '
+                             'changed since dry-run, tree isn\'t walked')
+    parser.add_argument('--async-log', action='store_true',
+                        help='Write log records from background thread in '
+                             'batches')
+    parser.add_argument('--aggregate-log', action='store_true', default=None,
+                        help='Log removals once per directory with counts '
+                             'instead of once per entry')
+    parser.add_argument('--prune-report', action='store_true',
+                        help='List directories that were not walked')
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help='Write summary and metrics to JSON file')
+    parser.add_argument('--prometheus-textfile', metavar='PATH',
+                        help='Write summary and metrics to Prometheus '
+                             'textfile')
+    parser.add_argument('--metrics-interval', type=float, metavar='SECONDS',
+                        help='Write metrics files also periodically during '
+                             'the run')
+    parser.add_argument('--run-id',
+                        help='Identifier of run shared by cooperating '
+                             'instances (default current date)')
+    parser.add_argument('--merge-summaries', metavar='DIR',
+                        help='Print merged partial summaries from '
+                             'coordination directory of one run and exit')
     args = parser.parse_args()
+    if not args.config and not args.merge_summaries:
+        parser.error('config is required')
+    if args.plan_out and not args.dry:
+        parser.error('--plan-out requires --dry')
+    if (args.plan_out or args.apply_plan) and (
+            args.daemon or args.target_free is not None or
+            args.target_free_inodes is not None):
+        parser.error('--plan-out and --apply-plan can\'t be used with '
+                     '--daemon or watermark mode')
+    if args.plan_out and args.apply_plan:
+        parser.error('--plan-out and --apply-plan can\'t be used together')
 
-    logging_args = {'console': not args.quiet, 'syslog': args.quiet}
+    logging_args = {'console': not args.quiet, 'syslog': args.quiet,
+                    'queued': args.async_log}
     lg = gdctmpcleaner.logger.init(name='tmpcleaner', **logging_args)
 
     if args.verbose:
@@ -85,9 +224,48 @@ def main():
     if args.debug:
         lg.setLevel(logging.DEBUG)
 
+    if args.merge_summaries:
+        if not report_merged(args.merge_summaries):
+            sys.exit(1)
+        return
+
+    exporter = None
     try:
-        cleaner = TmpCleaner(args.config, dry=args.dry)
-        cleaner.run()
+        cleaner = TmpCleaner(args.config, dry=args.dry, workers=args.workers,
+                             remove_workers=args.remove_workers,
+                             prune_report=args.prune_report,
+                             processes=args.processes, run_id=args.run_id,
+                             max_runtime=args.max_runtime,
+                             aggregate_log=args.aggregate_log)
+        if args.metrics_json or args.prometheus_textfile:
+            exporter = Exporter(cleaner, json_path=args.metrics_json,
+                                prometheus_path=args.prometheus_textfile,
+                                interval=args.metrics_interval)
+            exporter.start()
+        if args.target_free is not None or args.target_free_inodes is not None:
+            Watermark(cleaner, free=args.target_free,
+                      inodes=args.target_free_inodes,
+                      candidates=args.candidates).run()
+        elif args.daemon:
+            daemon = Daemon(cleaner)
+            # Summary is logged after daemon is stopped
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: daemon.stop())
+            daemon.run()
+        elif args.apply_plan:
+            apply_plan(cleaner, args.apply_plan)
+        else:
+            if args.plan_out:
+                cleaner.plan = PlanWriter(args.plan_out, cleaner)
+            try:
+                cleaner.run()
+            except:
+                if cleaner.plan:
+                    cleaner.plan.close(complete=False)
+                raise
+            if cleaner.plan:
+                # Plan of interrupted walk would miss candidates
+                cleaner.plan.close(complete=not cleaner.interrupted)
     except (InvalidConfiguration, PIDExists, NoConfigFile) as e:
         # "Friendly" exceptions, no stack-trace, just log them
         lg.error(e)
@@ -95,6 +273,10 @@ def main():
     except Exception as e:
         lg.exception(e)
         sys.exit(1)
+    finally:
+        if exporter:
+            # Final results are written after summary is logged
+            exporter.stop(final=False)
 
     summary = cleaner.get_summary()
     totals = {
@@ -111,12 +293,7 @@ def main():
         if name is None:
             name = 'unspecified'
 
-        report = (
-            'Summary: path={0} definition={1} removed_files={removed[files]} '
-            'removed_dirs={removed[dirs]} removed_size={removed[size]} '
-            'existing_files={existing[files]} existing_dirs={existing[dirs]} '
-            'existing_size={existing[size]}'.format(cleaner.config['path'],
-                                                    name, **definition))
+        report = SUMMARY_FMT.format(cleaner.config['path'], name, **definition)
         totals['removed_files'] += definition['removed']['files']
         totals['removed_dirs'] += definition['removed']['dirs']
         totals['removed_size'] += definition['removed']['size']
@@ -125,17 +302,47 @@ def main():
         totals['existing_size'] += definition['existing']['size']
         lg.warn(report)
 
+    # Print pruned directories
+    if args.prune_report:
+        for path, reason in cleaner.pruned:
+            lg.warn('Pruned: path={0} reason={1}'.format(path, reason))
+
     # Print totals
     report_fmt = (
         'Summary totals: path={0} time={1} time_pass={2} time_remove={3} '
         'removed_files={removed_files} removed_dirs={removed_dirs} '
         'removed_size={removed_size} existing_files={existing_files} '
-        'existing_dirs={existing_dirs} existing_size={existing_size}')
+        'existing_dirs={existing_dirs} existing_size={existing_size} '
+        'syscalls_saved={4} stats_skipped={5} pruned_dirs={6} '
+        'throttled_scan={7:.3f} throttled_remove={8:.3f}')
+    metrics = cleaner.get_metrics()
     report = report_fmt.format(
         cleaner.config['path'], cleaner.time_run.seconds,
-        cleaner.time_pass.seconds, cleaner.time_remove.seconds, **totals)
+        cleaner.time_pass.seconds, cleaner.time_remove.seconds,
+        cleaner.syscalls_saved, cleaner.stats_skipped, cleaner.pruned_dirs,
+        metrics['phases']['throttle_scan'],
+        metrics['phases']['throttle_remove'], **totals)
     lg.warn(report)
 
+    # Print timing metrics
+    lg.warn('Metrics: path={0} {1}'.format(
+        cleaner.config['path'],
+        ' '.join('phase_{0}={1:.3f}'.format(phase, seconds)
+                 for phase, seconds in sorted(metrics['phases'].iteritems()))))
+    for operation, data in sorted(metrics['operations'].iteritems()):
+        histogram = ','.join('{0:g}:{1}'.format(bound, hits)
+                             for bound, hits in data['histogram'])
+        lg.warn('Metrics: path={0} operation={1} count={count} '
+                'time={time:.3f} max={max:.6f} histogram={2}'.format(
+                    cleaner.config['path'], operation, histogram, **data))
+
+    if exporter:
+        try:
+            exporter.write(final=True)
+        except Exception as e:
+            lg.error("Can't write metrics: %s" % e)
+            sys.exit(1)
+
 if __name__ == '__main__':
     try:
         main()
@@ -12,12 +12,30 @@ import stat
 import posix
 
 from itertools import count
+from collections import OrderedDict
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import Queue
+import threading
 
 import yaml
 import re
+import sre_compile
+import sre_parse
+import sre_constants
 from datetime import datetime, timedelta
 import time
 
+from gdctmpcleaner.checkpoint import Checkpoint
+from gdctmpcleaner.coordinate import Coordinator
+from gdctmpcleaner.export import Exporter
+from gdctmpcleaner.fs import Filesystem, create as create_filesystem
+from gdctmpcleaner.index import Index
+from gdctmpcleaner.journal import Journal
+from gdctmpcleaner.metrics import Metrics
+from gdctmpcleaner.throttle import Throttle, set_ioprio, set_sched_idle
+from gdctmpcleaner import vector
+
 import logging
 lg = logging.getLogger('tmpcleaner')
 
@@ -26,13 +44,34 @@ class TmpCleaner(object):
     """
     Cleaner class
     """
-    def __init__(self, config, dry=False):
+    def __init__(self, config, dry=False, workers=None, remove_workers=None,
+                 prune_report=False, processes=None, run_id=None,
+                 filesystem=None, max_runtime=None, aggregate_log=None):
         """
         Load config
         Initialize logging if it isn't initialized
 
-        :param config: config file to use
+        :param config: config file to use or already loaded config dict
         :param dry: dry-run only (default False)
+        :param workers: number of threads listing directories, overrides
+                        config option workers (default 1)
+        :param remove_workers: number of threads removing files, overrides
+                               config option removeWorkers (default 0, remove
+                               files in walking thread)
+        :param prune_report: keep list of pruned directories (default False)
+        :param processes: number of processes cleaning top-level
+                          subdirectories, overrides config option processes
+                          (default 1)
+        :param run_id: identifier of run shared by cooperating instances,
+                       used when coordinationDir is set (default current
+                       date)
+        :param filesystem: Filesystem instance, overrides config option
+                           filesystem (not passed to processes)
+        :param max_runtime: seconds after which walk is stopped, overrides
+                            config option maxRuntime
+        :param aggregate_log: log removals once per directory instead of
+                              once per entry, overrides config option
+                              aggregateLog
         """
         self.dry = dry
         self.definitions = []
@@ -42,15 +81,28 @@ class TmpCleaner(object):
         self.time_pass = timedelta(seconds=0)
         self.time_remove = timedelta(seconds=0)
 
+        # Number of stat calls avoided compared to os.walk() + File()
+        self.syscalls_saved = 0
+        # Number of files not stat'ed because statistics were minimal
+        self.stats_skipped = 0
+
+        # Latencies of filesystem operations and matching
+        self.metrics = Metrics()
+        # Wall time of walking thread spent in phases
+        self.wall = {'scan': 0.0, 'match': 0.0, 'remove': 0.0}
+
         if self.dry:
             lg.info("Running in dry-run mode")
 
-        if not os.path.isfile(config):
-            raise NoConfigFile('Config file %s not found' % config)
+        if isinstance(config, dict):
+            self.config = config
+        else:
+            if not os.path.isfile(config):
+                raise NoConfigFile('Config file %s not found' % config)
 
-        with open(config, 'r') as fh:
-            self.config = yaml.load(fh.read())
-            lg.debug("Loaded config file %s" % config)
+            with open(config, 'r') as fh:
+                self.config = yaml.load(fh.read())
+                lg.debug("Loaded config file %s" % config)
 
         # Setup definitions
         if self.config.has_key('definitions'):
@@ -58,6 +110,7 @@ class TmpCleaner(object):
                 self.definitions.append(Definition(**definition))
         else:
             raise InvalidConfiguration('Config section definitions not present')
+        self.matcher = Matcher(self.definitions)
 
         # Setup summary structure
         self.summary = {
@@ -75,12 +128,166 @@ class TmpCleaner(object):
                 'existing': {'dirs': 0, 'files': 0, 'size': 0},
             }
 
+        # Number of threads for directory listing
+        self.workers = workers or self.config.get('workers') or 1
+        if not isinstance(self.workers, int) or self.workers < 1:
+            raise InvalidConfiguration('Number of workers has to be positive integer, not %s' % self.workers)
+
+        # Number of threads for removal and size of their queue
+        self.remove_workers = remove_workers
+        if self.remove_workers is None:
+            self.remove_workers = self.config.get('removeWorkers') or 0
+        if not isinstance(self.remove_workers, int) or self.remove_workers < 0:
+            raise InvalidConfiguration('Number of remove workers has to be non-negative integer, not %s' % self.remove_workers)
+        self.remove_queue = self.config.get('removeQueue') or 1000
+        if not isinstance(self.remove_queue, int) or self.remove_queue < 1:
+            raise InvalidConfiguration('Size of remove queue has to be positive integer, not %s' % self.remove_queue)
+
+        # Number of processes cleaning top-level subdirectories
+        self.processes = processes or self.config.get('processes') or 1
+        if not isinstance(self.processes, int) or self.processes < 1:
+            raise InvalidConfiguration('Number of processes has to be positive integer, not %s' % self.processes)
+
+        # Files matching no definition are stat'ed only to count their size
+        # in full statistics
+        self.statistics = self.config.get('statistics') or 'full'
+        if self.statistics not in ('full', 'minimal'):
+            raise InvalidConfiguration('statistics has to be full or minimal, not %s' % self.statistics)
+
+        # Level of logger is checked once, not for every removed entry
+        self.verbose = lg.isEnabledFor(logging.INFO)
+        # Number of removals per (directory, type, definition name) logged
+        # once directory is processed
+        self.aggregate_log = aggregate_log
+        if self.aggregate_log is None:
+            self.aggregate_log = self.config.get('aggregateLog') or False
+        self.removals = {}
+
         # Compile regexp for excluded paths
         if self.config.has_key('pathIgnore') and self.config['pathIgnore']:
             self.path_ignore = re.compile(self.config['pathIgnore'])
         else:
             self.path_ignore = None
 
+        # Literal prefixes of pathMatch for pruning of subtrees that can't
+        # match any definition, None if some definition can match anything
+        self.prefixes = None
+        if self.config.get('pruneUnmatched'):
+            self.prefixes = [definition.prefix for definition in self.definitions]
+            if not all(self.prefixes):
+                lg.warn("Some definition doesn't have pathMatch with literal "
+                        "prefix, unmatched subtrees won't be pruned")
+                self.prefixes = None
+
+        # Content of directory whose every descendant would be removed by
+        # the same definition is removed without evaluation of entries
+        self.remove_subtrees = self.config.get('removeSubtrees') or False
+
+        # Regular files of directory are evaluated at once by _evaluate()
+        self.vectorize = self.config.get('vectorize') or False
+
+        # Throttling of filesystem operations, operation: [Throttle]
+        self.throttles = {}
+        latency = self.config.get('adaptiveLatency')
+        if self.config.get('maxOps') or latency:
+            throttle = Throttle(self.config.get('maxOps'), latency)
+            for operation in ('listdir', 'prescan', 'stat', 'unlink', 'rmdir'):
+                self.throttles[operation] = [throttle]
+        if self.config.get('maxUnlinks'):
+            throttle = Throttle(self.config['maxUnlinks'], latency)
+            for operation in ('unlink', 'rmdir'):
+                self.throttles.setdefault(operation, []).append(throttle)
+
+        # Backend of listing, stat and removal
+        self.fs = filesystem
+        if self.fs is None:
+            try:
+                self.fs = create_filesystem(self.config.get('filesystem'))
+            except ValueError as exc:
+                raise InvalidConfiguration('Invalid filesystem: %s' % exc)
+        if self.config.get('path'):
+            self.fs.set_top(os.path.normpath(self.config['path']))
+
+        ioprio = self.config.get('ioprio')
+        if ioprio is not None and ioprio != 'idle' and ioprio not in range(8):
+            raise InvalidConfiguration('ioprio has to be idle or best-effort level 0-7, not %s' % ioprio)
+
+        # Index of directories unchanged since previous run
+        # Cooperation with other instances cleaning the same tree
+        self.coordinator = None
+        if self.config.get('coordinationDir'):
+            if self.processes > 1:
+                raise InvalidConfiguration('coordinationDir can\'t be used with multiple processes')
+            lease_time = self.config.get('leaseTime') or 300
+            if not isinstance(lease_time, (int, float)) or lease_time <= 0:
+                raise InvalidConfiguration('leaseTime has to be positive number, not %s' % lease_time)
+            run_id = run_id or datetime.now().strftime('%Y%m%d')
+            if self.dry:
+                # Don't mark subtrees finished for real run
+                run_id += '.dry'
+            self.coordinator = Coordinator(
+                os.path.join(self.config['coordinationDir'], run_id),
+                lease_time)
+
+        # Runtime budget and checkpoint of sweep split into several runs
+        self.max_runtime = max_runtime or self.config.get('maxRuntime')
+        if self.max_runtime is not None and (
+                not isinstance(self.max_runtime, (int, float)) or self.max_runtime <= 0):
+            raise InvalidConfiguration('maxRuntime has to be positive number, not %s' % self.max_runtime)
+        self.checkpoint = None
+        if self.max_runtime or self.config.get('checkpointFile'):
+            if self.processes > 1 or self.coordinator:
+                raise InvalidConfiguration('maxRuntime and checkpointFile can\'t be used with multiple processes or coordinationDir')
+        if self.config.get('checkpointFile'):
+            checkpoint_file = self.config['checkpointFile']
+            if self.dry:
+                # Don't move cursor of real sweep
+                checkpoint_file += '.dry'
+            self.checkpoint = Checkpoint(checkpoint_file,
+                                         os.path.normpath(self.config['path']),
+                                         self.config['definitions'])
+            if self.workers > 1:
+                lg.warn("Directories are listed in single thread to keep "
+                        "order of checkpoint")
+        # Time when walk is stopped and the last directory processed
+        # before, set if the walk was stopped
+        self.deadline = None
+        self.interrupted = None
+
+        self.index = None
+        if self.config.get('stateFile') and (self.processes > 1 or self.coordinator):
+            # Index can't be shared by writing processes and records of
+            # subtrees cleaned by other instances would be dropped
+            lg.warn("stateFile can't be used with multiple processes or "
+                    "coordinationDir, index is disabled")
+        elif self.config.get('stateFile'):
+            # Sizes of unmatched files aren't counted in minimal statistics
+            definitions = self.config['definitions']
+            if self.statistics != 'full':
+                definitions = {'definitions': definitions,
+                               'statistics': self.statistics}
+            self.index = Index(self.config['stateFile'], definitions)
+        # Records of directories waiting for their parent to be stored
+        # into index
+        self.records = {}
+
+        # Journal of removals, not written in dry-run
+        self.journal = None
+        if self.config.get('journalFile') and not self.dry:
+            try:
+                self.journal = Journal(
+                    self.config['journalFile'],
+                    fmt=self.config.get('journalFormat') or 'ndjson',
+                    max_size=self.config.get('journalMaxSize'),
+                    backups=self.config.get('journalBackups') or 5)
+            except ValueError as exc:
+                raise InvalidConfiguration('Invalid journal: %s' % exc)
+            atexit.register(self.journal.close)
+
+        # Number of pruned directories and list of (path, reason) if requested
+        self.pruned_dirs = 0
+        self.pruned = [] if prune_report else None
+
         # Check and write pidfile
         if self.config['pidfile'] and not self.dry:
             if os.path.isfile(self.config['pidfile']):
@@ -91,9 +298,22 @@ class TmpCleaner(object):
                     fh.write(str(os.getpid()))
                 atexit.register(self._cleanup)
 
-        # Cache for unprocessed records
+        # Number of entries left in directories waiting for their parent,
+        # record is freed once the parent is processed
         self.st = {}
 
+        # Deletion stage and number of unfinished removals per directory
+        self.remover = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # PlanWriter receiving candidates of dry-run
+        self.plan = None
+
+        # Object notified about walked directories and kept entries by
+        # directory(path) and entry(path, expiry), used by daemon mode
+        self.tracker = None
+
     def errh(self, exc):
         """
         Error-handling function for os.walk
@@ -117,61 +337,939 @@ class TmpCleaner(object):
         if self.pidfile:
             os.unlink(self.pidfile)
 
+    def _scan(self, top):
+        """
+        List directory and stat regular files in it, uses scandir()
+
+        File and directory split is taken from d_type of directory entries,
+        so directories aren't stat'ed during listing. Entries other than
+        regular files and directories (including symlinks) are skipped
+        without stat. In minimal statistics files whose path matches no
+        definition are not stat'ed either, matching is done here, so stats
+        of matched files run in listing threads.
+
+        Directory that is unchanged according to index is not listed at all.
+
+        Content of directory closed by definition (see Matcher.subtree())
+        is removed by _purge() instead.
+
+        :param top: string path of directory
+        :return: Listing instance, None if directory can't be listed
+        """
+        if self.remove_subtrees and self.plan is None:
+            definition = self.matcher.subtree(top)
+            if definition:
+                return self._purge(top, definition)
+
+        listing = Listing()
+        if self.index:
+            listing.listed = time.time()
+            try:
+                listing.mtime = self.timed('stat', self.fs.lstat, top).st_mtime
+            except OSError as exc:
+                self.errh(exc)
+                return None
+            record = self.index.get(top)
+            if (record and record['mtime'] == listing.mtime and
+                    record['expiry'] > listing.listed and
+                    all(count[0] in self.summary for count in record['counts'])):
+                listing.dirs = record['dirs']
+                listing.skipped = record['entries'] - len(listing.dirs)
+                listing.counts = record['counts']
+                # os.walk() isdir, islink or File() stat for every entry
+                listing.saved = 2 * record['entries'] - 1
+                return listing
+
+        try:
+            entries = self.timed('listdir', self.fs.scandir, top)
+        except OSError as exc:
+            self.errh(exc)
+            return None
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                listing.dirs.append(entry.name)
+                # os.walk() stats every directory twice (isdir, islink)
+                listing.saved += 2
+            elif entry.is_file(follow_symlinks=False):
+                if self.statistics == 'minimal' and \
+                        self.timed('match', self.matcher.unmatched, entry.path):
+                    listing.files.append((entry.name, None))
+                    listing.saved += 1
+                    continue
+                try:
+                    listing.files.append(
+                        (entry.name, self.timed('stat', self.fs.lstat, entry.path)))
+                except OSError as exc:
+                    self.errh(exc)
+                    continue
+                # os.walk() isdir, file itself is stat'ed only once
+                listing.saved += 1
+            else:
+                lg.warn('File %s is not regular file or directory ..skipping',
+                        entry.path)
+                # os.walk() isdir and File() stat
+                listing.saved += 2
+                listing.skipped += 1
+
+        return listing
+
+    def _purge(self, top, definition):
+        """
+        Remove content of directory whose every descendant is removed by
+        definition, entries aren't evaluated and directories aren't stat'ed
+
+        Subtree is walked depth-first without recursion, directories
+        matching pathIgnore are kept. Can be called from listing threads,
+        counts are returned in listing and added to summary by
+        _walk_tree().
+
+        :param top: string path of directory
+        :param definition: Definition instance returned by Matcher.subtree()
+        :return: Listing instance without entries, None if directory can't
+                 be listed
+        """
+        listing = Listing()
+        purged = listing.purged = {
+            'definition': definition.name,
+            'removed': {'dirs': 0, 'files': 0, 'size': 0},
+            'failed': {'dirs': 0, 'files': 0, 'size': 0},
+            'stats_skipped': 0,
+        }
+
+        # Stack of [path, paths of subdirectories left or None if it isn't
+        # listed yet, number of entries left in directory]
+        stack = [[top, None, 0]]
+        while stack:
+            frame = stack[-1]
+            path, dirs, left = frame
+            if dirs is None:
+                frame[1] = []
+                try:
+                    entries = self.timed('listdir', self.fs.scandir, path)
+                except OSError as exc:
+                    self.errh(exc)
+                    if path == top:
+                        return None
+                    if exc.errno != errno.ENOENT:
+                        frame[2] += 1
+                    continue
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.prune(entry.path):
+                            frame[2] += 1
+                        else:
+                            frame[1].append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        if not self._purge_entry(entry.path, False, purged):
+                            frame[2] += 1
+                    else:
+                        lg.warn('File %s is not regular file or directory ..skipping',
+                                entry.path)
+                        frame[2] += 1
+                continue
+            if dirs:
+                stack.append([dirs.pop(), None, 0])
+                continue
+
+            stack.pop()
+            if path == top:
+                listing.skipped = left
+            elif left or not self._purge_entry(path, True, purged):
+                stack[-1][2] += 1
+
+        if self.verbose:
+            lg.info("Removing content of %s (%d files, %d directories), "
+                    "matching definition %s", top,
+                    purged['removed']['files'], purged['removed']['dirs'],
+                    definition.name)
+        return listing
+
+    def _purge_entry(self, path, directory, purged):
+        """
+        Remove entry of subtree removed by _purge()
+
+        :param path: full path of entry
+        :param directory: entry is empty directory
+        :param purged: dict with counts of _purge()
+        :return: False if entry is left in its directory
+        :rtype: bool
+        """
+        fstat = None
+        if self.journal or (not directory and self.statistics == 'full'):
+            try:
+                fstat = self.timed('stat', self.fs.lstat, path)
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    return True
+                self.errh(exc)
+                return False
+        elif not directory:
+            purged['stats_skipped'] += 1
+
+        status = 'removed'
+        if not self.dry:
+            time_start = datetime.now()
+            try:
+                if directory:
+                    self.timed('rmdir', self.fs.rmdir, path)
+                else:
+                    self.timed('unlink', self.fs.unlink, path)
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    return True
+                elif exc.errno == errno.ENOTEMPTY:
+                    # Something was created meanwhile
+                    return False
+                elif exc.errno in [errno.EPERM, errno.EACCES]:
+                    lg.error(exc)
+                    status = 'failed'
+                else:
+                    raise
+            finally:
+                with self.lock:
+                    self.time_remove += datetime.now() - time_start
+
+        counts = purged[status]
+        counts['dirs' if directory else 'files'] += 1
+        if fstat is not None and not directory:
+            counts['size'] += fstat.st_size
+        if self.journal and fstat is not None:
+            try:
+                file = File(path, fstat)
+            except UnsupportedFileType:
+                # Replaced meanwhile, it was removed anyway
+                pass
+            else:
+                file.definition = purged['definition']
+                file.removed = status == 'removed'
+                file.failed = status == 'failed' or None
+                self.journal.record(file)
+        return status == 'removed'
+
+    def prune(self, path):
+        """
+        Check if directory should be skipped together with its content
+
+        Directory is pruned if it matches pathIgnore or if no path inside it
+        can match pathMatch of any definition (when pruneUnmatched is set).
+
+        :param path: full path to a directory
+        :return: True if directory shouldn't be walked
+        :rtype: bool
+        """
+        if self.path_ignore and self.path_ignore.match(path):
+            reason = 'pathIgnore'
+        elif self.prefixes is not None:
+            inner = os.path.join(path, '')
+            for prefix in self.prefixes:
+                if prefix.startswith(inner) or inner.startswith(prefix):
+                    return False
+            reason = 'unmatched'
+        else:
+            return False
+
+        lg.debug("Pruning directory %s (%s)", path, reason)
+        # Called also by _purge() in listing threads
+        with self.lock:
+            self.pruned_dirs += 1
+            if self.pruned is not None:
+                self.pruned.append((path, reason))
+        return True
+
+    def _walk(self, top):
+        """
+        Walk directory tree bottom-up in single thread
+
+        :param top: string path where to start
+        :return: generator of (root, Listing)
+        """
+        listing = self._scan(top)
+        if listing is None:
+            return
+
+        dirs = listing.dirs
+        if self.checkpoint:
+            # Cursor of checkpoint is position in order of sorted names
+            dirs = sorted(dirs)
+        for name in dirs:
+            path = os.path.join(top, name)
+            if self.checkpoint and self.checkpoint.finished(path):
+                continue
+            if self.prune(path):
+                continue
+            for child in self._walk(path):
+                yield child
+
+        yield top, listing
+
+    def _walk_parallel(self, top):
+        """
+        Walk directory tree bottom-up, directories are listed and files
+        stat'ed by pool of self.workers threads
+
+        Directory is yielded only after all its subdirectories, results are
+        consumed in calling thread.
+
+        :param top: string path where to start
+        :return: generator of (root, Listing)
+        """
+        done = Queue.Queue()
+        pool = ThreadPool(self.workers)
+
+        def scan(path):
+            try:
+                done.put((path, self._scan(path), None))
+            except Exception as exc:
+                # Pass unexpected exception to calling thread
+                done.put((path, None, exc))
+
+        def submit(path):
+            pool.apply_async(scan, (path,))
+
+        # path: [parent, result, number of unfinished subdirectories]
+        pending = {top: [None, None, 0]}
+        # Directories waiting for listing, the deepest are listed first to
+        # keep number of pending directories low
+        stack = [top]
+        running = 0
+
+        try:
+            while pending:
+                while stack and running < 2 * self.workers:
+                    submit(stack.pop())
+                    running += 1
+
+                path, result, exc = done.get()
+                running -= 1
+                if exc is not None:
+                    raise exc
+                if result is not None:
+                    pending[path][1] = result
+                    for name in result.dirs:
+                        child = os.path.join(path, name)
+                        if self.prune(child):
+                            continue
+                        pending[child] = [path, None, 0]
+                        pending[path][2] += 1
+                        stack.append(child)
+
+                # Yield all finished directories up to the top
+                while path is not None and pending[path][2] == 0:
+                    parent, result, _ = pending.pop(path)
+                    if result is not None:
+                        yield path, result
+                    if parent is not None:
+                        pending[parent][2] -= 1
+                    path = parent
+        finally:
+            pool.terminate()
+
+    def listings(self, top):
+        """
+        Walk directory tree bottom-up in single process
+
+        :param top: string path where to start
+        :return: generator of (root, Listing)
+        """
+        if self.workers > 1 and not self.checkpoint:
+            return self._walk_parallel(top)
+        return self._walk(top)
+
     def walk_tree(self, top):
         """
-        Walk directory tree, uses os.walk()
+        Walk directory tree
+
+        :param top: string path where to start
+        :return: number of entries left in top directory, None if it wasn't
+                 walked
+        """
+        # Paths of removed files are split to find their directory
+        top = os.path.normpath(top)
+        if self.prune(top):
+            return None
+
+        pool = None
+        if self.coordinator:
+            walk = self._walk_cooperative(top)
+        elif self.processes > 1:
+            # Fork worker processes before any thread is started, lock
+            # held by other thread would stay locked in child
+            pool = multiprocessing.Pool(self.processes)
+            walk = self._walk_shards(top, pool)
+        else:
+            walk = self.listings(top)
+
+        if self.remove_workers and not self.dry:
+            self.remover = Remover(self.remove, self.remove_workers,
+                                   self.remove_queue)
+        # Cutoffs of definitions are computed once per walk
+        self.matcher.set_time(time.time())
+        try:
+            self._walk_tree(walk)
+            if self.interrupted == top:
+                # Budget ran out after the whole tree was processed
+                self.interrupted = None
+            # Wait for the rest of removals
+            while self.pending:
+                self.collect()
+            remaining = self.st.pop(top, None)
+            record = self.records.pop(top, None)
+            if record and remaining is not None:
+                self.store(top, record, remaining)
+        finally:
+            if self.remover:
+                self.remover.stop()
+                self.remover = None
+            self.matcher.set_time(None)
+            if self.journal:
+                self.journal.flush()
+            # Descriptors of walked directories
+            self.fs.close()
+            if pool:
+                pool.terminate()
+                pool.join()
+        return remaining
+
+    def _walk_shards(self, top, pool):
+        """
+        Walk top-level subdirectories in pool of processes, each
+        subdirectory is cleaned by its own TmpCleaner
+
+        Subdirectories are submitted from the largest by number of entries,
+        so long shards don't start last. Results of shards are merged and
+        number of entries left in each subdirectory is set, so the top
+        directory yielded at the end is processed as in sequential walk.
+
+        Rate limits are divided between processes.
 
         :param top: string path where to start
+        :param pool: multiprocessing.Pool
+        :return: generator of (root, Listing) yielding only top directory
+        """
+        listing = self._scan(top)
+        if listing is None:
+            return
+
+        shards = [os.path.join(top, name) for name in listing.dirs]
+        shards = [path for path in shards if not self.prune(path)]
+
+        def entries(path):
+            try:
+                return len(self.timed('prescan', self.fs.listdir, path))
+            except OSError:
+                return 0
+        shards.sort(key=entries, reverse=True)
+
+        # Shards mustn't write pidfile nor run another pool
+        # Journal is rotated only by this process
+        config = dict(self.config, pidfile='', stateFile=None, processes=1,
+                      aggregateLog=self.aggregate_log, journalMaxSize=None)
+        for option in ('maxOps', 'maxUnlinks'):
+            if config.get(option):
+                config[option] = float(config[option]) / self.processes
+        tasks = [(config, self.dry, self.workers, self.remove_workers,
+                  self.pruned is not None, path) for path in shards]
+        for result in pool.imap_unordered(_clean_shard, tasks):
+            self.merge(result)
+            if result['remaining'] is not None:
+                self.st[result['path']] = result['remaining']
+
+        yield top, listing
+
+    def _walk_cooperative(self, top):
         """
-        for root, dirs, files in os.walk(top, topdown=False, onerror=self.errh):
-            self.st.update({root: {'files': list(files), 'dirs': list(dirs)}})
-            # Handle path_ignore
-            if self.path_ignore and self.path_ignore.match(root):
+        Walk top-level subdirectories claimed through coordinator, other
+        subdirectories are left to cooperating instances
+
+        Each subdirectory is marked finished together with number of entries
+        left in it as soon as it's walked. Top directory is claimed once all
+        subdirectories are finished, instance that gets it processes files
+        directly in it and evaluates subdirectories by their finished
+        markers. Subdirectories claimed by other instances are waited for, so
+        leases of crashed instances are taken over when they expire.
+
+        :param top: string path where to start
+        :return: generator of (root, Listing)
+        """
+        listing = self._scan(top)
+        if listing is None:
+            return
+
+        shards = [os.path.join(top, name) for name in listing.dirs]
+        shards = [path for path in shards if not self.prune(path)]
+        walk = self._walk_parallel if self.workers > 1 else self._walk
+
+        waiting = shards
+        while waiting:
+            unfinished = []
+            for path in waiting:
+                if self.coordinator.claim(path):
+                    lg.info("Claimed %s", path)
+                    for child in walk(path):
+                        yield child
+                    # Wait for removals, so number of entries is final
+                    while self.pending:
+                        self.collect()
+                    self.records.pop(path, None)
+                    self.coordinator.release(path, self.st.pop(path, None))
+                elif not self.coordinator.finished(path):
+                    unfinished.append(path)
+            waiting = unfinished
+            if waiting:
+                lg.debug("Waiting for %d directories claimed by other "
+                         "instances", len(waiting))
+                time.sleep(self.coordinator.interval)
+
+        while not self.coordinator.finished(top):
+            if not self.coordinator.claim(top):
+                time.sleep(self.coordinator.interval)
                 continue
-            for name in files:
+            # List top directory again, its files could change meanwhile
+            listing = self._scan(top)
+            if listing is None:
+                self.coordinator.release(top)
+                return
+            for path in shards:
+                if os.path.basename(path) in listing.dirs:
+                    remaining = self.coordinator.remaining(path)
+                    if remaining is not None:
+                        self.st[path] = remaining
+            yield top, listing
+            self.coordinator.release(top)
+
+    def merge(self, result):
+        """
+        Merge result of shard cleaned by another process
+
+        :param result: dict returned by _clean_shard() or statistics of
+                       previous runs stored in checkpoint
+        """
+        # Unnamed definitions can have different ids in other process,
+        # summary is matched by order of definitions
+        names = [None] + [definition.name for definition in self.definitions]
+        for name, statuses in zip(names, result['summary']):
+            for status, counters in statuses.iteritems():
+                for key, value in counters.iteritems():
+                    self.summary[name][status][key] += value
+
+        self.metrics.merge(result['operations'])
+        self.time_remove += result['time_remove']
+        self.syscalls_saved += result['syscalls_saved']
+        self.stats_skipped += result['stats_skipped']
+        self.pruned_dirs += result['pruned_dirs']
+        if self.pruned is not None:
+            self.pruned.extend(result['pruned'] or [])
+
+    def _walk_tree(self, walk):
+        """
+        Process directories returned by walk generator
+
+        :param walk: generator of (root, Listing)
+        """
+        walk = iter(walk)
+        while True:
+            try:
+                root, listing = self.walled('scan', next, walk)
+            except StopIteration:
+                break
+            self.syscalls_saved += listing.saved
+            # Number of entries left in directory
+            self.st[root] = len(listing.dirs) + len(listing.files) + listing.skipped
+
+            record = None
+            if listing.purged is not None:
+                # Content was removed by _purge(), directory isn't indexed
+                name = listing.purged['definition']
+                for status in ('removed', 'failed'):
+                    for key, value in listing.purged[status].iteritems():
+                        self.summary[name][status][key] += value
+                self.stats_skipped += listing.purged['stats_skipped']
+            elif listing.counts is not None:
+                # Directory is unchanged since previous run, count its files
+                for name, files, size in listing.counts:
+                    self.summary[name]['existing']['files'] += files
+                    self.summary[name]['existing']['size'] += size
+                if not self.dry:
+                    self.index.touch(root)
+            elif self.index and not self.dry:
+                record = self.records[root] = {
+                    'mtime': listing.mtime,
+                    'listed': listing.listed,
+                    'dirs': listing.dirs,
+                    'entries': self.st[root],
+                    'expiry': float('inf'),
+                    'counts': {},
+                }
+
+            files = listing.files
+            if self.vectorize and files:
+                self._evaluate(root, files, record)
+                files = ()
+            for name, fstat in files:
                 fname = os.path.join(root, name)
+                if fstat is None or self.walled('match', self.matcher.unmatched,
+                                                fname):
+                    # Fast path, file can't match any definition and is
+                    # counted as existing without creating File, its size
+                    # is unknown in minimal statistics (it was already
+                    # matched by _scan())
+                    if fstat is None:
+                        self.stats_skipped += 1
+                    size = fstat.st_size if fstat is not None else 0
+                    self.summary[None]['existing']['files'] += 1
+                    self.summary[None]['existing']['size'] += size
+                    if record:
+                        counts = record['counts'].setdefault(None, [0, 0])
+                        counts[0] += 1
+                        counts[1] += size
+                    continue
                 try:
-                    curr = File(fname)
+                    curr = File(fname, fstat)
                 except UnsupportedFileType as exc:
                     lg.warn('%s ..skipping' % exc)
                     continue
-                curr = self.match_delete(curr)
-                if curr.removed:
-                    self.st[root]['files'].remove(name)
-            for name in dirs:
+                self.match_delete(curr)
+                if record or self.tracker:
+                    expiry = self.matcher.expiry(curr)
+                if self.tracker and not curr.removed:
+                    self.tracker.entry(curr.path, expiry)
+                if record:
+                    record['expiry'] = min(record['expiry'], expiry)
+                    counts = record['counts'].setdefault(curr.definition, [0, 0])
+                    counts[0] += 1
+                    counts[1] += curr.stat.st_size
+            for name in listing.dirs:
                 fname = os.path.join(root,name)
+                # Directory can be evaluated only after its content is removed
+                while self.pending.get(fname):
+                    self.collect()
+                # Directory is processed, free its records
+                remaining = self.st.pop(fname, None)
+                record = self.records.pop(fname, None)
+                if remaining is None:
+                    # Directory was pruned or couldn't be listed, preserve it
+                    continue
+                if remaining:
+                    # This dir still has some entries, we'll preserve it
+                    # without stat
+                    self.syscalls_saved += 1
+                    if record:
+                        self.store(fname, record, remaining)
+                    continue
                 try:
-                    curr = File(fname)
+                    curr = File(fname, self.walled('scan', self.timed, 'stat',
+                                                   self.fs.stat, fname))
                 except UnsupportedFileType as exc:
                     lg.warn('%s ..skipping' % exc)
                     continue
-                if self.st[fname]['files'] or self.st[fname]['dirs']:
-                    # This dir still has some files/dirs, we'll preserve it
-                    for d in self.st[fname]['dirs']:
-                        # but we can remove already processed children to save memory
-                        del self.st[os.path.join(fname, d)]
-                else:
-                    curr = self.match_delete(curr)
-                    if curr.removed:
-                        self.st[root]['dirs'].remove(name)
-                        del self.st[fname]
-                    else:
-                        # Preserve not matching directory
-                        for d in self.st[fname]['dirs']:
-                            # but remove it from cache
-                            del self.st[os.path.join(fname, d)]
+                except OSError as exc:
+                    self.errh(exc)
+                    continue
+                self.match_delete(curr)
+                if self.tracker and not curr.removed:
+                    self.tracker.entry(curr.path, self.matcher.expiry(curr))
+
+            if self.tracker:
+                self.tracker.directory(root)
+            if self.removals:
+                self.flush_removals()
+
+            # Process finished removals without waiting
+            while self.remover:
+                try:
+                    self.collect(block=False)
+                except Queue.Empty:
+                    break
+
+            if self.deadline and time.time() >= self.deadline:
+                # Stop on directory boundary, so walk can be resumed after
+                # this directory
+                self.interrupted = root
+                break
+
+    def _group(self, root, files):
+        """
+        Group files of directory by definitions matching their path
+
+        :param root: path of directory
+        :param files: list of (name, stat) of regular files
+        :return: tuple (OrderedDict definitions: list of (path, stat), list
+                 of stats of unmatched files)
+        """
+        groups = OrderedDict()
+        unmatched = []
+        for name, fstat in files:
+            if fstat is None:
+                # Matching no definition by _scan() in minimal statistics
+                unmatched.append(fstat)
+                continue
+            fname = os.path.join(root, name)
+            chain = self.matcher.chain(fname)
+            if chain:
+                groups.setdefault(chain, []).append((fname, fstat))
+            else:
+                unmatched.append(fstat)
+        return groups, unmatched
+
+    def _evaluate(self, root, files, record):
+        """
+        Evaluate regular files of directory at once
+
+        Files are grouped by definitions matching their path, times of each
+        group are packed into columns and compared with cutoffs of all
+        definitions of the group in one step. Kept files are counted by
+        reductions of columns, only files to remove get File instance.
+
+        :param root: path of directory
+        :param files: list of (name, stat) of regular files, stat is None if
+                      file is unmatched in minimal statistics
+        :param record: index record of directory or None
+        """
+        groups, unmatched = self.walled('match', self._group, root, files)
+
+        # Unmatched files are counted like by fast path of _walk_tree(),
+        # their size is unknown in minimal statistics
+        sizes = [fstat.st_size for fstat in unmatched if fstat is not None]
+        self.stats_skipped += len(unmatched) - len(sizes)
+        self._count(None, len(unmatched), sum(sizes), len(unmatched),
+                    sum(sizes), record)
+
+        for chain, entries in groups.iteritems():
+            paths = []
+            stats = []
+            for fname, fstat in entries:
+                if not stat.S_ISREG(fstat.st_mode):
+                    lg.warn('File %s is not regular file ..skipping' % fname)
+                    continue
+                paths.append(fname)
+                stats.append(fstat)
+            if paths:
+                self._evaluate_group(chain, paths, stats, record)
+
+    def _evaluate_group(self, chain, paths, stats, record):
+        """
+        Evaluate files matching the same definitions by path like match()
+        does for each of them
+
+        :param chain: tuple of definitions returned by Matcher.chain()
+        :param paths: list of paths of files
+        :param stats: list of stats of files
+        :param record: index record of directory or None
+        """
+        time_start = time.time()
+        length = len(paths)
+        columns = {}
+
+        def column(name):
+            if name not in columns:
+                columns[name] = vector.column(
+                    [getattr(fstat, name) for fstat in stats])
+            return columns[name]
+
+        # Files not removed by previous definitions and files without
+        # statistical definition
+        remaining = vector.fill(length, True)
+        unlabeled = vector.fill(length, True)
+        # Lists of (definition name, mask) and (definition, mask), masks of
+        # removals don't overlap
+        labels = []
+        removals = []
+        for definition in chain:
+            matched = remaining
+            for name, cutoff in self.matcher.cutoffs[definition]:
+                matched = vector.both(matched,
+                                      vector.at_most(column(name), cutoff))
+            if definition.path_match:
+                # Matching path sets statistical definition like
+                # match_path() does
+                label = vector.both(unlabeled, remaining)
+            else:
+                label = vector.both(unlabeled, matched)
+            labels.append((definition.name, label))
+            unlabeled = vector.both(unlabeled, vector.negate(label))
+            if definition.no_remove is False:
+                removals.append((definition, matched))
+                remaining = vector.both(remaining, vector.negate(matched))
+        labels.append((None, unlabeled))
+        latency = time.time() - time_start
+        self.wall['match'] += latency
+        self.metrics.record('match', latency)
+
+        names = {}
+        removed = vector.negate(remaining)
+        for name, label in labels:
+            for index in vector.indices(vector.both(label, removed)):
+                names[index] = name
+        for definition, matched in removals:
+            for index in vector.indices(matched):
+                curr = File(paths[index], stats[index])
+                curr.definition = names[index]
+                if self.delete(curr, definition):
+                    self.update_summary(curr)
+
+        sizes = column('st_size')
+        for name, label in labels:
+            kept = vector.both(label, remaining)
+            self._count(name, vector.count(kept), vector.total(sizes, kept),
+                        vector.count(label), vector.total(sizes, label),
+                        record)
+
+        if record or self.tracker:
+            # The earliest time of removal by any definition
+            expiry = vector.constant(length, float('inf'))
+            for definition in chain:
+                if definition.no_remove is False:
+                    times = vector.constant(length, 0)
+                    for name, age in definition.ages:
+                        times = vector.maximum(times,
+                                               vector.shift(column(name), age))
+                    expiry = vector.minimum(expiry, times)
+            if record:
+                record['expiry'] = min(record['expiry'],
+                                       vector.smallest(expiry))
+            if self.tracker:
+                for index in vector.indices(remaining):
+                    self.tracker.entry(paths[index], expiry[index])
+
+    def _count(self, name, files, size, listed, listed_size, record):
+        """
+        Add kept files of definition to summary and all files of definition
+        to index record
+
+        :param name: definition name
+        :param files: number of kept files
+        :param size: size of kept files
+        :param listed: number of all files
+        :param listed_size: size of all files
+        :param record: index record of directory or None
+        """
+        if not listed:
+            return
+        self.summary[name]['existing']['files'] += files
+        self.summary[name]['existing']['size'] += int(size)
+        if record:
+            counts = record['counts'].setdefault(name, [0, 0])
+            counts[0] += listed
+            counts[1] += int(listed_size)
+
+    def store(self, path, record, remaining):
+        """
+        Store record of processed directory into index if it can be used by
+        next run
+
+        :param path: full path to a directory
+        :param record: dict created when directory was walked
+        :param remaining: number of entries left in directory
+        """
+        if remaining != record['entries']:
+            # Something was removed, directory mtime has changed
+            return
+        if record['expiry'] <= time.time():
+            # Some file has to be checked again by next run
+            return
+        if record['mtime'] >= record['listed'] - 1:
+            # Directory could be modified within mtime granularity
+            return
+        counts = [[name, files, size]
+                  for name, (files, size) in record['counts'].iteritems()]
+        self.index.put(path, record['mtime'], record['expiry'],
+                       record['dirs'], remaining, counts)
+
+    def forget(self, file):
+        """
+        Decrease number of entries left in directory of removed file
+
+        :param file: instance of File class
+        """
+        root = os.path.dirname(file.path)
+        # Directory isn't being walked when file is removed by daemon
+        if root in self.st:
+            self.st[root] -= 1
+
+    def collect(self, block=True):
+        """
+        Process one result of deletion stage
+
+        :param block: wait for result, otherwise raise Queue.Empty if there
+                      is none
+        """
+        file, counted, exc = self.walled('remove', self.remover.get, block)
+        root = os.path.dirname(file.path)
+        self.pending[root] -= 1
+        if not self.pending[root]:
+            del self.pending[root]
+
+        if exc is not None:
+            raise exc
+        if file.removed:
+            self.forget(file)
+        if counted:
+            self.update_summary(file)
 
     def run(self):
         """
         Run cleanup
         """
+        # Demote priority, threads started later inherit it
+        if self.config.get('ioprio') is not None:
+            set_ioprio(self.config['ioprio'])
+        if self.config.get('schedIdle'):
+            set_sched_idle()
+
         # Pass directory structure, gather files
         lg.warn("Passing %s" % self.config['path'])
         time_start = datetime.now()
-
-        self.walk_tree(self.config['path'])
+        if self.max_runtime:
+            self.deadline = time.time() + self.max_runtime
+
+        resumed = self.checkpoint is not None and self.checkpoint.cursor is not None
+        if resumed:
+            lg.warn("Resuming sweep after %s, run %d",
+                    os.path.join(*self.checkpoint.cursor),
+                    self.checkpoint.runs + 1)
+            # Finished directories are evaluated once their parent is
+            # processed, statistics of previous runs are added to this one
+            self.st.update(self.checkpoint.remaining)
+            self.merge(dict(self.checkpoint.result, operations={},
+                            time_remove=timedelta(seconds=0)))
+
+        complete = False
+        try:
+            self.walk_tree(self.config['path'])
+            # Records of directories finished by previous runs of sweep
+            # weren't used
+            complete = not self.interrupted and not resumed
+            self.time_pass = datetime.now() - time_start
+        finally:
+            if self.index:
+                self.index.close(complete=complete and not self.dry)
+            if self.coordinator:
+                self.coordinator.close()
         self.time_run = datetime.now() - time_start
 
+        if self.interrupted:
+            lg.warn("Runtime budget of %s seconds exhausted, stopped after %s",
+                    self.max_runtime, self.interrupted)
+        if self.checkpoint:
+            if self.interrupted:
+                self.checkpoint.save(self.interrupted, self.st, {
+                    'summary': self._ordered_summary(),
+                    'syscalls_saved': self.syscalls_saved,
+                    'stats_skipped': self.stats_skipped,
+                    'pruned_dirs': self.pruned_dirs,
+                    'pruned': self.pruned,
+                })
+            else:
+                if resumed:
+                    lg.warn("Sweep finished by %d runs started at %s",
+                            self.checkpoint.runs + 1,
+                            datetime.fromtimestamp(self.checkpoint.started))
+                self.checkpoint.clear()
+
+        if self.coordinator:
+            self.coordinator.write_summary(Exporter(self).collect(final=True))
+
     def match(self, file):
         """
         Matches at least one definition?
@@ -179,71 +1277,112 @@ class TmpCleaner(object):
         :param file: instance of File class
         :return: matching definition/None
         """
-        for definition in self.definitions:
-            # Check if file matches definition path (or path is not specified)
-            if definition.match_path(file):
-                # Check if file matches time (return True if we don't want to
-                # match time)
-                if definition.match_time(file):
-                    if definition.no_remove is False:
-                        return definition
-                    else:
-                        lg.debug("File %s matches definition %s, but we don't "
-                                 "want to remove it", file.path,
-                                 definition.name)
-                else:
-                    lg.debug("File %s matches path definition %s but haven't "
-                             "passed time match", file.path, definition.name)
-                # Break if we have found correct definition by path and if
-                # pathMatch was specified
-                #   - to avoid deleting file by more common definition
-                #   - it would be good to have an option to overwrite this
-                #     behavior if requested
-                # also break if we have already removed the file by time
-                if definition.path_match or file.removed:
-                    break
+        return self.timed('match', self.matcher.match, file)
 
-        return None
-
-    def match_delete(self, file):
+    def match_delete(self, file, existing=True):
         """
         Remove file if it matches at least one definition
 
         :param file: instance of File class
+        :param existing: count file to summary also if it's kept
         """
 
-        not_deleted = False
-        matching_definition = self.match(file)
-        if matching_definition:
-            ftype = 'directory' if file.directory else 'file'
-            lg.info("Removing %s %s, matching definition %s",
-                    ftype, file.path, matching_definition.name)
-            if not self.dry:
-                try:
-                    file.remove()
-                except OSError as e:
-                    # Directory not empty or file or directory doesn't exist,
-                    # these errors are fine just log them and go on
-                    if e.errno in [errno.ENOENT, errno.ENOTEMPTY]:
-                        not_deleted = True
-                        lg.info(e)
-                    elif e.errno in [errno.EPERM, errno.EACCES]:
-                        # Permission denied or operation not supported,
-                        # log error but go on
-                        file.failed = True
-                        lg.error(e)
-                    else:
-                        # This could be worse error, raise
-                        raise
-            else:
-                # Set removed flag manually in dry-run
-                file.removed = True
-        # don't count dirs with subdirs
-        if matching_definition and not_deleted:
+        matching_definition = self.walled('match', self.match, file)
+        if matching_definition and not self.delete(file, matching_definition):
             return file
-        self.update_summary(file)
+        if existing or file.removed or file.failed:
+            self.update_summary(file)
         return file
 
+    def delete(self, file, definition):
+        """
+        Remove file matching definition
+
+        :param file: instance of File class
+        :param definition: matching definition
+        :return: False if file shouldn't be counted now
+        :rtype: bool
+        """
+        ftype = 'directory' if file.directory else 'file'
+        self.log_removal(file, ftype, definition.name)
+        if self.dry:
+            # Set removed flag manually in dry-run
+            file.removed = True
+            if self.plan:
+                self.plan.add(file)
+        elif self.remover:
+            # Removal and summary will be finished by collect()
+            root = os.path.dirname(file.path)
+            self.pending[root] = self.pending.get(root, 0) + 1
+            self.walled('remove', self.remover.put, file)
+            return False
+        elif not self.walled('remove', self.remove, file):
+            # don't count dirs with subdirs
+            return False
+        if file.removed:
+            self.forget(file)
+        return True
+
+    def log_removal(self, file, ftype, name):
+        """
+        Log removal of file or count it for flush_removals()
+
+        :param file: instance of File class
+        :param ftype: file or directory
+        :param name: name of matching definition
+        """
+        if not self.verbose:
+            return
+        if self.aggregate_log:
+            key = (os.path.dirname(file.path), ftype, name)
+            self.removals[key] = self.removals.get(key, 0) + 1
+        else:
+            lg.info("Removing %s %s, matching definition %s",
+                    ftype, file.path, name)
+
+    def flush_removals(self):
+        """
+        Log aggregated removals
+        """
+        for (root, ftype, name), count in sorted(self.removals.items()):
+            lg.info("Removing %d %s in %s, matching definition %s", count,
+                    'directories' if ftype == 'directory' else 'files',
+                    root, name)
+        self.removals = {}
+
+    def remove(self, file):
+        """
+        Remove file, log errors that shouldn't stop cleanup
+
+        Can be called from deletion stage threads.
+
+        :param file: instance of File class
+        :return: False if file wasn't removed and shouldn't be counted
+        :rtype: bool
+        """
+        time_start = datetime.now()
+        try:
+            self.timed('rmdir' if file.directory else 'unlink', file.remove,
+                       self.fs)
+        except OSError as e:
+            # Directory not empty or file or directory doesn't exist,
+            # these errors are fine just log them and go on
+            if e.errno in [errno.ENOENT, errno.ENOTEMPTY]:
+                lg.info(e)
+                return False
+            elif e.errno in [errno.EPERM, errno.EACCES]:
+                # Permission denied or operation not supported,
+                # log error but go on
+                file.failed = True
+                lg.error(e)
+            else:
+                # This could be worse error, raise
+                raise
+        finally:
+            with self.lock:
+                self.time_remove += datetime.now() - time_start
+        return True
+
     def update_summary(self, f_object):
         """
         Update summary statistics
@@ -263,11 +1402,92 @@ class TmpCleaner(object):
             status = 'existing'
 
         self.summary[f_object.definition][status][category] += 1
+        if self.journal and status != 'existing':
+            self.journal.record(f_object)
 
         # Update size statistics
         if not f_object.directory and f_object.stat.st_size:
             self.summary[f_object.definition][status]['size'] += f_object.stat.st_size
 
+    def timed(self, operation, function, *args):
+        """
+        Call function and record its latency
+
+        :param operation: operation name for metrics
+        :param function: function to call
+        :param args: arguments of function
+        :return: return value of function
+        """
+        throttles = self.throttles.get(operation)
+        if throttles:
+            wait = sum(throttle.acquire() for throttle in throttles)
+            if wait:
+                phase = 'remove' if operation in ('unlink', 'rmdir') else 'scan'
+                self.metrics.record('throttle_%s' % phase, wait)
+
+        time_start = time.time()
+        try:
+            return function(*args)
+        finally:
+            latency = time.time() - time_start
+            self.metrics.record(operation, latency)
+            if throttles:
+                for throttle in throttles:
+                    throttle.observe(latency)
+
+    def walled(self, phase, function, *args):
+        """
+        Call function in walking thread and add its duration to wall time of
+        phase
+
+        :param phase: scan, match or remove
+        :param function: function to call
+        :param args: arguments of function
+        :return: return value of function
+        """
+        time_start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.wall[phase] += time.time() - time_start
+
+    def get_metrics(self):
+        """
+        Return timing metrics
+
+        Run, pass, scan, match and remove are wall times, scan, match and
+        remove are parts of pass spent by walking thread waiting for
+        listings, matching and removing or waiting for removal threads.
+        Busy phases are sums of latencies of operations, so they can be
+        longer than run with more threads. Throttling phases are sums of
+        times spent waiting before filesystem operations when walking and
+        removing.
+
+        :return: dict with keys phases (phase: seconds) and operations
+                 (operation: {'count', 'time', 'max', 'histogram'})
+        """
+        operations = self.metrics.get()
+
+        def total(*names):
+            return sum(operations[name]['time'] for name in names
+                       if name in operations)
+
+        return {
+            'phases': {
+                'run': self.time_run.total_seconds(),
+                'pass': self.time_pass.total_seconds(),
+                'scan': self.wall['scan'],
+                'match': self.wall['match'],
+                'remove': self.wall['remove'],
+                'scan_busy': total('listdir', 'prescan', 'stat'),
+                'match_busy': total('match'),
+                'remove_busy': total('unlink', 'rmdir'),
+                'throttle_scan': total('throttle_scan'),
+                'throttle_remove': total('throttle_remove'),
+            },
+            'operations': operations,
+        }
+
     def get_summary(self):
         """
         Return summary
@@ -276,20 +1496,120 @@ class TmpCleaner(object):
         """
         return self.summary
 
+    def _ordered_summary(self):
+        """
+        Return summary as list ordered by definitions for merge(), unnamed
+        definitions can have different ids in other process
+
+        :return: list of statuses of unspecified and all definitions
+        """
+        return [self.summary[None]] + [self.summary[definition.name]
+                                       for definition in self.definitions]
+
+
+def _clean_shard(args):
+    """
+    Clean single shard in worker process
+
+    :param args: tuple (config, dry, workers, remove_workers, prune_report,
+                 path)
+    :return: dict with shard results for TmpCleaner.merge()
+    """
+    config, dry, workers, remove_workers, prune_report, path = args
+    cleaner = TmpCleaner(config, dry=dry, workers=workers,
+                         remove_workers=remove_workers,
+                         prune_report=prune_report)
+    remaining = cleaner.walk_tree(path)
+    return {
+        'path': path,
+        'remaining': remaining,
+        'summary': cleaner._ordered_summary(),
+        'operations': cleaner.metrics.operations,
+        'time_remove': cleaner.time_remove,
+        'syscalls_saved': cleaner.syscalls_saved,
+        'stats_skipped': cleaner.stats_skipped,
+        'pruned_dirs': cleaner.pruned_dirs,
+        'pruned': cleaner.pruned,
+    }
+
+
+class Listing(object):
+    """
+    Content of single directory
+    """
+    __slots__ = ('dirs', 'files', 'skipped', 'saved', 'mtime', 'listed',
+                 'counts', 'purged')
+
+    def __init__(self):
+        """
+        Initialize empty listing
+        """
+        # Subdirectory names
+        self.dirs = []
+        # List of (name, stat) of regular files, stat is None if file
+        # matches no definition by path in minimal statistics
+        self.files = []
+        # Number of other entries that are left in directory
+        self.skipped = 0
+        # Number of stat calls avoided compared to os.walk() + File()
+        self.saved = 0
+        # Directory mtime and time of listing, set if index is used
+        self.mtime = None
+        self.listed = None
+        # List of [definition name, files, size] of existing files if
+        # listing was taken from index
+        self.counts = None
+        # Dict with definition name and counts of removed content if it was
+        # removed by TmpCleaner._purge()
+        self.purged = None
+
+
+def _stat_time(index, name):
+    """
+    Return property of File reading time from its stat
+
+    :param index: index of integer time in stat tuple
+    :param name: name of float time attribute of stat
+    """
+    def get(self):
+        return getattr(self.stat, name)
+
+    def set(self, value):
+        # Used by tests to age file, stat_result fills float times from
+        # tuple
+        fields = list(self.stat)
+        fields[index] = value
+        self.stat = posix.stat_result(fields)
+    return property(get, set)
+
 
 class File(object):
     """
     Represents single file or directory
+
+    Times are read from stat only when definitions ask for them, instance
+    has no __dict__.
     """
-    def __init__(self, path, fstat=None):
+    __slots__ = ('path', 'stat', 'directory', 'definition', 'failed',
+                 'removed')
+
+    # Backend used when none is given
+    fs = Filesystem()
+
+    atime = _stat_time(stat.ST_ATIME, 'st_atime')
+    mtime = _stat_time(stat.ST_MTIME, 'st_mtime')
+    ctime = _stat_time(stat.ST_CTIME, 'st_ctime')
+
+    def __init__(self, path, fstat=None, fs=None):
         """
         Initialize object, stat file if stat is empty
 
         :param path: full path to a file
         :param fstat: posix.stat_result (output of os.stat())
+        :param fs: Filesystem instance used for stat
         """
         self.path = path
-        self.stat = os.stat(path) if not fstat else fstat
+        self.stat = (fs or self.fs).stat(path) if not fstat else fstat
         assert isinstance(self.stat, posix.stat_result), "Stat is not instance of posix.stat_result"
 
         self.directory = stat.S_ISDIR(self.stat.st_mode)
@@ -297,26 +1617,93 @@ class File(object):
         self.failed = None
         self.removed = False
 
-        self.atime = self.stat.st_atime
-        self.mtime = self.stat.st_mtime
-        self.ctime = self.stat.st_ctime
-
         # Check if it's file or directory, otherwise raise exception
         if not self.directory and not stat.S_ISREG(self.stat.st_mode):
             raise UnsupportedFileType("File %s is not regular file or directory" % path)
 
-    def remove(self):
+    def remove(self, fs=None):
         """
         Remove file or directory
+
+        :param fs: Filesystem instance used for removal
         """
+        fs = fs or self.fs
         if self.directory:
-            os.rmdir(self.path)
+            fs.rmdir(self.path)
         else:
-            os.unlink(self.path)
+            fs.unlink(self.path)
 
         self.removed = True
 
 
+class Remover(object):
+    """
+    Deletion stage, removes files in its own threads
+
+    Files are passed through bounded queue, so walking is blocked when
+    removal can't keep up. Results are passed back to be processed by
+    walking thread.
+    """
+    def __init__(self, remove, workers, size):
+        """
+        Start threads
+
+        :param remove: function removing File, returns whether to count it
+        :param workers: number of threads
+        :param size: maximum number of files waiting for removal
+        """
+        self.remove = remove
+        self.queue = Queue.Queue(maxsize=size)
+        self.results = Queue.Queue()
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        """
+        Remove files from queue until None is received
+        """
+        while True:
+            file = self.queue.get()
+            if file is None:
+                return
+            try:
+                self.results.put((file, self.remove(file), None))
+            except Exception as exc:
+                # Pass unexpected exception to walking thread
+                self.results.put((file, False, exc))
+
+    def put(self, file):
+        """
+        Queue file for removal, blocks if queue is full
+
+        :param file: instance of File class
+        """
+        self.queue.put(file)
+
+    def get(self, block=True):
+        """
+        Return result of removal
+
+        :param block: wait for result, otherwise raise Queue.Empty if there
+                      is none
+        :return: tuple (file, counted, exception)
+        """
+        return self.results.get(block)
+
+    def stop(self):
+        """
+        Stop threads after queued files are removed
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
 class Definition(object):
     """
     Cleanup definition
@@ -334,9 +1721,39 @@ class Definition(object):
         self.path_exclude = re.compile(pathExclude) if pathExclude else None
         self.no_remove = noRemove
 
+        # Every path matching pathMatch starts with this prefix
+        self.prefix = self._literal_prefix(self.path_match) if self.path_match else ''
+
         self.mtime = 3600 * mtime if mtime else None
         self.atime = 3600 * atime if atime else None
         self.ctime = 3600 * ctime if ctime else None
+        # Stat attributes and ages checked by match_time()
+        self.ages = [(name, age) for name, age in (('st_atime', self.atime),
+                                                   ('st_mtime', self.mtime),
+                                                   ('st_ctime', self.ctime))
+                     if age]
+
+    @staticmethod
+    def _literal_prefix(regex):
+        """
+        Return literal prefix of compiled regular expression
+
+        :param regex: compiled regular expression
+        :returns: string every match starts with, empty if unknown
+        :rtype: str
+        """
+        if regex.flags & re.IGNORECASE:
+            return ''
+
+        prefix = []
+        for op, av in sre_parse.parse(regex.pattern):
+            if op == sre_constants.LITERAL:
+                prefix.append(unichr(av) if isinstance(regex.pattern, unicode) else chr(av))
+            elif op == sre_constants.AT and av == sre_constants.AT_BEGINNING:
+                continue
+            else:
+                break
+        return ''.join(prefix)
 
     def match_path(self, file):
         """
@@ -363,16 +1780,18 @@ class Definition(object):
 
         return True
 
-    def match_time(self, file):
+    def match_time(self, file, now=None):
         """
         Return True if object matches given mtime/ctime/atime
 
         :param file: instance of File
+        :param now: unix timestamp of evaluation (default current time)
         :returns: True if object matches time definition
         :rtype: bool
         """
         # Check mtime/ctime/atime
-        now = time.time()
+        if now is None:
+            now = time.time()
         if self.atime and (now - self.atime) < file.atime:
             return False
 
@@ -388,6 +1807,419 @@ class Definition(object):
 
         return True
 
+    def expiry(self, file):
+        """
+        Return time when object will match given mtime/ctime/atime
+
+        :param file: instance of File
+        :returns: unix timestamp, 0 if definition doesn't filter by time
+        :rtype: float
+        """
+        times = [0]
+        if self.atime:
+            times.append(file.atime + self.atime)
+        if self.mtime:
+            times.append(file.mtime + self.mtime)
+        if self.ctime:
+            times.append(file.ctime + self.ctime)
+        return max(times)
+
+    def cutoffs(self, now):
+        """
+        Return the latest times of object matching given atime/mtime/ctime
+
+        :param now: unix timestamp of evaluation
+        :returns: list of (stat attribute, unix timestamp)
+        """
+        return [(name, now - age) for name, age in self.ages]
+
+
+class Matcher(object):
+    """
+    Finds matching definition for file
+
+    pathMatch expressions of all definitions are compiled into single
+    alternation, so the first definition matching by path is found by one
+    regular expression match. Only definitions without pathMatch in front of
+    it have to be checked one by one.
+
+    Alternation is split into chunks if expressions together have more
+    groups than sre supports.
+    """
+    # sre of Python < 3.5 supports only 100 groups including the whole match
+    groups_max = 99
+
+    def __init__(self, definitions):
+        """
+        Compile definitions
+
+        :param definitions: list of Definition instances, first match has
+                            precedence
+        """
+        self.definitions = definitions
+        self.combined = self._combinable()
+        # Combined expression of definitions from given index and index of
+        # the first definition not included in it
+        self.cache = {}
+
+        # Near misses are logged only in debug level, checked once
+        self.debug = lg.isEnabledFor(logging.DEBUG)
+
+        # Time of evaluation shared by all files and cutoffs of definitions
+        # computed from it, see set_time()
+        self.now = None
+        self.cutoffs = {}
+
+        # Expressions of pathMatch and pathExclude of definitions matching
+        # only paths whose all descendants match too
+        self.closures = [(self._closure(definition.path_match),
+                          self._closure(definition.path_exclude))
+                         for definition in self.definitions]
+
+        # Definitions without pathMatch preceding definition on given index
+        self.preceding = [[]]
+        for definition in self.definitions:
+            preceding = list(self.preceding[-1])
+            if not definition.path_match:
+                preceding.append(definition)
+            self.preceding.append(preceding)
+
+    def set_time(self, now):
+        """
+        Evaluate times of all files against the same time, so it isn't read
+        for every file
+
+        :param now: unix timestamp, None to use current time for each file
+        """
+        self.now = now
+        self.cutoffs = {}
+        if now is not None:
+            for definition in self.definitions:
+                self.cutoffs[definition] = definition.cutoffs(now)
+
+    @staticmethod
+    def _closure(regex):
+        """
+        Return expression that matches path only if it matches every path
+        starting with it
+
+        Match of expression can't depend on characters after matched part
+        except for end anchors, they are replaced by expression that never
+        matches.
+
+        :param regex: compiled regular expression or None
+        :return: compiled expression, None if it can't be built
+        """
+        if regex is None:
+            return None
+        never = sre_parse.parse('(?!)')[0]
+
+        def relax(subpattern):
+            for index, (op, av) in enumerate(subpattern):
+                if op == sre_constants.AT:
+                    if av in (sre_constants.AT_END, sre_constants.AT_END_STRING):
+                        subpattern[index] = never
+                    elif av not in (sre_constants.AT_BEGINNING,
+                                    sre_constants.AT_BEGINNING_STRING):
+                        # Word boundary depends on following character
+                        return False
+                elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                    # Lookahead depends on following characters
+                    if av[0] > 0 or not relax(av[1]):
+                        return False
+                elif op == sre_constants.SUBPATTERN:
+                    if not relax(av[-1]):
+                        return False
+                elif op == sre_constants.BRANCH:
+                    if not all(relax(branch) for branch in av[1]):
+                        return False
+                elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                    if not relax(av[2]):
+                        return False
+                elif op == sre_constants.GROUPREF_EXISTS:
+                    if not all(relax(branch) for branch in av[1:] if branch):
+                        return False
+            return True
+
+        try:
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+            if not relax(parsed):
+                return None
+            return sre_compile.compile(parsed, regex.flags)
+        except (re.error, TypeError, ValueError):
+            return None
+
+    def subtree(self, path):
+        """
+        Return definition removing every entry below directory, entries
+        don't have to be evaluated one by one
+
+        Nothing below directory can match preceding definitions, the
+        definition has no time criteria nor pathExclude and its pathMatch
+        matches every path below directory.
+
+        :param path: full path of directory
+        :return: Definition instance or None
+        """
+        inner = os.path.join(path, '')
+        for definition, (closure, exclude) in zip(self.definitions,
+                                                  self.closures):
+            if exclude and exclude.match(inner):
+                # Everything below directory is excluded
+                continue
+            prefix = definition.prefix
+            if prefix and not (prefix.startswith(inner) or
+                               inner.startswith(prefix)):
+                # Nothing below directory can match
+                continue
+            if (not definition.no_remove and not definition.path_exclude and
+                    not (definition.atime or definition.mtime or
+                         definition.ctime) and
+                    (not definition.path_match or
+                     (closure and closure.match(inner)))):
+                return definition
+            # Some entry below directory can stop at this definition
+            return None
+        return None
+
+    def _combinable(self):
+        """
+        Return True if pathMatch expressions can be joined into alternation
+
+        Expressions with backreferences, global flags or clashing group names
+        would change their meaning, expression with too many groups can't be
+        compiled with marker group.
+
+        :rtype: bool
+        """
+        flags = re.compile('').flags
+        names = set()
+        for definition in self.definitions:
+            regex = definition.path_match
+            if not regex:
+                continue
+            if regex.flags != flags:
+                return False
+            if regex.groups + 1 > self.groups_max:
+                return False
+            if re.search(r'\\[1-9]|\(\?P=|\(\?\(', regex.pattern):
+                return False
+            if names.intersection(regex.groupindex):
+                return False
+            names.update(regex.groupindex)
+        return True
+
+    def _regex(self, start):
+        """
+        Return combined pathMatch expression of definitions from given index
+
+        :param start: index of first definition
+        :return: tuple (compiled expression or None if there is no pathMatch,
+                 index of the first definition after expression)
+        """
+        if start not in self.cache:
+            parts = []
+            groups = 0
+            end = start
+            for definition in self.definitions[start:]:
+                regex = definition.path_match
+                if regex:
+                    # Expression groups and marker group
+                    if groups + regex.groups + 1 > self.groups_max:
+                        break
+                    groups += regex.groups + 1
+                    parts.append('(?:%s)(?P<_matcher_%d>)' % (regex.pattern, end))
+                end += 1
+            self.cache[start] = (re.compile('|'.join(parts)) if parts else None,
+                                 end)
+        return self.cache[start]
+
+    def first(self, path):
+        """
+        Return index of first definition matching path by pathMatch
+
+        :param path: full path
+        :return: index of definition or number of definitions if none matches
+        """
+        start = 0
+        while True:
+            regex, end = self._regex(start)
+            result = regex.match(path) if regex else None
+            if not result:
+                if end < len(self.definitions):
+                    # Continue with next chunk
+                    start = end
+                    continue
+                return len(self.definitions)
+            # Name of the group closed last is the marker after expression
+            index = int(result.lastgroup.rsplit('_', 1)[1])
+            exclude = self.definitions[index].path_exclude
+            if not exclude or not exclude.match(path):
+                return index
+            start = index + 1
+
+    def match(self, file):
+        """
+        Matches at least one definition?
+
+        :param file: instance of File class
+        :return: matching definition/None
+        """
+        if not self.combined:
+            return self.match_sequential(file)
+
+        index = self.first(file.path)
+        for definition in self.preceding[index]:
+            if definition.match_path(file):
+                if self.match_definition(definition, file):
+                    return definition
+                if file.removed:
+                    return None
+
+        if index < len(self.definitions):
+            definition = self.definitions[index]
+            # Set definition for statistical purposes like match_path() does
+            if not file.definition:
+                file.definition = definition.name
+            return self.match_definition(definition, file)
+        return None
+
+    def unmatched(self, path):
+        """
+        Check if no definition matches path, such file can't be removed and
+        isn't counted to any definition
+
+        :param path: full path of regular file
+        :rtype: bool
+        """
+        if self.combined:
+            index = self.first(path)
+            if index < len(self.definitions):
+                return False
+            definitions = self.preceding[index]
+        else:
+            definitions = self.definitions
+
+        for definition in definitions:
+            if definition.path_exclude and definition.path_exclude.match(path):
+                continue
+            if definition.path_match and not definition.path_match.match(path):
+                continue
+            return False
+        return True
+
+    def chain(self, path):
+        """
+        Return definitions matching path in order they are checked by
+        match(), only the last one can have pathMatch
+
+        :param path: full path of regular file
+        :returns: tuple of Definition instances, empty if file is unmatched
+        """
+        if self.combined:
+            index = self.first(path)
+            chain = [definition for definition in self.preceding[index]
+                     if not definition.path_exclude or
+                     not definition.path_exclude.match(path)]
+            if index < len(self.definitions):
+                chain.append(self.definitions[index])
+            return tuple(chain)
+
+        chain = []
+        for definition in self.definitions:
+            if definition.path_exclude and definition.path_exclude.match(path):
+                continue
+            if definition.path_match:
+                if definition.path_match.match(path):
+                    chain.append(definition)
+                    break
+                continue
+            chain.append(definition)
+        return tuple(chain)
+
+    def candidates(self, file):
+        """
+        Return definitions matching file by path in order they are checked,
+        file can match only one of them
+
+        :param file: instance of File class
+        :returns: list of Definition instances
+        """
+        if self.combined:
+            index = self.first(file.path)
+            candidates = [definition for definition in self.preceding[index]
+                          if definition.match_path(file)]
+            if index < len(self.definitions):
+                candidates.append(self.definitions[index])
+        else:
+            candidates = []
+            for definition in self.definitions:
+                if definition.match_path(file):
+                    candidates.append(definition)
+                    if definition.path_match:
+                        break
+        return candidates
+
+    def expiry(self, file):
+        """
+        Return the earliest time when file can match definition allowing
+        removal, times of file are expected to only grow
+
+        :param file: instance of File class
+        :returns: unix timestamp, inf if file will never be removed
+        :rtype: float
+        """
+        expiry = float('inf')
+        for definition in self.candidates(file):
+            if definition.no_remove is False:
+                expiry = min(expiry, definition.expiry(file))
+        return expiry
+
+    def match_sequential(self, file):
+        """
+        Matches at least one definition? Check definitions one by one.
+
+        :param file: instance of File class
+        :return: matching definition/None
+        """
+        for definition in self.definitions:
+            # Check if file matches definition path (or path is not specified)
+            if definition.match_path(file):
+                if self.match_definition(definition, file):
+                    return definition
+                # Break if we have found correct definition by path and if
+                # pathMatch was specified
+                #   - to avoid deleting file by more common definition
+                #   - it would be good to have an option to overwrite this
+                #     behavior if requested
+                # also break if we have already removed the file by time
+                if definition.path_match or file.removed:
+                    break
+
+        return None
+
+    def match_definition(self, definition, file):
+        """
+        Check time and noRemove of definition already matching file by path
+
+        :param definition: instance of Definition
+        :param file: instance of File
+        :return: definition if file should be removed, None otherwise
+        """
+        # Check if file matches time (return True if we don't want to
+        # match time)
+        if definition.match_time(file, self.now):
+            if definition.no_remove is False:
+                return definition
+            elif self.debug:
+                lg.debug("File %s matches definition %s, but we don't "
+                         "want to remove it", file.path,
+                         definition.name)
+        elif self.debug:
+            lg.debug("File %s matches path definition %s but haven't "
+                     "passed time match", file.path, definition.name)
+        return None
+
 
 ## Exceptions
 class UnsupportedFileType(Exception):
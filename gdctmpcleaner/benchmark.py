@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Benchmark of TmpCleaner on generated trees
+
+Tree has given depth and fanout of directories with given number of files in
+each directory. Files are split between rules by their shares, file of rule
+has suffix matched by pathMatch of rule definition, other files don't match
+any definition. Times of files are set by os.utime according to distribution
+of ages.
+
+Each run is done in forked process on freshly generated tree, so its peak
+RSS can be measured.
+"""
+
+import os
+import json
+import random
+import re
+import shutil
+import tempfile
+import time
+
+from gdctmpcleaner import TmpCleaner
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+# Operations that are filesystem calls
+SYSCALLS = ('listdir', 'prescan', 'stat', 'unlink', 'rmdir')
+
+
+class Spec(object):
+    """
+    Parameters of generated tree
+    """
+    def __init__(self, depth=3, fanout=10, files=10, ages=None, rules=None,
+                 seed=0):
+        """
+        Setup parameters
+
+        :param depth: number of directory levels
+        :param fanout: number of subdirectories of each directory
+        :param files: number of files in each directory below top
+        :param ages: list of (hours, weight) pairs, age of file is chosen
+                     by weight (default all files are new)
+        :param rules: list of dicts with keys name, share (fraction of files
+                      matching rule) and optional definition options mtime,
+                      atime, ctime and noRemove
+        :param seed: seed of random generator
+        """
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.ages = ages or [(0, 1)]
+        self.rules = rules or []
+        self.seed = seed
+
+        if sum(rule['share'] for rule in self.rules) > 1:
+            raise ValueError('Shares of rules can\'t exceed 1')
+
+    def definitions(self, path):
+        """
+        Return definitions of rules for tree in path
+
+        :param path: top of generated tree
+        :return: list of dicts
+        """
+        definitions = []
+        for rule in self.rules:
+            definition = dict((key, value) for key, value in rule.items()
+                              if key != 'share')
+            definition['pathMatch'] = '%s/.*\\.%s$' % (re.escape(path),
+                                                      re.escape(rule['name']))
+            definitions.append(definition)
+        return definitions
+
+    def to_dict(self):
+        """
+        Return parameters as dict
+        """
+        return {
+            'depth': self.depth,
+            'fanout': self.fanout,
+            'files': self.files,
+            'ages': [list(age) for age in self.ages],
+            'rules': self.rules,
+            'seed': self.seed,
+        }
+
+
+def generate(spec, path):
+    """
+    Generate tree
+
+    :param spec: Spec instance
+    :param path: existing empty directory
+    :return: dict with numbers of dirs and files and dict of files per rule
+             name
+    """
+    rng = random.Random(spec.seed)
+    now = time.time()
+    total_weight = float(sum(weight for _, weight in spec.ages))
+    counts = dict((rule['name'], 0) for rule in spec.rules)
+    counts[None] = 0
+
+    def choose_age():
+        point = rng.random() * total_weight
+        for hours, weight in spec.ages:
+            point -= weight
+            if point < 0:
+                break
+        return hours
+
+    def choose_rule():
+        point = rng.random()
+        for rule in spec.rules:
+            point -= rule['share']
+            if point < 0:
+                return rule['name']
+        return None
+
+    created = {'dirs': 0, 'files': 0}
+    dirs = [path]
+    for level in range(spec.depth):
+        children = []
+        for parent in dirs:
+            for i in range(spec.fanout):
+                child = os.path.join(parent, 'd%d' % i)
+                os.mkdir(child)
+                children.append(child)
+                created['dirs'] += 1
+
+                for f in range(spec.files):
+                    rule = choose_rule()
+                    name = 'f%d.%s' % (f, rule) if rule else 'f%d' % f
+                    file_path = os.path.join(child, name)
+                    open(file_path, 'w').close()
+                    # Files are a bit older than their age to pass
+                    # thresholds equal to age
+                    mtime = now - choose_age() * 3600 - 60
+                    os.utime(file_path, (mtime, mtime))
+                    counts[rule] += 1
+                    created['files'] += 1
+        dirs = children
+
+    created['rules'] = counts
+    return created
+
+
+def _measure(function):
+    """
+    Run function in forked process
+
+    :param function: function returning JSON serializable result
+    :return: tuple (result, peak RSS of process in kB)
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            with os.fdopen(write_fd, 'w') as fh:
+                json.dump(function(), fh)
+            status = 0
+        except Exception:
+            lg.exception("Benchmark run failed")
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fh:
+        data = fh.read()
+    _, status, usage = os.wait4(pid, 0)
+    if status != 0:
+        raise RuntimeError('Benchmark run failed with status %s' % status)
+    return json.loads(data), usage.ru_maxrss
+
+
+def run(spec, dry=True, options=None, directory=None):
+    """
+    Generate tree and run TmpCleaner on it
+
+    :param spec: Spec instance
+    :param dry: run in dry-run mode
+    :param options: dict of additional global config options, eg. workers
+    :param directory: directory where tree is generated (default system
+                      temporary directory)
+    :return: dict with results
+    """
+    temp = tempfile.mkdtemp(prefix='tmpcleaner-benchmark.', dir=directory)
+    try:
+        top = os.path.join(temp, 'tree')
+        os.mkdir(top)
+        time_start = time.time()
+        created = generate(spec, top)
+        time_generate = time.time() - time_start
+
+        config = dict(options or {})
+        config.update({
+            'pidfile': '',
+            'path': top,
+            'definitions': spec.definitions(top),
+        })
+
+        def clean():
+            cleaner = TmpCleaner(config, dry=dry)
+            cleaner.run()
+            summary = dict((str(name) if name is not None else 'unspecified',
+                            statuses)
+                           for name, statuses in cleaner.get_summary().items())
+            return {'metrics': cleaner.get_metrics(), 'summary': summary}
+
+        result, rss = _measure(clean)
+    finally:
+        shutil.rmtree(temp)
+
+    metrics = result['metrics']
+    operations = metrics['operations']
+    # Walked entries and top directory
+    entries = created['dirs'] + created['files'] + 1
+    syscalls = sum(operations[name]['count'] for name in SYSCALLS
+                   if name in operations)
+    duration = metrics['phases']['run']
+    return {
+        'dry': dry,
+        'options': options or {},
+        'entries': entries,
+        'dirs': created['dirs'],
+        'files': created['files'],
+        'rules': dict((str(name) if name is not None else 'unspecified', count)
+                      for name, count in created['rules'].items()),
+        'generate_seconds': time_generate,
+        'duration': duration,
+        'entries_per_second': entries / duration if duration else 0.0,
+        'syscalls': syscalls,
+        'syscalls_per_entry': float(syscalls) / entries,
+        'peak_rss_kb': rss,
+        'phases': metrics['phases'],
+        'operations': dict((name, {'count': data['count'], 'time': data['time']})
+                           for name, data in operations.items()),
+        'summary': result['summary'],
+    }
+
+
+def benchmark(spec, modes=('dry', 'real'), options=None, directory=None,
+              repeat=1):
+    """
+    Run benchmark in requested modes
+
+    :param spec: Spec instance
+    :param modes: list of dry and real
+    :param options: dict of additional global config options
+    :param directory: directory where trees are generated
+    :param repeat: number of runs of each mode
+    :return: dict with parameters and list of results
+    """
+    results = []
+    for mode in modes:
+        for _ in range(repeat):
+            result = run(spec, dry=(mode == 'dry'), options=options,
+                         directory=directory)
+            lg.info("Benchmark %s: entries=%d duration=%.3f "
+                    "entries_per_second=%.0f syscalls_per_entry=%.2f "
+                    "peak_rss_kb=%d", mode, result['entries'],
+                    result['duration'], result['entries_per_second'],
+                    result['syscalls_per_entry'], result['peak_rss_kb'])
+            results.append(result)
+
+    return {
+        'timestamp': time.time(),
+        'spec': spec.to_dict(),
+        'options': options or {},
+        'results': results,
+    }
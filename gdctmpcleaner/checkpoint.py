@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Checkpoint of sweep split into several runs
+
+Directories are walked depth-first in order of sorted names, so position of
+walk is given by the last processed directory. It is stored as cursor, list
+of path components relative to top, every directory before the cursor in
+that order is finished. Checkpoint keeps also number of entries left in
+finished directories whose parent wasn't processed yet, so they are
+evaluated by the next run, and statistics of previous runs of the sweep, so
+the run that finishes the sweep reports statistics of the whole tree.
+"""
+
+import os
+import errno
+import hashlib
+import json
+import time
+
+from gdctmpcleaner.export import write_atomic
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+
+def _native(name):
+    """
+    Return path loaded from JSON as str, names from listing are str too
+    """
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+class Checkpoint(object):
+    """
+    JSON file with cursor and statistics of unfinished sweep
+    """
+    def __init__(self, path, top, definitions):
+        """
+        Load checkpoint, start new sweep if it doesn't exist or it belongs to
+        other path or definitions
+
+        :param path: path to checkpoint file
+        :param top: path of walked tree
+        :param definitions: definitions section of configuration
+        """
+        self.path = path
+        self.top = top
+        self.checksum = hashlib.sha1(
+            json.dumps(definitions, sort_keys=True)).hexdigest()
+
+        # Cursor of last finished directory, None if sweep starts
+        self.cursor = None
+        # Number of previous runs of sweep and start of its first run
+        self.runs = 0
+        self.started = time.time()
+        # Full path: number of entries left in finished directories
+        self.remaining = {}
+        # Statistics of previous runs in format of _clean_shard() result
+        self.result = None
+
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return
+        except ValueError:
+            lg.warn("Checkpoint %s is corrupted, starting new sweep", path)
+            return
+
+        if data.get('top') != top or data.get('checksum') != self.checksum:
+            lg.warn("Path or definitions have changed, starting new sweep "
+                    "instead of checkpoint %s", path)
+            return
+        self.cursor = tuple(_native(name) for name in data['cursor'])
+        self.remaining = dict((os.path.join(top, _native(directory)), entries)
+                              for directory, entries
+                              in data['remaining'].items())
+        self.runs = data['runs']
+        self.started = data['started']
+        self.result = data['result']
+
+    def finished(self, path):
+        """
+        Check if directory was finished by previous run
+
+        :param path: full path to a directory inside top
+        :rtype: bool
+        """
+        if self.cursor is None:
+            return False
+        components = tuple(os.path.relpath(path, self.top).split(os.sep))
+        if components[:len(self.cursor)] == self.cursor:
+            # Cursor and its descendants
+            return True
+        # Ancestors of cursor are before it, but they aren't finished
+        return (components < self.cursor and
+                self.cursor[:len(components)] != components)
+
+    def save(self, path, remaining, result):
+        """
+        Store position of interrupted sweep
+
+        :param path: full path of the last processed directory
+        :param remaining: dict full path: number of entries left in finished
+                          directories waiting for their parent
+        :param result: statistics of sweep so far in format of
+                       _clean_shard() result
+        """
+        data = {
+            'top': self.top,
+            'checksum': self.checksum,
+            'cursor': os.path.relpath(path, self.top).split(os.sep),
+            'remaining': dict((os.path.relpath(directory, self.top), entries)
+                              for directory, entries in remaining.items()),
+            'runs': self.runs + 1,
+            'started': self.started,
+            'result': result,
+        }
+        write_atomic(self.path, json.dumps(data, indent=2, sort_keys=True) + '\n')
+
+    def clear(self):
+        """
+        Remove checkpoint of finished sweep
+        """
+        try:
+            os.unlink(self.path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
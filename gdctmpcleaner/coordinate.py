@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Cooperation of several instances cleaning the same shared tree
+
+Instances split top-level subdirectories between them by lease files in
+shared coordination directory. Lease is created exclusively, renewed while
+its subdirectory is being cleaned and replaced by done marker with number
+of entries left in subdirectory when it's finished. Lease that wasn't
+renewed for lease time belongs to crashed instance and can be taken over.
+Each instance writes its partial summary, partial summaries of one run can
+be merged.
+"""
+
+import os
+import errno
+import glob
+import hashlib
+import json
+import socket
+import threading
+import time
+
+from gdctmpcleaner.export import write_atomic
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+
+class Coordinator(object):
+    """
+    Claims subtrees by lease files in directory of single run
+    """
+    def __init__(self, directory, lease_time=300):
+        """
+        Setup coordinator, create run directory if it doesn't exist
+
+        :param directory: coordination directory of this run, shared by all
+                          instances
+        :param lease_time: seconds after which lease that wasn't renewed
+                           expires
+        """
+        self.directory = directory
+        self.lease_time = lease_time
+        # Leases are renewed and expired leases checked three times per
+        # lease time
+        self.interval = lease_time / 3.0
+        self.owner = '%s.%d' % (socket.gethostname(), os.getpid())
+
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        # path: lease file of claimed subtrees
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _file(self, path, kind):
+        """
+        Return path of lease or done marker of subtree
+        """
+        name = hashlib.sha1(path.encode('utf-8') if isinstance(path, unicode)
+                            else path).hexdigest()
+        return os.path.join(self.directory, '%s.%s' % (name, kind))
+
+    def expired(self, lease):
+        """
+        Check if lease wasn't renewed for lease time
+
+        :param lease: path of lease file
+        :return: True if lease is expired, None if it doesn't exist
+        """
+        try:
+            mtime = os.stat(lease).st_mtime
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+        return mtime + self.lease_time < time.time()
+
+    def finished(self, path):
+        """
+        Check if subtree was finished by some instance
+
+        :param path: full path of subtree
+        :rtype: bool
+        """
+        return os.path.exists(self._file(path, 'done'))
+
+    def claim(self, path):
+        """
+        Try to claim subtree
+
+        :param path: full path of subtree
+        :return: True if subtree was claimed and has to be cleaned
+        :rtype: bool
+        """
+        lease = self._file(path, 'lease')
+        while not self.finished(path):
+            try:
+                fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            else:
+                with os.fdopen(fd, 'w') as fh:
+                    json.dump({'owner': self.owner, 'path': path}, fh)
+                if self.finished(path):
+                    # Lease was renamed to done marker since the check
+                    os.unlink(lease)
+                    return False
+                with self.lock:
+                    self.leases[path] = lease
+                self._start()
+                return True
+
+            if not self.expired(lease):
+                # Claimed by running instance
+                return False
+
+            # Only one instance succeeds in moving expired lease away
+            stale = '%s.%s' % (lease, self.owner)
+            try:
+                os.rename(lease, stale)
+            except OSError as exc:
+                if exc.errno == errno.ENOENT:
+                    return False
+                raise
+            if not self.expired(stale):
+                # Lease was renewed or taken over by other instance
+                # meanwhile, put it back
+                try:
+                    os.link(stale, lease)
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+                os.unlink(stale)
+                return False
+            os.unlink(stale)
+            lg.warn("Taking over expired lease of %s", path)
+        return False
+
+    def release(self, path, remaining=None):
+        """
+        Mark claimed subtree as finished
+
+        :param path: full path of subtree
+        :param remaining: number of entries left in subtree root, None if it
+                          wasn't walked
+        :return: False if lease was taken over by other instance, which
+                 marks the subtree finished itself
+        :rtype: bool
+        """
+        with self.lock:
+            lease = self.leases.pop(path)
+            try:
+                with open(lease) as fh:
+                    owner = json.load(fh).get('owner')
+            except (IOError, ValueError):
+                # Lease was removed or is being written by new owner
+                owner = None
+            if owner != self.owner:
+                lg.warn("Lease of %s was taken over as expired, it's left "
+                        "to its new owner", path)
+                return False
+            with open(lease, 'w') as fh:
+                json.dump({'owner': self.owner, 'path': path,
+                           'remaining': remaining}, fh)
+            os.rename(lease, self._file(path, 'done'))
+        return True
+
+    def remaining(self, path):
+        """
+        Return number of entries left in root of finished subtree
+
+        :param path: full path of subtree
+        :return: number of entries, None if subtree root wasn't walked
+        """
+        with open(self._file(path, 'done')) as fh:
+            return json.load(fh).get('remaining')
+
+    def _start(self):
+        """
+        Start renewing of claimed leases
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._renew)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _renew(self):
+        """
+        Renew claimed leases periodically until stopped
+        """
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                leases = self.leases.items()
+            for path, lease in leases:
+                try:
+                    os.utime(lease, None)
+                except OSError as exc:
+                    lg.error("Can't renew lease of %s: %s", path, exc)
+
+    def close(self):
+        """
+        Stop renewing, unfinished leases are left to expire
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def write_summary(self, data):
+        """
+        Write partial summary of this instance
+
+        :param data: dict returned by Exporter.collect()
+        """
+        write_atomic(os.path.join(self.directory,
+                                  'summary.%s.json' % self.owner),
+                     json.dumps(data, indent=2, sort_keys=True) + '\n')
+
+
+def merge_summaries(directory):
+    """
+    Merge partial summaries of all instances of one run
+
+    :param directory: coordination directory of the run
+    :return: dict in format of Exporter.collect(), duration is the longest
+             one, None if there is no summary
+    """
+    merged = None
+    for path in sorted(glob.glob(os.path.join(directory, 'summary.*.json'))):
+        with open(path) as fh:
+            data = json.load(fh)
+        if merged is None:
+            merged = data
+            merged['instances'] = 1
+            continue
+
+        merged['instances'] += 1
+        merged['final'] = merged['final'] and data['final']
+        merged['timestamp'] = max(merged['timestamp'], data['timestamp'])
+        merged['duration'] = max(merged['duration'], data['duration'])
+        for key in ('entries', 'removed_size', 'syscalls_saved',
+                    'stats_skipped', 'pruned_dirs'):
+            merged[key] += data[key]
+
+        for name, statuses in data['definitions'].iteritems():
+            merged_statuses = merged['definitions'].setdefault(name, statuses)
+            if merged_statuses is statuses:
+                continue
+            for status, counters in statuses.iteritems():
+                for key, value in counters.iteritems():
+                    merged_statuses[status][key] += value
+
+        for phase, seconds in data['phases'].iteritems():
+            if phase in ('run', 'pass'):
+                merged['phases'][phase] = max(merged['phases'][phase], seconds)
+            else:
+                merged['phases'][phase] += seconds
+
+        for operation, values in data['operations'].iteritems():
+            merged_values = merged['operations'].setdefault(operation, values)
+            if merged_values is values:
+                continue
+            merged_values['count'] += values['count']
+            merged_values['time'] += values['time']
+            merged_values['max'] = max(merged_values['max'], values['max'])
+            for bucket, (bound, hits) in zip(merged_values['histogram'],
+                                             values['histogram']):
+                bucket[1] += hits
+
+    if merged:
+        duration = merged['duration']
+        merged['entries_per_second'] = merged['entries'] / duration if duration else 0.0
+        merged['removed_bytes_per_second'] = merged['removed_size'] / duration if duration else 0.0
+    return merged
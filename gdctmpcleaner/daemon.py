@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Daemon mode, incremental cleaning driven by inotify
+
+Initial full pass records the earliest time when each kept entry can match
+definition allowing removal into min-heap and watches every walked
+directory. Daemon then sleeps until the first entry expires or inotify
+reports new entry. Expired entry is stat'ed again and evaluated by
+definitions, times of entries only grow (except for explicit change of
+times that is reported by IN_ATTRIB), so it's kept with new expiry if it
+doesn't match yet.
+
+When limit of watches is reached or events are lost, changes aren't
+reported reliably and the whole tree is walked again periodically.
+"""
+
+import os
+import errno
+import heapq
+import select
+import threading
+import time
+from datetime import timedelta
+
+from gdctmpcleaner import File, UnsupportedFileType, InvalidConfiguration
+from gdctmpcleaner import inotify
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+# Events of watched directories
+WATCH_MASK = (inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_ATTRIB |
+              inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+              inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+              inotify.IN_ONLYDIR | inotify.IN_DONTFOLLOW)
+
+
+class Daemon(object):
+    """
+    Keeps cleaning tree of TmpCleaner until stopped
+    """
+    # Maximum time between checks of stop request
+    tick = 1.0
+
+    def __init__(self, cleaner):
+        """
+        Setup daemon
+
+        Config options rescanInterval (seconds between full passes when
+        changes can't be watched, default 3600) and maxWatches (maximum
+        number of watched directories, default system limit) are used.
+
+        :param cleaner: TmpCleaner instance
+        """
+        self.cleaner = cleaner
+        config = cleaner.config
+        if cleaner.processes > 1 or cleaner.coordinator or cleaner.max_runtime:
+            raise InvalidConfiguration('Daemon mode can\'t be used with multiple processes, coordinationDir or maxRuntime')
+        if cleaner.index or cleaner.checkpoint:
+            # Files of indexed or skipped directories wouldn't be tracked
+            raise InvalidConfiguration('Daemon mode can\'t be used with stateFile or checkpointFile')
+
+        self.top = os.path.normpath(config['path'])
+        self.rescan_interval = config.get('rescanInterval') or 3600
+        if not isinstance(self.rescan_interval, (int, float)) or self.rescan_interval <= 0:
+            raise InvalidConfiguration('rescanInterval has to be positive number, not %s' % self.rescan_interval)
+        self.max_watches = config.get('maxWatches')
+        if self.max_watches is not None and (
+                not isinstance(self.max_watches, int) or self.max_watches < 1):
+            raise InvalidConfiguration('maxWatches has to be positive integer, not %s' % self.max_watches)
+
+        # Heap of (expiry, path) and the current expiry of each entry,
+        # heap items with other expiry are stale
+        self.heap = []
+        self.expiry = {}
+        # Watched directories, wd: path and path: wd
+        self.paths = {}
+        self.watches = {}
+        # Time of next full pass, None while all changes are watched
+        self.rescan = None
+        self.inotify = None
+        self.stopped = threading.Event()
+
+    def entry(self, path, expiry):
+        """
+        Track entry kept by walk
+
+        :param path: full path of file or empty directory
+        :param expiry: time when entry can match definition allowing
+                       removal, inf if it never will
+        """
+        if expiry == float('inf'):
+            self.expiry.pop(path, None)
+            return
+        self.expiry[path] = expiry
+        heapq.heappush(self.heap, (expiry, path))
+
+    def directory(self, path):
+        """
+        Watch walked directory
+
+        :param path: full path to a directory
+        """
+        if self.inotify is None or path in self.watches:
+            return
+        if self.max_watches and len(self.watches) >= self.max_watches:
+            self._lost("Limit of %d watches reached" % self.max_watches)
+            return
+        try:
+            wd = self.inotify.add_watch(path, WATCH_MASK)
+        except OSError as exc:
+            if exc.errno == errno.ENOSPC:
+                self._lost("Limit of inotify watches reached")
+            elif exc.errno != errno.ENOENT:
+                lg.error("Can't watch %s: %s", path, exc)
+            return
+        # Directory moved in replaces previous path of the same inode
+        self.watches.pop(self.paths.get(wd), None)
+        self.paths[wd] = path
+        self.watches[path] = wd
+
+    def _lost(self, reason):
+        """
+        Schedule periodic full passes, changes aren't watched reliably
+        """
+        if self.rescan is None:
+            lg.warn("%s, tree will be walked every %s seconds", reason,
+                    self.rescan_interval)
+            self.rescan = time.time() + self.rescan_interval
+
+    def _forget(self, path):
+        """
+        Stop tracking entries and watches in removed or moved directory
+        """
+        prefix = os.path.join(path, '')
+        for tracked in [tracked for tracked in self.expiry
+                        if tracked.startswith(prefix)]:
+            del self.expiry[tracked]
+        for watched in [watched for watched in self.watches
+                        if watched == path or watched.startswith(prefix)]:
+            wd = self.watches.pop(watched)
+            self.paths.pop(wd, None)
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                # Watch was already removed with directory
+                pass
+
+    def _pass(self):
+        """
+        Walk the whole tree, rebuild heap and watches
+        """
+        lg.warn("Passing %s", self.top)
+        self.heap = []
+        self.expiry = {}
+        # Existing entries are counted again by each pass
+        for statuses in self.cleaner.summary.values():
+            for key in statuses['existing']:
+                statuses['existing'][key] = 0
+        self.cleaner.walk_tree(self.top)
+
+    def _handle(self, events):
+        """
+        Process inotify events
+        """
+        for wd, mask, cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                self._lost("Inotify events were lost")
+                continue
+            root = self.paths.get(wd)
+            if root is None:
+                continue
+            if mask & inotify.IN_IGNORED:
+                self.paths.pop(wd, None)
+                if self.watches.get(root) == wd:
+                    del self.watches[root]
+                continue
+            if not name:
+                # Event of watched directory itself, it's handled by its
+                # parent
+                continue
+
+            path = os.path.join(root, name)
+            if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                self.expiry.pop(path, None)
+                if mask & inotify.IN_ISDIR:
+                    self._forget(path)
+                if root != self.top:
+                    # Directory could be left empty by other process
+                    self._check(root)
+            elif mask & inotify.IN_ISDIR:
+                if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    # New subtree, clean it and watch it, directory itself
+                    # is evaluated if it's empty
+                    if self.cleaner.walk_tree(path) == 0:
+                        self._check(path)
+            else:
+                # New file or its times were changed
+                self._check(path)
+
+    def _check(self, path):
+        """
+        Evaluate entry and track it with its new expiry if it's kept, kept
+        entry isn't counted to summary again
+
+        :param path: full path of entry
+        """
+        self.expiry.pop(path, None)
+        cleaner = self.cleaner
+        try:
+            fstat = cleaner.timed('stat', cleaner.fs.lstat, path)
+            curr = File(path, fstat)
+            if curr.directory and cleaner.timed('listdir', cleaner.fs.listdir, path):
+                # Directory is evaluated again once it's empty
+                return
+        except UnsupportedFileType as exc:
+            lg.warn('%s ..skipping' % exc)
+            return
+        except OSError as exc:
+            cleaner.errh(exc)
+            return
+
+        cleaner.match_delete(curr, existing=False)
+        if curr.removed:
+            parent = os.path.dirname(path)
+            if parent.startswith(os.path.join(self.top, '')):
+                # Parent could be left empty
+                self._check(parent)
+        else:
+            expiry = cleaner.matcher.expiry(curr)
+            if expiry > time.time():
+                self.entry(path, expiry)
+
+    def _expire(self):
+        """
+        Evaluate entries whose expiry has passed
+        """
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            expiry, path = heapq.heappop(self.heap)
+            if self.expiry.get(path) != expiry:
+                # Stale item, entry was removed or tracked again
+                continue
+            self._check(path)
+
+    def run(self):
+        """
+        Run initial pass and keep cleaning until stop() is called
+        """
+        try:
+            self.inotify = inotify.Inotify()
+        except (OSError, AttributeError) as exc:
+            # AttributeError if libc doesn't support inotify
+            self._lost("Can't initialize inotify (%s)" % exc)
+
+        self.cleaner.tracker = self
+        time_start = time.time()
+        try:
+            self._pass()
+            self.cleaner.time_pass = timedelta(seconds=time.time() - time_start)
+            lg.warn("Initial pass finished, watching %d directories and "
+                    "%d entries", len(self.watches), len(self.expiry))
+
+            while not self.stopped.is_set():
+                now = time.time()
+                timeout = self.tick
+                if self.heap:
+                    timeout = min(timeout, self.heap[0][0] - now)
+                if self.rescan is not None:
+                    timeout = min(timeout, self.rescan - now)
+
+                if self.inotify is not None:
+                    try:
+                        ready = select.select([self.inotify], [], [],
+                                              max(timeout, 0))[0]
+                    except select.error as exc:
+                        # Interrupted by signal requesting stop
+                        if exc.args[0] != errno.EINTR:
+                            raise
+                        ready = []
+                    if ready:
+                        self._handle(self.inotify.read())
+                elif timeout > 0:
+                    self.stopped.wait(timeout)
+
+                self._expire()
+                # Removals of events and expired entries
+                self.cleaner.flush_removals()
+                if self.rescan is not None and time.time() >= self.rescan:
+                    self._pass()
+                    self.rescan = time.time() + self.rescan_interval
+                self.cleaner.time_run = timedelta(seconds=time.time() - time_start)
+        finally:
+            self.cleaner.tracker = None
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+    def stop(self):
+        """
+        Request daemon to stop, can be called from other thread or signal
+        handler
+        """
+        self.stopped.set()
+
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Export of summary and metrics in machine-readable formats
+
+Supported formats are JSON and Prometheus text exposition format suitable for
+node_exporter textfile collector. Files are replaced atomically, so they can
+be written periodically during long runs.
+"""
+
+import os
+import json
+import tempfile
+import threading
+import time
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+
+def write_atomic(path, content):
+    """
+    Replace file content atomically
+
+    :param path: path to a file
+    :param content: string to write
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(content)
+        os.chmod(temp, 0o644)
+        os.rename(temp, path)
+    except:
+        os.unlink(temp)
+        raise
+
+
+def _label(value):
+    """
+    Escape Prometheus label value
+    """
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Exporter(object):
+    """
+    Writes summary and metrics of TmpCleaner to files
+    """
+    def __init__(self, cleaner, json_path=None, prometheus_path=None,
+                 interval=None):
+        """
+        Setup exporter
+
+        :param cleaner: TmpCleaner instance
+        :param json_path: path of JSON file
+        :param prometheus_path: path of Prometheus textfile
+        :param interval: seconds between periodic writes during run, None to
+                         write only at the end
+        """
+        self.cleaner = cleaner
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+
+        self.time_start = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start measuring run duration and periodic writing if requested
+        """
+        self.time_start = time.time()
+        if self.interval:
+            self.thread = threading.Thread(target=self._flush)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _flush(self):
+        """
+        Write files periodically until stopped
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as exc:
+                # Don't let exporting break cleanup
+                lg.error("Can't write metrics: %s", exc)
+
+    def stop(self, final=True):
+        """
+        Stop periodic writing
+
+        :param final: write final results
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if final:
+            self.write(final=True)
+
+    def collect(self, final=False):
+        """
+        Return summary and metrics
+
+        :param final: run has finished
+        :return: dict
+        """
+        summary = self.cleaner.get_summary()
+        metrics = self.cleaner.get_metrics()
+
+        if final:
+            duration = self.cleaner.time_run.total_seconds()
+        else:
+            duration = time.time() - self.time_start
+
+        definitions = {}
+        entries = 0
+        removed_size = 0
+        for name, statuses in summary.items():
+            if name is None:
+                name = 'unspecified'
+            definitions[str(name)] = dict(
+                (status, dict(counters)) for status, counters in statuses.items())
+            for counters in statuses.values():
+                entries += counters['files'] + counters['dirs']
+            removed_size += statuses['removed']['size']
+
+        return {
+            'path': self.cleaner.config['path'],
+            'dry': self.cleaner.dry,
+            'final': final,
+            'timestamp': time.time(),
+            'duration': duration,
+            'entries': entries,
+            'removed_size': removed_size,
+            'entries_per_second': entries / duration if duration else 0.0,
+            'removed_bytes_per_second': removed_size / duration if duration else 0.0,
+            'syscalls_saved': self.cleaner.syscalls_saved,
+            'stats_skipped': self.cleaner.stats_skipped,
+            'pruned_dirs': self.cleaner.pruned_dirs,
+            'definitions': definitions,
+            'phases': metrics['phases'],
+            'operations': metrics['operations'],
+        }
+
+    def write(self, final=False):
+        """
+        Write all requested files
+
+        :param final: run has finished
+        """
+        data = self.collect(final)
+        if self.json_path:
+            write_atomic(self.json_path, json.dumps(data, indent=2,
+                                                    sort_keys=True) + '\n')
+        if self.prometheus_path:
+            write_atomic(self.prometheus_path,
+                         self.format_prometheus(data).encode('utf-8'))
+
+    @staticmethod
+    def format_prometheus(data):
+        """
+        Format data in Prometheus text exposition format
+
+        :param data: dict returned by collect()
+        :return: unicode string
+        """
+        path = _label(data['path'])
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(u'# HELP tmpcleaner_%s %s' % (name, help))
+            lines.append(u'# TYPE tmpcleaner_%s %s' % (name, kind))
+            for labels, value in samples:
+                labels = u','.join([u'path="%s"' % path] +
+                                   [u'%s="%s"' % (key, _label(val))
+                                    for key, val in labels])
+                lines.append(u'tmpcleaner_%s{%s} %r' % (name, labels, float(value)))
+
+        metric('entries', 'gauge',
+               'Number of files and directories by definition and status',
+               [((('definition', name), ('status', status), ('type', kind)),
+                 counters[kind])
+                for name, statuses in sorted(data['definitions'].items())
+                for status, counters in sorted(statuses.items())
+                for kind in ('files', 'dirs')])
+        metric('size_bytes', 'gauge',
+               'Size of files by definition and status',
+               [((('definition', name), ('status', status)), counters['size'])
+                for name, statuses in sorted(data['definitions'].items())
+                for status, counters in sorted(statuses.items())])
+        metric('running', 'gauge', 'Whether cleanup is still running',
+               [((), 0 if data['final'] else 1)])
+        metric('dry_run', 'gauge', 'Whether cleanup runs in dry-run mode',
+               [((), 1 if data['dry'] else 0)])
+        metric('last_update_timestamp_seconds', 'gauge',
+               'Time when this file was written',
+               [((), data['timestamp'])])
+        metric('duration_seconds', 'gauge', 'Duration of the run',
+               [((), data['duration'])])
+        metric('entries_per_second', 'gauge',
+               'Number of processed entries per second',
+               [((), data['entries_per_second'])])
+        metric('removed_bytes_per_second', 'gauge',
+               'Size of removed files per second',
+               [((), data['removed_bytes_per_second'])])
+        metric('syscalls_saved', 'gauge',
+               'Number of stat calls avoided compared to os.walk()',
+               [((), data['syscalls_saved'])])
+        metric('stats_skipped', 'gauge',
+               'Number of files not stat\'ed in minimal statistics',
+               [((), data['stats_skipped'])])
+        metric('pruned_dirs', 'gauge', 'Number of directories not walked',
+               [((), data['pruned_dirs'])])
+        metric('phase_seconds', 'gauge', 'Time spent in phase',
+               [((('phase', phase),), seconds)
+                for phase, seconds in sorted(data['phases'].items())])
+        metric('operations_total', 'counter', 'Number of operations',
+               [((('operation', operation),), values['count'])
+                for operation, values in sorted(data['operations'].items())])
+        metric('operation_seconds_total', 'counter', 'Time spent in operations',
+               [((('operation', operation),), values['time'])
+                for operation, values in sorted(data['operations'].items())])
+
+        return u'\n'.join(lines) + u'\n'
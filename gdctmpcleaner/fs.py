@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Filesystem backends used for listing, stat and removal
+
+Filesystem passes calls to the local filesystem. DirFilesystem does the
+same relative to open descriptors of parent directories. FaultyFilesystem
+adds latency, jitter and errors to calls of other backend, so behavior on
+slow network filesystems can be reproduced on local disk.
+"""
+
+import os
+import errno
+import random
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5, use backported module
+    from scandir import scandir
+
+# Operations of backends
+OPERATIONS = ('scandir', 'listdir', 'stat', 'lstat', 'unlink', 'rmdir')
+
+# Errors that can be injected
+ERRORS = {
+    'EACCES': errno.EACCES,
+    'ENOENT': errno.ENOENT,
+    'EIO': errno.EIO,
+}
+
+
+class Filesystem(object):
+    """
+    Local filesystem
+    """
+    def scandir(self, path):
+        """
+        Return list of directory entries with name and path attributes and
+        is_dir() and is_file() methods
+        """
+        return list(scandir(path))
+
+    def listdir(self, path):
+        """
+        Return list of names in directory
+        """
+        return os.listdir(path)
+
+    def stat(self, path):
+        """
+        Return stat of path
+        """
+        return os.stat(path)
+
+    def lstat(self, path):
+        """
+        Return stat of path, don't follow symlinks
+        """
+        return os.lstat(path)
+
+    def unlink(self, path):
+        """
+        Remove file
+        """
+        os.unlink(path)
+
+    def rmdir(self, path):
+        """
+        Remove empty directory
+        """
+        os.rmdir(path)
+
+    def set_top(self, path):
+        """
+        Set top of walked tree, components above it can be symlinks
+
+        :param path: normalized path of directory
+        """
+        pass
+
+    def close(self):
+        """
+        Release resources kept between calls
+        """
+        pass
+
+
+class _Entry(object):
+    """
+    Directory entry of DirFilesystem with path of listed directory
+    """
+    __slots__ = ('name', 'path', 'entry')
+
+    def __init__(self, name, path, entry):
+        self.name = name
+        self.path = path
+        self.entry = entry
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+
+class DirFilesystem(Filesystem):
+    """
+    Local filesystem accessed relative to open directory descriptors
+
+    Directory is opened relative to descriptor of its parent, parent closed
+    meanwhile is opened again the same way, only top of walked tree (or /
+    if it isn't set) is opened by absolute path. Entries are stat'ed,
+    listed and removed relative to descriptor of their directory, so only
+    the last component of path is looked up. Component opened relative to
+    parent isn't followed if it's symlink, so directory replaced by symlink
+    during walk isn't entered and entries of open directory are removed
+    even if it was moved.
+
+    Python 2 has no dir_fd arguments, descriptor-relative paths
+    /proc/self/fd/FD/NAME are used instead, kernel resolves them from the
+    open descriptor.
+
+    Descriptors are kept in LRU cache of given size, descriptors used by
+    other threads aren't closed.
+    """
+    proc = '/proc/self/fd'
+
+    def __init__(self, maxOpen=64):
+        """
+        Setup backend
+
+        :param maxOpen: maximum number of open directory descriptors not
+                        used at the moment
+        :raises ValueError: if limit is invalid or /proc isn't mounted
+        """
+        if not isinstance(maxOpen, int) or maxOpen < 1:
+            raise ValueError('maxOpen has to be positive integer, not %s' % maxOpen)
+        if not os.path.isdir(self.proc):
+            raise ValueError('%s is not available' % self.proc)
+        self.max_open = maxOpen
+        # Only directory opened by absolute path besides /
+        self.top = None
+        # path: [descriptor, number of users, closed when unused], the
+        # least recently used first
+        self.fds = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _acquire(self, path):
+        """
+        Return descriptor of directory, it isn't closed until released
+
+        :param path: normalized path of directory
+        :rtype: int
+        """
+        with self.lock:
+            entry = self.fds.pop(path, None)
+            if entry is not None:
+                self.fds[path] = entry
+                entry[1] += 1
+                return entry[0]
+
+        flags = os.O_RDONLY | os.O_DIRECTORY | getattr(os, 'O_CLOEXEC', 0o2000000)
+        parent, name = os.path.split(path)
+        if name and path != self.top:
+            # Parent is opened again if it was closed
+            self._acquire(parent)
+            try:
+                fd = self._call(os.open, path, parent, name,
+                                flags | os.O_NOFOLLOW)
+            finally:
+                self._release(parent)
+        else:
+            # Components of top can be symlinks
+            fd = os.open(path, flags)
+
+        with self.lock:
+            entry = self.fds.get(path)
+            if entry is not None:
+                # Opened by other thread meanwhile
+                os.close(fd)
+                entry[1] += 1
+                return entry[0]
+            self.fds[path] = [fd, 1, False]
+            if len(self.fds) > self.max_open:
+                for lru in [lru for lru, (_, users, _) in self.fds.items()
+                            if not users][:len(self.fds) - self.max_open]:
+                    os.close(self.fds.pop(lru)[0])
+        return fd
+
+    def _release(self, path):
+        """
+        Release descriptor of directory returned by _acquire()
+        """
+        with self.lock:
+            entry = self.fds.get(path)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[2] and not entry[1]:
+                del self.fds[path]
+                os.close(entry[0])
+
+    def _forget(self, path):
+        """
+        Close descriptor of removed directory once it's unused
+        """
+        with self.lock:
+            entry = self.fds.get(path)
+            if entry is None:
+                return
+            if entry[1]:
+                entry[2] = True
+            else:
+                del self.fds[path]
+                os.close(entry[0])
+
+    def _call(self, function, path, directory, name, *args):
+        """
+        Call function with path relative to descriptor of directory, errors
+        contain original path
+        """
+        fd = self.fds[directory][0]
+        try:
+            return function('%s/%d/%s' % (self.proc, fd, name), *args)
+        except OSError as exc:
+            raise OSError(exc.errno, exc.strerror, path)
+
+    def _relative(self, function, path, *args):
+        """
+        Call function with path relative to descriptor of its directory
+        """
+        path = os.path.normpath(path)
+        directory, name = os.path.split(path)
+        if not name or name == '..':
+            return function(path, *args)
+        self._acquire(directory)
+        try:
+            return self._call(function, path, directory, name, *args)
+        finally:
+            self._release(directory)
+
+    def scandir(self, path):
+        path = os.path.normpath(path)
+        self._acquire(path)
+        try:
+            return [_Entry(entry.name, os.path.join(path, entry.name), entry)
+                    for entry in self._call(lambda proc: list(scandir(proc)),
+                                            path, path, '.')]
+        finally:
+            self._release(path)
+
+    def listdir(self, path):
+        path = os.path.normpath(path)
+        self._acquire(path)
+        try:
+            return self._call(os.listdir, path, path, '.')
+        finally:
+            self._release(path)
+
+    def stat(self, path):
+        return self._relative(os.stat, path)
+
+    def lstat(self, path):
+        return self._relative(os.lstat, path)
+
+    def unlink(self, path):
+        self._relative(os.unlink, path)
+
+    def rmdir(self, path):
+        self._relative(os.rmdir, path)
+        self._forget(os.path.normpath(path))
+
+    def set_top(self, path):
+        self.top = os.path.normpath(path)
+
+    def close(self):
+        """
+        Close all unused descriptors
+        """
+        with self.lock:
+            for path, (fd, users, _) in self.fds.items():
+                if not users:
+                    del self.fds[path]
+                    os.close(fd)
+
+
+class FaultyFilesystem(Filesystem):
+    """
+    Filesystem adding latency and errors to calls of other backend
+    """
+    def __init__(self, latency=None, jitter=0.0, errors=None, seed=None,
+                 backend=None):
+        """
+        Setup backend
+
+        :param latency: seconds added to every operation or dict
+                        operation: seconds
+        :param jitter: maximum of random seconds added to latency
+        :param errors: dict operation: {error name: probability}, errors
+                       are EACCES, ENOENT and EIO
+        :param seed: seed of random generator
+        :param backend: Filesystem instance to call (default local)
+        """
+        if isinstance(latency, dict):
+            self.latency = latency
+        else:
+            self.latency = dict.fromkeys(OPERATIONS, latency or 0.0)
+        self.jitter = jitter
+        self.errors = errors or {}
+        self.backend = backend or Filesystem()
+
+        for operation in set(self.latency) | set(self.errors):
+            if operation not in OPERATIONS:
+                raise ValueError('Unknown operation %s' % operation)
+        for operation_errors in self.errors.values():
+            for name in operation_errors:
+                if name not in ERRORS:
+                    raise ValueError('Unknown error %s' % name)
+
+        # Random generator is shared by threads
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def _call(self, operation, path):
+        """
+        Wait for latency of operation, raise error or call backend
+        """
+        with self.lock:
+            delay = self.latency.get(operation) or 0.0
+            if self.jitter:
+                delay += self.random.uniform(0, self.jitter)
+            failure = None
+            for name, probability in sorted(self.errors.get(operation, {}).items()):
+                if self.random.random() < probability:
+                    failure = ERRORS[name]
+                    break
+
+        if delay:
+            time.sleep(delay)
+        if failure is not None:
+            raise OSError(failure, os.strerror(failure), path)
+        return getattr(self.backend, operation)(path)
+
+    def scandir(self, path):
+        return self._call('scandir', path)
+
+    def listdir(self, path):
+        return self._call('listdir', path)
+
+    def stat(self, path):
+        return self._call('stat', path)
+
+    def lstat(self, path):
+        return self._call('lstat', path)
+
+    def unlink(self, path):
+        return self._call('unlink', path)
+
+    def rmdir(self, path):
+        return self._call('rmdir', path)
+
+    def set_top(self, path):
+        self.backend.set_top(path)
+
+    def close(self):
+        self.backend.close()
+
+
+def create(options):
+    """
+    Create backend from config option filesystem
+
+    :param options: dict with key backend (local, dirfd or faulty) and
+                    arguments of DirFilesystem or FaultyFilesystem, None for
+                    local filesystem
+    :return: Filesystem instance
+    :raises ValueError: on invalid options
+    """
+    options = dict(options or {})
+    backend = options.pop('backend', 'local')
+    if backend == 'local':
+        return Filesystem()
+    elif backend == 'dirfd':
+        try:
+            return DirFilesystem(**options)
+        except TypeError as exc:
+            raise ValueError(exc)
+    elif backend == 'faulty':
+        try:
+            return FaultyFilesystem(**options)
+        except TypeError as exc:
+            raise ValueError(exc)
+    raise ValueError('Unknown filesystem backend %s' % backend)
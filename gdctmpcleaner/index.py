@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Persistent index of directories that don't have to be listed again
+
+For each directory it keeps its mtime, subdirectory names, number of
+entries, statistics of existing files directly in it and the earliest time
+when any of those files can match definition allowing removal. Directory with
+unchanged mtime and expiry in future doesn't have to be listed and its files
+don't have to be stat'ed.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+
+class Index(object):
+    """
+    SQLite backed directory index
+    """
+    def __init__(self, path, definitions):
+        """
+        Open index, drop its content if definitions have changed
+
+        :param path: path to SQLite database file
+        :param definitions: definitions section of configuration
+        """
+        self.path = path
+        self.checksum = hashlib.sha1(
+            json.dumps(definitions, sort_keys=True)).hexdigest()
+        self.lock = threading.Lock()
+
+        # Index is read from listing threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirs '
+                        '(path TEXT PRIMARY KEY, mtime REAL, expiry REAL, '
+                        'dirs TEXT, entries INTEGER, counts TEXT, run INTEGER)')
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'checksum'").fetchone()
+        if not row or row[0] != self.checksum:
+            if row:
+                lg.warn("Definitions have changed, invalidating index %s", path)
+            self.db.execute('DELETE FROM dirs')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('checksum', ?)",
+                            (self.checksum,))
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+        self.run = int(row[0]) + 1 if row else 1
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)",
+                        (str(self.run),))
+        self.db.commit()
+
+    def get(self, path):
+        """
+        Return index record of directory
+
+        :param path: full path to a directory
+        :return: dict with keys mtime, expiry, dirs, entries and counts or
+                 None if directory isn't indexed
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT mtime, expiry, dirs, entries, counts FROM dirs '
+                'WHERE path = ?', (path,)).fetchone()
+        if not row:
+            return None
+        return {
+            'mtime': row[0],
+            'expiry': row[1],
+            'dirs': json.loads(row[2]),
+            'entries': row[3],
+            'counts': json.loads(row[4]),
+        }
+
+    def put(self, path, mtime, expiry, dirs, entries, counts):
+        """
+        Store directory record
+
+        :param path: full path to a directory
+        :param mtime: mtime of directory before it was listed
+        :param expiry: the earliest time when some file can be removed
+        :param dirs: list of subdirectory names
+        :param entries: number of entries in directory
+        :param counts: list of [definition name, files, size] of existing
+                       files
+        """
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, mtime, expiry, json.dumps(dirs), entries,
+                 json.dumps(counts), self.run))
+
+    def touch(self, path):
+        """
+        Mark directory record as used by current run
+
+        :param path: full path to a directory
+        """
+        with self.lock:
+            self.db.execute('UPDATE dirs SET run = ? WHERE path = ?',
+                            (self.run, path))
+
+    def close(self, complete=False):
+        """
+        Commit changes and close index
+
+        :param complete: whole tree was walked, drop records of directories
+                         that weren't seen
+        """
+        with self.lock:
+            if complete:
+                self.db.execute('DELETE FROM dirs WHERE run != ?', (self.run,))
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Minimal inotify binding through ctypes
+
+Only what daemon mode needs: watching directories for created, deleted,
+moved and changed entries and reading events without blocking.
+"""
+
+import ctypes
+import errno
+import os
+import struct
+
+# Events
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+# Flags of events
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# Flags of watches
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+
+# Flags of inotify_init1()
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without name
+EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Inotify instance
+    """
+    def __init__(self):
+        """
+        Create inotify instance
+
+        :raises OSError: if inotify isn't available or limit of instances
+                         is reached
+        """
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        """
+        Return file descriptor, can be passed to select()
+        """
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        Watch path
+
+        :param path: path to a directory
+        :param mask: events to watch
+        :return: watch descriptor, the same for already watched inode
+        :raises OSError: ENOSPC when limit of watches is reached
+        """
+        wd = self.libc.inotify_add_watch(
+            self.fd, path.encode('utf-8') if isinstance(path, unicode) else path,
+            ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Stop watching, IN_IGNORED event is generated for the watch
+
+        :param wd: watch descriptor
+        """
+        if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def read(self):
+        """
+        Read pending events without blocking
+
+        :return: list of (wd, mask, cookie, name), name is empty for events
+                 of watched directory itself
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        """
+        Close inotify instance, all watches are removed
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Append-only journal of removals
+
+Each removed or failed entry is recorded with its path, type, size, times,
+matching definition and outcome. Records are kept in memory and written
+by background thread in batches, so removal doesn't wait for the journal.
+
+Two formats are supported:
+ - ndjson - one JSON object per line, paths which aren't valid UTF-8 get
+   replacement characters
+ - binary - file starts with MAGIC, each record is length-prefixed struct
+   RECORD followed by raw path and definition name
+
+Each batch is written by single write(2) to descriptor opened with
+O_APPEND, so batches of processes sharing the journal don't interleave.
+Definition names are always written as strings.
+
+Journal is rotated once it exceeds given size, rotated files get suffixes
+.1 (the newest) to .N.
+"""
+
+import os
+import errno
+import json
+import struct
+import threading
+import time
+
+FORMATS = ('ndjson', 'binary')
+
+# First bytes of binary journal
+MAGIC = 'TMPCLNJ1\n'
+# Length of the rest of record, time of removal, flags, size, atime, mtime,
+# ctime, length of path and length of definition name
+RECORD = struct.Struct('<IdBQdddHH')
+FLAG_DIRECTORY = 1
+FLAG_FAILED = 2
+
+
+def _encode_ndjson(item):
+    """
+    Encode record tuple as JSON line
+    """
+    stamp, path, directory, fstat, definition, failed = item
+    return json.dumps({
+        'time': stamp,
+        'path': path.decode('utf-8', 'replace') if isinstance(path, str) else path,
+        'type': 'directory' if directory else 'file',
+        'size': fstat.st_size,
+        'atime': fstat.st_atime,
+        'mtime': fstat.st_mtime,
+        'ctime': fstat.st_ctime,
+        'definition': unicode(definition) if definition is not None else None,
+        'outcome': 'failed' if failed else 'removed',
+    }, sort_keys=True) + '\n'
+
+
+def _encode_binary(item):
+    """
+    Encode record tuple as binary record
+    """
+    stamp, path, directory, fstat, definition, failed = item
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    definition = unicode(definition).encode('utf-8') if definition is not None else ''
+    flags = (FLAG_DIRECTORY if directory else 0) | (FLAG_FAILED if failed else 0)
+    return RECORD.pack(RECORD.size - 4 + len(path) + len(definition), stamp,
+                       flags, fstat.st_size, fstat.st_atime, fstat.st_mtime,
+                       fstat.st_ctime, len(path), len(definition)) + \
+        path + definition
+
+
+class Journal(object):
+    """
+    Buffered writer of journal
+    """
+    def __init__(self, path, fmt='ndjson', batch=1000, interval=5.0,
+                 max_size=None, backups=5):
+        """
+        Open journal for appending
+
+        :param path: path to journal file
+        :param fmt: ndjson or binary
+        :param batch: number of records written at once
+        :param interval: maximum seconds record waits in memory
+        :param max_size: rotate journal exceeding this number of bytes,
+                         None to never rotate
+        :param backups: number of rotated files kept
+        :raises ValueError: on invalid format or limits
+        """
+        if fmt not in FORMATS:
+            raise ValueError('format has to be one of %s, not %s' % (
+                ', '.join(FORMATS), fmt))
+        if max_size is not None and max_size <= 0:
+            raise ValueError('maximum size has to be positive, not %s' % max_size)
+        if backups < 1:
+            raise ValueError('number of backups has to be positive, not %s' % backups)
+        self.path = path
+        self.fmt = fmt
+        self.encode = _encode_binary if fmt == 'binary' else _encode_ndjson
+        self.batch = batch
+        self.interval = interval
+        self.max_size = max_size
+        self.backups = backups
+
+        # Records waiting for writing, lock of buffer and lock of file
+        # serializing batches
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.full = threading.Event()
+        self.closed = False
+        # Writer is started with the first record, so processes can be
+        # forked before
+        self.thread = None
+        self.fd = None
+        self._open()
+
+    def _open(self):
+        """
+        Open journal file, binary file gets header if it's new
+        """
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        if self.fmt == 'binary':
+            try:
+                # Only process creating the file writes header
+                fd = os.open(self.path, flags | os.O_EXCL, 0o644)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            else:
+                self._write(fd, MAGIC)
+                os.close(fd)
+        # Appends of other processes writing the same journal aren't
+        # overwritten
+        self.fd = os.open(self.path, flags, 0o644)
+
+    @staticmethod
+    def _write(fd, data):
+        """
+        Write whole data, single write(2) unless it's interrupted
+        """
+        while data:
+            data = data[os.write(fd, data):]
+
+    def record(self, file):
+        """
+        Add removed or failed file, can be called from removal threads
+
+        :param file: instance of File
+        """
+        item = (time.time(), file.path, file.directory, file.stat,
+                file.definition, file.failed)
+        with self.lock:
+            self.buffer.append(item)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work)
+                self.thread.daemon = True
+                self.thread.start()
+            if len(self.buffer) >= self.batch:
+                self.full.set()
+
+    def _work(self):
+        """
+        Write buffer when batch is full or interval passed
+        """
+        while not self.closed:
+            self.full.wait(self.interval)
+            self.full.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered records
+        """
+        with self.write_lock:
+            with self.lock:
+                items, self.buffer = self.buffer, []
+            if not items or self.fd is None:
+                return
+            self._write(self.fd, ''.join(self.encode(item) for item in items))
+            if self.max_size and os.fstat(self.fd).st_size >= self.max_size:
+                self._rotate()
+
+    def _rotate(self):
+        """
+        Shift rotated files and start new journal
+        """
+        os.close(self.fd)
+        for number in range(self.backups - 1, 0, -1):
+            older = '%s.%d' % (self.path, number)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.path, number + 1))
+        os.rename(self.path, '%s.1' % self.path)
+        self._open()
+
+    def close(self):
+        """
+        Write the rest of records and close journal
+        """
+        self.closed = True
+        self.full.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        with self.write_lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+def read(path):
+    """
+    Read journal of any format
+
+    :param path: path to journal file
+    :return: generator of dicts with keys time, path, type, size, atime,
+             mtime, ctime, definition and outcome
+    :raises ValueError: if binary journal is truncated
+    """
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            fh.seek(0)
+            for line in fh:
+                if line.strip():
+                    record = json.loads(line)
+                    # Older journals have ids of unnamed definitions as
+                    # numbers
+                    if record['definition'] is not None:
+                        record['definition'] = unicode(record['definition'])
+                    yield record
+            return
+
+        while True:
+            prefix = fh.read(4)
+            if not prefix:
+                return
+            if len(prefix) < 4:
+                raise ValueError('Truncated record in %s' % path)
+            data = prefix + fh.read(struct.unpack('<I', prefix)[0])
+            if len(data) < RECORD.size:
+                raise ValueError('Truncated record in %s' % path)
+            (_, stamp, flags, size, atime, mtime, ctime, path_len,
+             definition_len) = RECORD.unpack_from(data)
+            if len(data) != RECORD.size + path_len + definition_len:
+                raise ValueError('Truncated record in %s' % path)
+            names = data[RECORD.size:]
+            yield {
+                'time': stamp,
+                'path': names[:path_len],
+                'type': 'directory' if flags & FLAG_DIRECTORY else 'file',
+                'size': size,
+                'atime': atime,
+                'mtime': mtime,
+                'ctime': ctime,
+                'definition': names[path_len:].decode('utf-8') or None,
+                'outcome': 'failed' if flags & FLAG_FAILED else 'removed',
+            }
@@ -16,24 +16,34 @@ import logging
 lg = logging.getLogger('application')
 """
 
+import atexit
 import logging
 import logging.handlers
 from gdctmpcleaner.logger.level_handler import LevelHandler
+from gdctmpcleaner.logger.queue_handler import QueueHandler
 
 lg = None
 
 # Initialize logging
-def init(name='', level=logging.WARN, syslog=True, console=True):
+def init(name='', level=logging.WARN, syslog=True, console=True,
+         queued=False, batch=100):
+    """
+    Setup console and syslog handlers
+
+    With queued handlers records are written by background thread in
+    batches of given size, waiting records are written at exit.
+    """
     global lg
 
     lg = logging.getLogger(name)
     lg.setLevel(level)
+    handlers = []
 
     if console:
         lg_console = LevelHandler()
         lg_console.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
 
-        lg.addHandler(lg_console)
+        handlers.append(lg_console)
 
     if syslog:
         lg_syslog = logging.handlers.SysLogHandler(
@@ -41,6 +51,14 @@ def init(name='', level=logging.WARN, syslog=True, console=True):
             address='/dev/log')
         lg_syslog.setFormatter(logging.Formatter('%(name)-9s %(levelname)-8s %(message)s'))
 
-        lg.addHandler(lg_syslog)
+        handlers.append(lg_syslog)
+
+    if queued and handlers:
+        lg_queue = QueueHandler(handlers, batch=batch)
+        atexit.register(lg_queue.close)
+        handlers = [lg_queue]
+
+    for handler in handlers:
+        lg.addHandler(handler)
 
     return lg
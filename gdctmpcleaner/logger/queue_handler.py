@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Asynchronous logging handler
+
+Records are put into queue by logging thread without waiting for I/O and
+passed to target handlers by background thread in batches. Console
+handlers get the whole batch in single write. Forked processes don't
+have the background thread and write their records directly. When the
+queue is full, debug and info records are dropped, warnings and errors
+wait for free space.
+"""
+
+import os
+import logging
+import threading
+import Queue
+
+from gdctmpcleaner.logger.level_handler import LevelHandler
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler passing records to other handlers from background thread
+    """
+    def __init__(self, handlers, batch=100, size=10000):
+        """
+        Start background thread
+
+        :param handlers: list of target handlers
+        :param batch: maximum number of records written at once
+        :param size: maximum number of waiting records, debug and info
+                     records are dropped when queue is full
+        """
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.batch = batch
+        self.queue = Queue.Queue(maxsize=size)
+        # Number of records dropped since the last batch and its lock
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        """
+        Format message and exception in calling thread, arguments can
+        change before record is written
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        """
+        Queue record, block only for warnings and errors if queue is full
+        """
+        try:
+            if os.getpid() != self.pid or not self.thread.is_alive():
+                # Forked process or handler already closed
+                for handler in self.handlers:
+                    self._write(handler, [record])
+                return
+            record = self.prepare(record)
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _work(self):
+        """
+        Write queued records until None is received
+        """
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stop = None in records
+            records = [record for record in records if record is not None]
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                records.append(logging.LogRecord(
+                    'tmpcleaner', logging.WARN, __file__, 0,
+                    '%d log records were dropped, logging can\'t keep up',
+                    (dropped,), None))
+            for handler in self.handlers:
+                self._write(handler, records)
+            if stop:
+                return
+
+    @staticmethod
+    def _write(handler, records):
+        """
+        Write records by handler, console gets one write per stream
+        """
+        records = [record for record in records
+                   if record.levelno >= handler.level]
+        if not records:
+            return
+        if not isinstance(handler, LevelHandler):
+            for record in records:
+                handler.handle(record)
+            return
+
+        handler.acquire()
+        try:
+            lines = {}
+            for record in records:
+                if record.levelno >= handler._level:
+                    stream = handler._stream_greater_or_equal
+                else:
+                    stream = handler._stream_lower
+                lines.setdefault(stream, []).append(handler.format(record))
+            for stream, messages in lines.items():
+                stream.write('\n'.join(messages) + '\n')
+                stream.flush()
+        except Exception:
+            handler.handleError(records[-1])
+        finally:
+            handler.release()
+
+    def close(self):
+        """
+        Write waiting records and stop background thread
+        """
+        if os.getpid() == self.pid and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Call counts and latency histograms of filesystem operations and rule
+evaluation
+"""
+
+import threading
+
+
+class Metrics(object):
+    """
+    Thread-safe collection of operation latencies
+    """
+    # Upper bounds of histogram buckets in seconds
+    buckets = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0, float('inf'))
+
+    def __init__(self):
+        """
+        Initialize empty collection
+        """
+        self.lock = threading.Lock()
+        # operation: [count, total time, max time, [count per bucket]]
+        self.operations = {}
+
+    def record(self, operation, seconds):
+        """
+        Record single call of operation
+
+        :param operation: operation name, eg. stat
+        :param seconds: duration of the call
+        """
+        with self.lock:
+            data = self.operations.get(operation)
+            if data is None:
+                data = self.operations[operation] = [0, 0.0, 0.0,
+                                                     [0] * len(self.buckets)]
+            data[0] += 1
+            data[1] += seconds
+            if seconds > data[2]:
+                data[2] = seconds
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    data[3][index] += 1
+                    break
+
+    def merge(self, operations):
+        """
+        Add metrics collected by another instance, eg. in other process
+
+        :param operations: operations attribute of other instance
+        """
+        with self.lock:
+            for operation, (count, total, maximum, histogram) in operations.iteritems():
+                data = self.operations.get(operation)
+                if data is None:
+                    data = self.operations[operation] = [0, 0.0, 0.0,
+                                                         [0] * len(self.buckets)]
+                data[0] += count
+                data[1] += total
+                data[2] = max(data[2], maximum)
+                data[3] = [hits + other for hits, other in zip(data[3], histogram)]
+
+    def get(self):
+        """
+        Return metrics of all recorded operations
+
+        :return: dict operation: {'count', 'time', 'max', 'histogram'} where
+                 histogram is list of [upper bound, count] pairs
+        """
+        with self.lock:
+            return dict(
+                (operation, {
+                    'count': count,
+                    'time': total,
+                    'max': maximum,
+                    'histogram': [[bound, hits] for bound, hits
+                                  in zip(self.buckets, histogram)],
+                })
+                for operation, (count, total, maximum, histogram)
+                in self.operations.iteritems())
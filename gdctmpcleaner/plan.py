@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Removal plan exported by dry-run and applied without walking the tree
+
+Plan starts with MAGIC and JSON header line with cleaned path and names of
+definitions, followed by length-prefixed records of candidates in the order
+of dry-run, so directories come after their content. Each record contains
+fingerprint of entry (inode, mtime and size), entry is removed by plan only
+if it still matches. Directory is checked only by inode, its mtime changes
+when its content is removed and rmdir fails if something was added.
+"""
+
+import os
+import errno
+import json
+import struct
+import tempfile
+import time
+from datetime import datetime
+
+from gdctmpcleaner import File, UnsupportedFileType, InvalidConfiguration
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+# First line of plan
+MAGIC = 'TMPCLNP1\n'
+# Length of the rest of record, flags, inode, mtime, size, length of path and
+# length of definition name
+RECORD = struct.Struct('<IBQdQHH')
+FLAG_DIRECTORY = 1
+
+
+class PlanWriter(object):
+    """
+    Writes candidates of dry-run, plan is complete only after close()
+    """
+    def __init__(self, path, cleaner):
+        """
+        Start writing plan into temporary file next to path
+
+        :param path: path of plan
+        :param cleaner: TmpCleaner instance in dry-run
+        """
+        if not cleaner.dry:
+            raise InvalidConfiguration('Plan can be written only in dry-run')
+        if cleaner.processes > 1 or cleaner.coordinator or cleaner.checkpoint:
+            raise InvalidConfiguration('Plan can\'t be written with multiple processes, coordinationDir or checkpointFile')
+        self.path = path
+        directory, name = os.path.split(os.path.abspath(path))
+        fd, self.temp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+        self.fh = os.fdopen(fd, 'wb', 1 << 20)
+        self.fh.write(MAGIC)
+        self.fh.write(json.dumps({
+            'path': cleaner.config['path'],
+            'created': time.time(),
+            'definitions': [definition.name
+                            for definition in cleaner.definitions],
+        }) + '\n')
+        self.count = 0
+
+    def add(self, file):
+        """
+        Add candidate
+
+        :param file: instance of File matching definition
+        """
+        path = file.path
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        definition = unicode(file.definition).encode('utf-8')
+        fstat = file.stat
+        self.fh.write(RECORD.pack(
+            RECORD.size - 4 + len(path) + len(definition),
+            FLAG_DIRECTORY if file.directory else 0, fstat.st_ino,
+            fstat.st_mtime, fstat.st_size, len(path), len(definition)) +
+            path + definition)
+        self.count += 1
+
+    def close(self, complete=True):
+        """
+        Finish plan
+
+        :param complete: replace plan file, otherwise drop unfinished plan
+        """
+        self.fh.close()
+        if complete:
+            os.chmod(self.temp, 0o644)
+            os.rename(self.temp, self.path)
+            lg.warn("Plan with %d candidates written to %s", self.count,
+                    self.path)
+        else:
+            os.unlink(self.temp)
+
+
+def read(path):
+    """
+    Read plan
+
+    :param path: path of plan
+    :return: tuple (header dict, generator of (path, directory, inode, mtime,
+             size, definition name))
+    :raises ValueError: if file isn't a plan
+    """
+    fh = open(path, 'rb')
+    if fh.readline() != MAGIC:
+        fh.close()
+        raise ValueError('%s is not a plan' % path)
+    try:
+        header = json.loads(fh.readline())
+    except ValueError:
+        fh.close()
+        raise ValueError('Invalid header of plan %s' % path)
+
+    def records():
+        with fh:
+            while True:
+                prefix = fh.read(4)
+                if not prefix:
+                    return
+                data = prefix
+                if len(prefix) == 4:
+                    data += fh.read(struct.unpack('<I', prefix)[0])
+                if len(data) < RECORD.size:
+                    raise ValueError('Truncated record in %s' % path)
+                (_, flags, inode, mtime, size, path_len,
+                 definition_len) = RECORD.unpack_from(data)
+                if len(data) != RECORD.size + path_len + definition_len:
+                    raise ValueError('Truncated record in %s' % path)
+                names = data[RECORD.size:]
+                yield (names[:path_len], bool(flags & FLAG_DIRECTORY), inode,
+                       mtime, size, names[path_len:].decode('utf-8'))
+    return header, records()
+
+
+def apply(cleaner, path):
+    """
+    Remove candidates of plan which weren't changed since dry-run, each is
+    only stat'ed, definitions aren't evaluated
+
+    :param cleaner: TmpCleaner instance with config used to write the plan
+    :param path: path of plan
+    :return: dict with numbers of removed and failed candidates and
+             candidates skipped because they were changed, removed or
+             directory isn't empty
+    :raises InvalidConfiguration: if plan doesn't belong to config
+    """
+    try:
+        header, records = read(path)
+    except (IOError, ValueError) as exc:
+        raise InvalidConfiguration('Can\'t read plan: %s' % exc)
+    if os.path.normpath(header['path']) != os.path.normpath(cleaner.config['path']):
+        raise InvalidConfiguration('Plan was written for path %s' % header['path'])
+    names = dict((unicode(name), name) for name in cleaner.summary if name is not None)
+    missing = [name for name in header['definitions'] if unicode(name) not in names]
+    if missing:
+        raise InvalidConfiguration('Plan uses definitions missing in config: %s' % ', '.join(unicode(name) for name in missing))
+
+    lg.warn("Applying plan %s created at %s", path,
+            datetime.fromtimestamp(header['created']))
+    counts = {'removed': 0, 'failed': 0, 'skipped': 0}
+    time_start = datetime.now()
+    try:
+        for fname, directory, inode, mtime, size, name in records:
+            try:
+                fstat = cleaner.timed('stat', cleaner.fs.lstat, fname)
+                curr = File(fname, fstat)
+            except UnsupportedFileType:
+                counts['skipped'] += 1
+                continue
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    cleaner.errh(exc)
+                counts['skipped'] += 1
+                continue
+            if curr.directory != directory or fstat.st_ino != inode or (
+                    not directory and (fstat.st_mtime != mtime or
+                                       fstat.st_size != size)):
+                lg.info("Keeping %s, it was changed since plan was written",
+                        fname)
+                counts['skipped'] += 1
+                continue
+
+            curr.definition = names[name]
+            cleaner.log_removal(curr, 'directory' if directory else 'file',
+                                curr.definition)
+            if cleaner.dry:
+                curr.removed = True
+            elif not cleaner.remove(curr):
+                counts['skipped'] += 1
+                continue
+            cleaner.update_summary(curr)
+            counts['failed' if curr.failed else 'removed'] += 1
+    except ValueError as exc:
+        raise InvalidConfiguration('Can\'t read plan: %s' % exc)
+    finally:
+        cleaner.flush_removals()
+        if cleaner.journal:
+            cleaner.journal.flush()
+        cleaner.time_pass = cleaner.time_run = datetime.now() - time_start
+
+    lg.warn("Plan applied: removed={removed} failed={failed} "
+            "skipped={skipped}".format(**counts))
+    return counts
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Limiting of filesystem operations so cleanup doesn't starve other I/O
+
+Throttle spaces operations to given rate and in adaptive mode slows down
+further while measured latency of operations is above threshold. Process can
+also demote its own I/O and CPU scheduling priority.
+"""
+
+import ctypes
+import os
+import platform
+import threading
+import time
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+# ioprio_set syscall numbers
+IOPRIO_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+SCHED_IDLE = 5
+
+
+class Throttle(object):
+    """
+    Thread-safe limiter of operation rate with adaptive backoff
+    """
+    # Bounds of adaptive delay between operations in seconds
+    delay_min = 0.001
+    delay_max = 1.0
+
+    def __init__(self, rate=None, latency=None):
+        """
+        Setup throttle
+
+        :param rate: maximum number of operations per second, None for
+                     unlimited
+        :param latency: latency threshold in seconds for adaptive backoff,
+                        None to disable it
+        """
+        self.interval = 1.0 / rate if rate else 0.0
+        self.latency = latency
+
+        self.lock = threading.Lock()
+        # Earliest time of next operation
+        self.next = 0.0
+        # Adaptive delay between operations and moving average of latency
+        self.delay = 0.0
+        self.average = None
+
+    def acquire(self):
+        """
+        Wait until next operation can be started
+
+        :return: seconds spent waiting
+        :rtype: float
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + max(self.interval, self.delay)
+
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0.0
+
+    def observe(self, latency):
+        """
+        Adapt delay between operations to latency of finished operation
+
+        Delay is doubled while average latency is above threshold and halved
+        when it's below.
+
+        :param latency: duration of operation in seconds
+        """
+        if not self.latency:
+            return
+
+        with self.lock:
+            if self.average is None:
+                self.average = latency
+            else:
+                self.average = 0.8 * self.average + 0.2 * latency
+
+            if self.average > self.latency:
+                self.delay = min(self.delay_max,
+                                 max(self.delay * 2, self.delay_min))
+            elif self.delay > self.delay_min:
+                self.delay /= 2
+            else:
+                self.delay = 0.0
+
+
+def set_ioprio(priority):
+    """
+    Set I/O scheduling priority of calling process, threads started later
+    inherit it
+
+    :param priority: 'idle' or best-effort level 0-7 (7 is the lowest)
+    :return: True if priority was set
+    :rtype: bool
+    """
+    if priority == 'idle':
+        ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    else:
+        ioprio = (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | int(priority)
+
+    syscall = IOPRIO_SYSCALLS.get(platform.machine())
+    if syscall is None:
+        lg.warn("Setting I/O priority is not supported on %s",
+                platform.machine())
+        return False
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        lg.warn("Can't set I/O priority: %s",
+                os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+
+def set_sched_idle():
+    """
+    Set SCHED_IDLE CPU scheduling policy of calling process
+
+    :return: True if policy was set
+    :rtype: bool
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    param = ctypes.c_int(0)
+    if libc.sched_setscheduler(0, SCHED_IDLE, ctypes.byref(param)) != 0:
+        lg.warn("Can't set SCHED_IDLE scheduling policy: %s",
+                os.strerror(ctypes.get_errno()))
+        return False
+    return True
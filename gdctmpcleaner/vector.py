@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Operations on columns of numbers and boolean masks
+
+Columns are NumPy arrays if NumPy is installed, so each operation runs over
+the whole column in C. Otherwise columns are array.array of doubles and
+masks are lists of booleans, operations are then list comprehensions, which
+is still cheaper than evaluating entries one by one.
+"""
+
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional
+    numpy = None
+
+
+def column(values):
+    """
+    Pack numbers into column of doubles
+
+    :param values: iterable of numbers
+    """
+    if numpy is not None:
+        return numpy.fromiter(values, dtype=numpy.float64)
+    return array('d', values)
+
+
+def constant(length, value):
+    """
+    Return column of given length filled with value
+    """
+    if numpy is not None:
+        return numpy.full(length, value, dtype=numpy.float64)
+    return array('d', [value]) * length
+
+
+def fill(length, value):
+    """
+    Return mask of given length filled with boolean value
+    """
+    if numpy is not None:
+        return numpy.full(length, bool(value), dtype=bool)
+    return [bool(value)] * length
+
+
+def at_most(values, limit):
+    """
+    Return mask of values lower or equal to limit
+    """
+    if numpy is not None:
+        return values <= limit
+    return [value <= limit for value in values]
+
+
+def both(first, second):
+    """
+    Return mask of items set in both masks
+    """
+    if numpy is not None:
+        return first & second
+    return [a and b for a, b in izip(first, second)]
+
+
+def negate(mask):
+    """
+    Return inverted mask
+    """
+    if numpy is not None:
+        return ~mask
+    return [not item for item in mask]
+
+
+def shift(values, offset):
+    """
+    Return column with offset added to every value
+    """
+    if numpy is not None:
+        return values + offset
+    return array('d', [value + offset for value in values])
+
+
+def maximum(first, second):
+    """
+    Return column of greater values of two columns
+    """
+    if numpy is not None:
+        return numpy.maximum(first, second)
+    return array('d', map(max, first, second))
+
+
+def minimum(first, second):
+    """
+    Return column of lower values of two columns
+    """
+    if numpy is not None:
+        return numpy.minimum(first, second)
+    return array('d', map(min, first, second))
+
+
+def count(mask):
+    """
+    Return number of items set in mask
+    """
+    if numpy is not None:
+        return int(numpy.count_nonzero(mask))
+    return sum(mask)
+
+
+def total(values, mask):
+    """
+    Return sum of values selected by mask
+    """
+    if numpy is not None:
+        return float(values[mask].sum())
+    return sum(value for value, item in izip(values, mask) if item)
+
+
+def smallest(values):
+    """
+    Return the lowest value of non-empty column
+    """
+    if numpy is not None:
+        return float(values.min())
+    return min(values)
+
+
+def indices(mask):
+    """
+    Return list of indices of items set in mask
+    """
+    if numpy is not None:
+        return numpy.flatnonzero(mask).tolist()
+    return [index for index, item in enumerate(mask) if item]
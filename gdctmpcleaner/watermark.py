@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2007-2014, GoodData(R) Corporation. All rights reserved
+
+"""
+Watermark mode, frees space quickly by removing the oldest files first
+
+Time thresholds of definitions are ignored, every file whose definition
+allows removal is a candidate. Tree is walked in batches, the oldest
+candidates of each batch are kept in bounded heap and removed from the
+oldest until free space and free inodes of filesystem reach the target.
+Walk isn't finished once the target is reached.
+"""
+
+import os
+import heapq
+from datetime import datetime
+
+from gdctmpcleaner import File, UnsupportedFileType, InvalidConfiguration
+
+import logging
+lg = logging.getLogger('tmpcleaner')
+
+
+class Watermark(object):
+    """
+    Removes the oldest candidates of TmpCleaner tree until target is met
+    """
+    def __init__(self, cleaner, free=None, inodes=None, candidates=10000,
+                 batch=None):
+        """
+        Setup target
+
+        :param cleaner: TmpCleaner instance
+        :param free: target percentage of free space
+        :param inodes: target percentage of free inodes
+        :param candidates: maximum number of candidates kept per batch
+        :param batch: number of candidates seen per batch (default ten
+                      times candidates)
+        """
+        if free is None and inodes is None:
+            raise InvalidConfiguration('Target of free space or inodes has to be set')
+        for target in (free, inodes):
+            if target is not None and not 0 < target <= 100:
+                raise InvalidConfiguration('Target has to be percentage, not %s' % target)
+        if candidates < 1:
+            raise InvalidConfiguration('Number of candidates has to be positive, not %s' % candidates)
+        if cleaner.coordinator or cleaner.index or cleaner.checkpoint:
+            raise InvalidConfiguration('Watermark mode can\'t be used with coordinationDir, stateFile or checkpointFile')
+
+        self.cleaner = cleaner
+        self.top = os.path.normpath(cleaner.config['path'])
+        self.free = free
+        self.inodes = inodes
+        self.candidates = candidates
+        self.batch = batch or 10 * candidates
+
+        # Bytes and inodes missing to the target
+        self.missing_bytes = 0
+        self.missing_inodes = 0
+        # Number of finished batches
+        self.batches = 0
+
+    def measure(self):
+        """
+        Check filesystem and compute how much has to be freed
+
+        :return: True if target is met
+        :rtype: bool
+        """
+        st = os.statvfs(self.top)
+        self.missing_bytes = 0
+        self.missing_inodes = 0
+        if self.free is not None:
+            self.missing_bytes = max(0, int(
+                (self.free / 100.0 * st.f_blocks - st.f_bavail) * st.f_frsize))
+        if self.inodes is not None:
+            self.missing_inodes = max(0, int(
+                self.inodes / 100.0 * st.f_files - st.f_favail))
+        lg.info("Missing %d bytes and %d inodes to target",
+                self.missing_bytes, self.missing_inodes)
+        return self.met()
+
+    def met(self):
+        """
+        Check if target is met according to freed files
+
+        :rtype: bool
+        """
+        return self.missing_bytes <= 0 and self.missing_inodes <= 0
+
+    @staticmethod
+    def age(file, definition):
+        """
+        Return time file is aged by, the latest of times filtered by
+        definition or mtime
+
+        :param file: instance of File
+        :param definition: Definition instance
+        :rtype: float
+        """
+        times = [getattr(file, name) for name in ('atime', 'mtime', 'ctime')
+                 if getattr(definition, name)]
+        return max(times) if times else file.mtime
+
+    def run(self):
+        """
+        Remove candidates until target is met or tree is walked
+
+        :return: True if target was met
+        :rtype: bool
+        """
+        cleaner = self.cleaner
+        time_start = datetime.now()
+        if self.measure():
+            lg.warn("Target is already met, nothing to remove")
+            return True
+
+        lg.warn("Passing %s until %d bytes and %d inodes are freed",
+                self.top, self.missing_bytes, self.missing_inodes)
+        # Heap of (-age, path, definition name) of the oldest candidates
+        heap = []
+        seen = 0
+        met = False
+        for root, listing in cleaner.listings(self.top):
+            for name, fstat in listing.files:
+                path = os.path.join(root, name)
+                if fstat is None or cleaner.matcher.unmatched(path):
+                    # Stat is missing only for unmatched files
+                    continue
+                try:
+                    file = File(path, fstat)
+                except UnsupportedFileType:
+                    continue
+                candidates = cleaner.matcher.candidates(file)
+                if not candidates or candidates[0].no_remove:
+                    continue
+
+                definition = candidates[0]
+                item = (-self.age(file, definition), path, definition.name)
+                if len(heap) < self.candidates:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    # Older than the youngest kept candidate
+                    heapq.heapreplace(heap, item)
+                seen += 1
+
+                if seen >= self.batch:
+                    met = self.purge(heap)
+                    heap = []
+                    seen = 0
+                    if met:
+                        break
+            if met:
+                break
+        else:
+            met = self.purge(heap)
+
+        cleaner.time_pass = cleaner.time_run = datetime.now() - time_start
+        if cleaner.journal:
+            cleaner.journal.flush()
+        if met:
+            lg.warn("Target was met after %d batches", self.batches)
+        else:
+            lg.warn("Target wasn't met, no more candidates found")
+        return met
+
+    def purge(self, heap):
+        """
+        Remove candidates of batch from the oldest until target is met
+
+        :param heap: heap of candidates
+        :return: True if target is met
+        :rtype: bool
+        """
+        cleaner = self.cleaner
+        self.batches += 1
+        for _, path, name in sorted(heap, reverse=True):
+            try:
+                file = File(path, cleaner.timed('stat', cleaner.fs.lstat, path))
+            except (UnsupportedFileType, OSError):
+                # File was removed or replaced meanwhile
+                continue
+            file.definition = name
+            cleaner.log_removal(file, 'file', name)
+            if cleaner.dry:
+                file.removed = True
+            elif not cleaner.remove(file):
+                continue
+            cleaner.update_summary(file)
+
+            if file.removed:
+                # Allocated size, hard linked file doesn't free anything
+                if file.stat.st_nlink <= 1:
+                    self.missing_bytes -= file.stat.st_blocks * 512
+                    self.missing_inodes -= 1
+                if self.met():
+                    cleaner.flush_removals()
+                    return True
+
+        cleaner.flush_removals()
+        if not cleaner.dry:
+            # Check real state, other processes could change it meanwhile
+            return self.measure()
+        return False
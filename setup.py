@@ -29,6 +29,8 @@ params = {
         ],
     'scripts': [
         'bin/tmpcleaner.py',
+        'bin/tmpcleaner-benchmark.py',
+        'bin/tmpcleaner-journal.py',
         ],
     'url': 'https://github.com/gooddata/tmpcleaner',
     'download_url': 'https://github.com/gooddata/tmpcleaner',
@@ -42,7 +44,7 @@ params = {
 It passes given structure only once, groups directories/files by given definition, applies different cleanup rules by each group and print final statistics.''',
     'tests_require': ['pytest'],
     'cmdclass': {'test': PyTest},
-    'requires': ['yaml', 'argparse'],
+    'requires': ['yaml', 'argparse', 'scandir'],
     'classifiers': [
         'Development Status:: 5 - Production/Stable',
         'Environment:: Console',
@@ -7,7 +7,33 @@ import posix
 import tempfile
 import os
 import stat
+import time
+import json
+import re
+import shutil
+import multiprocessing
+import threading
+import logging
+import StringIO
 import gdctmpcleaner
+import gdctmpcleaner.benchmark
+import gdctmpcleaner.checkpoint
+import gdctmpcleaner.coordinate
+import gdctmpcleaner.daemon
+import gdctmpcleaner.export
+import gdctmpcleaner.fs
+import gdctmpcleaner.journal
+import gdctmpcleaner.logger.level_handler
+import gdctmpcleaner.logger.queue_handler
+import gdctmpcleaner.plan
+import gdctmpcleaner.throttle
+import gdctmpcleaner.watermark
+
+def _cooperate(config, run_id):
+    """
+    Run one of cooperating instances
+    """
+    gdctmpcleaner.TmpCleaner(config, run_id=run_id).run()
 
 class TestTmpcleaner(unittest.TestCase):
     def setUp(self):
@@ -102,6 +128,79 @@ class TestTmpcleaner(unittest.TestCase):
             gdctmpcleaner.File('%s/1/3' % self.temp)) is False,
             "File %s matched mtime, but it shouldn't" % self.temp)
 
+    def test_matcher(self):
+        """
+        Test tmpcleaner.Matcher gives the same answer as checking
+        definitions one by one
+        """
+        definitions = [
+            gdctmpcleaner.Definition(name='test', pathMatch='.*/test$'),
+            gdctmpcleaner.Definition(name='unnamed-excluded',
+                                     pathExclude='/tmp/keep/.*', mtime=48),
+            gdctmpcleaner.Definition(name='users', pathMatch='/tmp/users/.*',
+                                     pathExclude='/tmp/users/admin(/.*|$)',
+                                     mtime=24),
+            gdctmpcleaner.Definition(name='projects',
+                                     pathMatch='/tmp/(projects|users)/.*',
+                                     noRemove=True),
+            gdctmpcleaner.Definition(name='logs', pathMatch='.*\\.log$',
+                                     atime=1),
+            gdctmpcleaner.Definition(name='all', mtime=1),
+        ]
+        matcher = gdctmpcleaner.Matcher(definitions)
+        self.assertTrue(matcher.combined)
+
+        paths = ['/tmp', '/tmp/test', '/tmp/users/test', '/tmp/users/a/b',
+                 '/tmp/users/admin', '/tmp/users/admin/x.log',
+                 '/tmp/projects/x', '/tmp/projects/x.log', '/tmp/keep/x.log',
+                 '/tmp/keep/test', '/tmp/other', '/tmp/other.log']
+        ages = [0, 2 * 3600, 30 * 3600, 72 * 3600]
+        now = time.time()
+        for path in paths:
+            for age in ages:
+                results = []
+                for match in (matcher.match, matcher.match_sequential):
+                    file_temp = gdctmpcleaner.File(self.temp)
+                    file_temp.path = path
+                    file_temp.atime = file_temp.mtime = now - age
+                    definition = match(file_temp)
+                    results.append((definition.name if definition else None,
+                                    file_temp.definition))
+                self.assertEqual(results[0], results[1],
+                    "Matcher result %s differs from %s for %s aged %s" %
+                                 (results[0], results[1], path, age))
+
+        # Backreferences can't be combined, definitions are checked one by one
+        matcher = gdctmpcleaner.Matcher(
+            [gdctmpcleaner.Definition(pathMatch='/tmp/(a)/\\1')] + definitions)
+        self.assertFalse(matcher.combined)
+
+    def test_matcher_groups(self):
+        """
+        Test many definitions with groups are split into several
+        alternations
+        """
+        definitions = [
+            gdctmpcleaner.Definition(name='p%d' % i,
+                                     pathMatch='/tmp/p%d/(a|b)/(c|d)/.*' % i,
+                                     mtime=1)
+            for i in range(35)]
+        matcher = gdctmpcleaner.Matcher(definitions)
+        self.assertTrue(matcher.combined)
+
+        now = time.time()
+        for i in (0, 20, 34):
+            for path, age, name in (('/tmp/p%d/a/d/x' % i, 2 * 3600, 'p%d' % i),
+                                    ('/tmp/p%d/a/d/x' % i, 0, None),
+                                    ('/tmp/p%d/a/e/x' % i, 2 * 3600, None)):
+                file_temp = gdctmpcleaner.File(self.temp)
+                file_temp.path = path
+                file_temp.mtime = now - age
+                definition = matcher.match(file_temp)
+                self.assertEqual(definition.name if definition else None, name)
+        # 35 expressions with 3 groups each don't fit into one alternation
+        self.assertTrue(len(matcher.cache) > 1)
+
 
 class TestE2E(unittest.TestCase):
     def setUp(self):
@@ -308,6 +407,1618 @@ definitions:
             (cleaner.summary['test-def']['existing']['size'] - 5*1024*1024) <
             abs(1024))
 
+class TestWalk(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure
+        """
+
+        config = '''---
+pidfile: ''
+path: '%s'
+
+definitions:
+    -
+        name: 'test-def'
+        pathMatch: '%s/.*'
+
+'''
+        self.temp = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        for i in range(1, 5):
+            os.mkdir('%s/%s' % (self.temp, i))
+            for f in range(1, 5):
+                with open('%s/%s/%s' % (self.temp, i, f), 'w') as fh:
+                    fh.write(str(f))
+        os.symlink(self.target, os.path.join(self.temp, 'link'))
+
+        self.config = tempfile.mktemp()
+        with open(self.config, 'a') as fh:
+            fh.write(config % (self.temp, self.temp))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        os.unlink(os.path.join(self.temp, 'link'))
+        os.rmdir(self.temp)
+        os.rmdir(self.target)
+        os.unlink(self.config)
+
+    def test_walk(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        cleaner.run()
+
+        # Symlink is skipped, target is left untouched
+        self.assertTrue(os.path.islink(os.path.join(self.temp, 'link')))
+        self.assertTrue(os.path.isdir(self.target))
+
+        self.assertEqual(
+            cleaner.summary['test-def']['removed']['files'], 16)
+        self.assertEqual(
+            cleaner.summary['test-def']['removed']['dirs'], 4)
+
+        # 16 files (isdir), 4 dirs (isdir, islink), symlink (isdir, stat)
+        self.assertEqual(cleaner.syscalls_saved, 16 + 4 * 2 + 2)
+
+    def test_metrics(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        cleaner.run()
+
+        metrics = cleaner.get_metrics()
+        operations = metrics['operations']
+        self.assertEqual(operations['listdir']['count'], 5)
+        self.assertEqual(operations['match']['count'], 16 + 4)
+        self.assertEqual(operations['unlink']['count'], 16)
+        self.assertEqual(operations['rmdir']['count'], 4)
+        for data in operations.values():
+            self.assertEqual(sum(hits for _, hits in data['histogram']),
+                             data['count'])
+        self.assertTrue(metrics['phases']['pass'] > 0)
+        self.assertTrue(metrics['phases']['run'] >= metrics['phases']['pass'])
+        self.assertAlmostEqual(metrics['phases']['remove_busy'],
+                               operations['unlink']['time'] +
+                               operations['rmdir']['time'])
+        # Wall times are parts of pass
+        walled = sum(metrics['phases'][phase]
+                     for phase in ('scan', 'match', 'remove'))
+        self.assertTrue(0 < walled <= metrics['phases']['pass'])
+        self.assertTrue(metrics['phases']['remove'] >=
+                        metrics['phases']['remove_busy'])
+
+    def test_export(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        output = tempfile.mkdtemp()
+        json_path = os.path.join(output, 'metrics.json')
+        prometheus_path = os.path.join(output, 'tmpcleaner.prom')
+        exporter = gdctmpcleaner.export.Exporter(
+            cleaner, json_path=json_path, prometheus_path=prometheus_path)
+        exporter.start()
+        cleaner.run()
+        exporter.stop()
+
+        with open(json_path) as fh:
+            data = json.load(fh)
+        with open(prometheus_path) as fh:
+            lines = fh.read().splitlines()
+        for path in (json_path, prometheus_path):
+            os.unlink(path)
+        os.rmdir(output)
+
+        self.assertTrue(data['final'])
+        self.assertEqual(data['definitions']['test-def']['removed']['files'], 16)
+        self.assertEqual(data['entries'], 20)
+        self.assertEqual(data['operations']['unlink']['count'], 16)
+        self.assertTrue(data['entries_per_second'] > 0)
+        self.assertTrue(
+            'tmpcleaner_entries{path="%s",definition="test-def",'
+            'status="removed",type="files"} 16.0' % self.temp in lines)
+        self.assertTrue(
+            'tmpcleaner_running{path="%s"} 0.0' % self.temp in lines)
+        self.assertTrue('# TYPE tmpcleaner_operations_total counter' in lines)
+        self.assertTrue(
+            'tmpcleaner_operations_total{path="%s",operation="unlink"} 16.0'
+            % self.temp in lines)
+
+    def test_throttle(self):
+        with open(self.config, 'a') as fh:
+            fh.write('maxUnlinks: 200\n')
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        cleaner.run()
+
+        self.assertEqual(
+            cleaner.summary['test-def']['removed']['files'], 16)
+        # 20 removals spaced by 5 ms, waiting is shortened by time spent
+        # between removals
+        phases = cleaner.get_metrics()['phases']
+        self.assertTrue(phases['throttle_remove'] > 0)
+        self.assertTrue(phases['pass'] >= 0.09)
+        self.assertEqual(phases['throttle_scan'], 0)
+
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare two identical testing directory structures
+        """
+
+        config = '''---
+pidfile: ''
+path: '%s'
+
+definitions:
+    -
+        name: 'test-def'
+        pathMatch: '%s/[0-9]+/.*'
+        mtime: 1
+    -
+        name: 'top'
+        pathMatch: '%s/.*'
+        noRemove: true
+
+'''
+        self.temps = []
+        self.configs = []
+        for _ in range(2):
+            temp = tempfile.mkdtemp()
+            for i in range(1, 10):
+                for j in range(1, 5):
+                    os.makedirs('%s/%s/%s' % (temp, i, j))
+                    for f in range(1, 5):
+                        path = '%s/%s/%s/%s' % (temp, i, j, f)
+                        with open(path, 'w') as fh:
+                            fh.write(str(f))
+                        if (i + f) % 3 == 0:
+                            self._age(path, 2)
+                    if i % 2:
+                        self._age('%s/%s/%s' % (temp, i, j), 2)
+                os.mkdir('%s/%s/empty' % (temp, i))
+                self._age('%s/%s/empty' % (temp, i), 2)
+            os.mkdir('%s/empty' % temp)
+            self._age('%s/empty' % temp, 2)
+
+            config_file = tempfile.mktemp()
+            with open(config_file, 'a') as fh:
+                fh.write(config % (temp, temp, temp))
+
+            self.temps.append(temp)
+            self.configs.append(config_file)
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structures
+        """
+        for temp in self.temps:
+            for root, dirs, files in os.walk(temp, topdown=False):
+                for f in files:
+                    os.unlink(os.path.join(root, f))
+
+                for d in dirs:
+                    os.rmdir(os.path.join(root, d))
+            os.rmdir(temp)
+
+        for config_file in self.configs:
+            os.unlink(config_file)
+
+    def _age(self, path, days):
+        """
+        Change file(dir)'s mtime to past
+        """
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime - 24*3600*days))
+
+    def test_workers(self):
+        sequential = gdctmpcleaner.TmpCleaner(self.configs[0])
+        sequential.run()
+        parallel = gdctmpcleaner.TmpCleaner(self.configs[1], workers=4)
+        parallel.run()
+
+        self.assertEqual(sequential.get_summary(), parallel.get_summary())
+        self.assertEqual(sequential.syscalls_saved, parallel.syscalls_saved)
+        self.assertTrue(sequential.summary['test-def']['removed']['files'] > 0)
+        self.assertEqual(sequential.summary['test-def']['removed']['dirs'], 9)
+        self.assertEqual(sorted(os.listdir(self.temps[0])),
+                         sorted(os.listdir(self.temps[1])))
+        self.assertTrue(os.path.exists(os.path.join(self.temps[1], 'empty')))
+
+    def test_remove_workers(self):
+        inline = gdctmpcleaner.TmpCleaner(self.configs[0])
+        inline.run()
+        pipelined = gdctmpcleaner.TmpCleaner(self.configs[1], workers=4,
+                                             remove_workers=3)
+        pipelined.run()
+
+        self.assertEqual(inline.get_summary(), pipelined.get_summary())
+        self.assertEqual(sorted(os.listdir(self.temps[0])),
+                         sorted(os.listdir(self.temps[1])))
+        self.assertFalse(pipelined.pending)
+        self.assertTrue(pipelined.time_remove.total_seconds() > 0)
+
+    def test_processes(self):
+        sequential = gdctmpcleaner.TmpCleaner(self.configs[0])
+        sequential.run()
+        sharded = gdctmpcleaner.TmpCleaner(self.configs[1], workers=2,
+                                           processes=3)
+        sharded.run()
+
+        self.assertEqual(sequential.get_summary(), sharded.get_summary())
+        self.assertEqual(sequential.syscalls_saved, sharded.syscalls_saved)
+        self.assertEqual(sorted(os.listdir(self.temps[0])),
+                         sorted(os.listdir(self.temps[1])))
+        self.assertTrue(os.path.exists(os.path.join(self.temps[1], 'empty')))
+        # Operations of shards are merged
+        operations = sharded.get_metrics()['operations']
+        expected = sequential.get_metrics()['operations']
+        for operation in ('unlink', 'listdir'):
+            self.assertEqual(operations[operation]['count'],
+                             expected[operation]['count'])
+        # Pre-scan of shards is recorded separately
+        self.assertEqual(operations['prescan']['count'], 10)
+
+    def test_cooperative(self):
+        coordination = tempfile.mkdtemp()
+        with open(self.configs[1], 'a') as fh:
+            fh.write("coordinationDir: '%s'\nleaseTime: 2\n" % coordination)
+        sequential = gdctmpcleaner.TmpCleaner(self.configs[0])
+        sequential.run()
+
+        # Lease left by crashed instance
+        run = os.path.join(coordination, 'test')
+        crashed = gdctmpcleaner.coordinate.Coordinator(run, 2)
+        self.assertTrue(crashed.claim(os.path.join(self.temps[1], '1')))
+        crashed.close()
+        lease = crashed.leases.values()[0]
+        os.utime(lease, (time.time() - 10, time.time() - 10))
+
+        instances = [multiprocessing.Process(target=_cooperate,
+                                             args=(self.configs[1], 'test'))
+                     for _ in range(3)]
+        for instance in instances:
+            instance.start()
+        for instance in instances:
+            instance.join()
+        merged = gdctmpcleaner.coordinate.merge_summaries(run)
+        shutil.rmtree(coordination)
+
+        self.assertEqual([instance.exitcode for instance in instances], [0] * 3)
+        self.assertEqual(merged['instances'], 3)
+        expected = gdctmpcleaner.export.Exporter(sequential).collect(final=True)
+        self.assertEqual(merged['definitions'], expected['definitions'])
+        self.assertEqual(merged['syscalls_saved'], expected['syscalls_saved'])
+        self.assertEqual(sorted(os.listdir(self.temps[0])),
+                         sorted(os.listdir(self.temps[1])))
+
+    def test_taken_over(self):
+        run = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, run)
+        path = os.path.join(self.temps[1], '1')
+        slow = gdctmpcleaner.coordinate.Coordinator(run, 2)
+        slow.owner = 'slow'
+        self.assertTrue(slow.claim(path))
+        slow.close()
+        lease = slow.leases[path]
+        os.utime(lease, (time.time() - 10, time.time() - 10))
+        other = gdctmpcleaner.coordinate.Coordinator(run, 2)
+        self.assertTrue(other.claim(path))
+        # Slow owner doesn't finish subtree of new owner
+        self.assertFalse(slow.release(path, 1))
+        self.assertFalse(other.finished(path))
+        self.assertTrue(other.release(path, 2))
+        other.close()
+        self.assertEqual(other.remaining(path), 2)
+
+
+class TestPrune(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure
+        """
+
+        config = '''---
+pidfile: ''
+path: '%s'
+pathIgnore: '.*/\\.snapshot$'
+pruneUnmatched: true
+
+definitions:
+    -
+        name: 'users'
+        pathMatch: '%s/users/.*'
+
+'''
+        self.temp = tempfile.mkdtemp()
+        for d in ('users', 'users/.snapshot', 'other', 'other/sub'):
+            os.mkdir('%s/%s' % (self.temp, d))
+            for f in range(1, 5):
+                with open('%s/%s/%s' % (self.temp, d, f), 'w') as fh:
+                    fh.write(str(f))
+
+        self.config = tempfile.mktemp()
+        with open(self.config, 'a') as fh:
+            fh.write(config % (self.temp, self.temp))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        for root, dirs, files in os.walk(self.temp, topdown=False):
+            for f in files:
+                os.unlink(os.path.join(root, f))
+
+            for d in dirs:
+                os.rmdir(os.path.join(root, d))
+        os.rmdir(self.temp)
+
+        os.unlink(self.config)
+
+    def test_prune(self):
+        for workers in (1, 4):
+            cleaner = gdctmpcleaner.TmpCleaner(self.config, dry=True,
+                                               workers=workers,
+                                               prune_report=True)
+            cleaner.run()
+
+            self.assertEqual(sorted(cleaner.pruned), [
+                (os.path.join(self.temp, 'other'), 'unmatched'),
+                (os.path.join(self.temp, 'users', '.snapshot'), 'pathIgnore'),
+            ])
+            self.assertEqual(cleaner.pruned_dirs, 2)
+            self.assertEqual(
+                cleaner.summary['users']['removed']['files'], 4)
+            self.assertEqual(
+                cleaner.summary[None]['existing']['files'], 0)
+
+        # Definition without literal prefix disables pruning of unmatched
+        # directories
+        with open(self.config, 'a') as fh:
+            fh.write('''    -
+        name: 'test'
+        pathMatch: '.*/test$'
+''')
+        cleaner = gdctmpcleaner.TmpCleaner(self.config, dry=True)
+        self.assertTrue(cleaner.prefixes is None)
+        cleaner.run()
+        self.assertEqual(cleaner.pruned_dirs, 1)
+        self.assertEqual(cleaner.summary[None]['existing']['files'], 8)
+
+class PeakCleaner(gdctmpcleaner.TmpCleaner):
+    """
+    TmpCleaner recording peak number of directory records
+    """
+    peak = 0
+
+    def match_delete(self, file):
+        self.peak = max(self.peak, len(self.st))
+        return super(PeakCleaner, self).match_delete(file)
+
+
+def _peak_rss(function):
+    """
+    Return peak RSS in kB of child process running function
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            function()
+            status = 0
+        finally:
+            os._exit(status)
+    _, status, usage = os.wait4(pid, 0)
+    assert status == 0, "Child process failed"
+    return usage.ru_maxrss
+
+
+class TestBookkeeping(unittest.TestCase):
+    depth = 3
+    fanout = 6
+
+    def setUp(self):
+        """
+        Prepare testing directory structure
+        """
+        self.temps = []
+        self.configs = []
+        self.temp, self.config, self.entries = self._tree(10)
+
+    def _tree(self, files):
+        """
+        Create tree of self.depth levels of self.fanout directories with
+        given number of files in each leaf directory
+
+        :return: tuple (path, config file, number of entries)
+        """
+        config = '''---
+pidfile: ''
+path: '%s'
+
+definitions:
+    -
+        name: 'test-def'
+        pathMatch: '%s/.*'
+        mtime: 1
+
+'''
+        temp = tempfile.mkdtemp()
+        entries = 0
+        dirs = [temp]
+        for level in range(self.depth):
+            children = []
+            for parent in dirs:
+                for i in range(self.fanout):
+                    path = os.path.join(parent, str(i))
+                    os.mkdir(path)
+                    children.append(path)
+            dirs = children
+            entries += len(dirs)
+        for parent in dirs:
+            for f in range(files):
+                with open(os.path.join(parent, str(f)), 'w') as fh:
+                    fh.write(str(f))
+                entries += 1
+
+        config_file = tempfile.mktemp()
+        with open(config_file, 'a') as fh:
+            fh.write(config % (temp, temp))
+
+        self.temps.append(temp)
+        self.configs.append(config_file)
+        return temp, config_file, entries
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structures
+        """
+        for temp in self.temps:
+            for root, dirs, files in os.walk(temp, topdown=False):
+                for f in files:
+                    os.unlink(os.path.join(root, f))
+
+                for d in dirs:
+                    os.rmdir(os.path.join(root, d))
+            os.rmdir(temp)
+
+        for config_file in self.configs:
+            os.unlink(config_file)
+
+    def test_peak(self):
+        for workers in (1, 4):
+            cleaner = PeakCleaner(self.config, dry=True, workers=workers)
+            cleaner.run()
+
+            self.assertEqual(
+                cleaner.summary['test-def']['existing']['files'], 10 * 6 ** 3)
+            # Parallel walk lists up to 2 * workers directories ahead
+            limit = (self.depth + 1) * self.fanout + 2 * (workers - 1)
+            self.assertTrue(cleaner.peak <= limit,
+                "Peak of %s directory records for %s entries" %
+                            (cleaner.peak, self.entries))
+            self.assertFalse(cleaner.st)
+
+    def test_memory(self):
+        """
+        Peak memory doesn't grow with number of entries when depth and
+        fanout are the same
+        """
+        _, large, entries = self._tree(100)
+        for workers in (1, 4):
+            def run(config):
+                gdctmpcleaner.TmpCleaner(config, dry=True, workers=workers).run()
+            small_rss = _peak_rss(lambda: run(self.config))
+            large_rss = _peak_rss(lambda: run(large))
+            # Keeping File or stat of every entry would take more than 5 MB
+            self.assertTrue(large_rss - small_rss < 2048,
+                "Peak RSS grew from %s kB to %s kB for %s instead of %s entries" %
+                            (small_rss, large_rss, entries, self.entries))
+
+    def test_compact(self):
+        """
+        File has no per-instance dict and files matching no definition are
+        counted without File
+        """
+        file_object = gdctmpcleaner.File(self.temp)
+        self.assertFalse(hasattr(file_object, '__dict__'))
+        self.assertEqual(file_object.mtime, file_object.stat.st_mtime)
+
+        config = {
+            'pidfile': '',
+            'path': self.temp,
+            'definitions': [{'name': 'logs', 'pathMatch': '.*\\.log$'}],
+        }
+        cleaner = PeakCleaner(config, dry=True)
+        cleaner.run()
+        self.assertEqual(cleaner.summary[None]['existing']['files'], 10 * 6 ** 3)
+        self.assertTrue(cleaner.summary[None]['existing']['size'] > 0)
+        # No File was created for matching
+        self.assertEqual(cleaner.peak, 0)
+
+    def test_statistics(self):
+        """
+        Files matching no definition by path aren't stat'ed in minimal
+        statistics
+        """
+        cleaners = {}
+        for statistics in ('full', 'minimal'):
+            config = {
+                'pidfile': '',
+                'path': self.temp,
+                'statistics': statistics,
+                'definitions': [{'name': 'half', 'pathMatch': '.*/[0-4]$',
+                                 'mtime': 1}],
+            }
+            cleaners[statistics] = gdctmpcleaner.TmpCleaner(config, dry=True)
+            cleaners[statistics].run()
+        full, minimal = cleaners['full'], cleaners['minimal']
+
+        unmatched = 5 * 6 ** 3
+        self.assertEqual(full.stats_skipped, 0)
+        self.assertEqual(minimal.stats_skipped, unmatched)
+        self.assertEqual(minimal.get_metrics()['operations']['stat']['count'],
+                         full.get_metrics()['operations']['stat']['count'] - unmatched)
+        self.assertEqual(minimal.summary['half'], full.summary['half'])
+        self.assertEqual(minimal.summary[None]['existing']['files'], unmatched)
+        self.assertEqual(minimal.summary[None]['existing']['size'], 0)
+        self.assertTrue(full.summary[None]['existing']['size'] > 0)
+
+        # Matched files are stat'ed by listing threads
+        threads = set()
+
+        class RecordingFilesystem(gdctmpcleaner.fs.Filesystem):
+            def lstat(self, path):
+                threads.add(threading.current_thread().name)
+                return gdctmpcleaner.fs.Filesystem.lstat(self, path)
+        cleaner = gdctmpcleaner.TmpCleaner(dict(config, workers=2), dry=True,
+                                           filesystem=RecordingFilesystem())
+        cleaner.run()
+        self.assertEqual(cleaner.summary['half'], full.summary['half'])
+        self.assertEqual(cleaner.stats_skipped, unmatched)
+        self.assertTrue(threads)
+        self.assertFalse(threading.current_thread().name in threads)
+
+        config['statistics'] = 'none'
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration,
+                          gdctmpcleaner.TmpCleaner, config)
+
+class IndexCleaner(gdctmpcleaner.TmpCleaner):
+    """
+    TmpCleaner recording directories taken from index
+    """
+    def _scan(self, top):
+        listing = super(IndexCleaner, self)._scan(top)
+        if listing and listing.counts is not None:
+            self.cached.append(top)
+        return listing
+
+    cached = None
+
+    def run(self):
+        self.cached = []
+        super(IndexCleaner, self).run()
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure
+        """
+
+        self.config_fmt = '''---
+pidfile: ''
+path: '%s'
+stateFile: '%s'
+
+definitions:
+    -
+        name: 'test-def'
+        pathMatch: '%s/.*'
+        mtime: %s
+
+'''
+        self.temp = tempfile.mkdtemp()
+        for i in range(1, 5):
+            os.mkdir('%s/%s' % (self.temp, i))
+            for f in range(1, 5):
+                with open('%s/%s/%s' % (self.temp, i, f), 'w') as fh:
+                    fh.write(str(f))
+        self.old = os.path.join(self.temp, '4', '1')
+        self._age(self.old, 2)
+        for i in range(1, 5):
+            self._age('%s/%s' % (self.temp, i), 1)
+        self._age(self.temp, 1)
+
+        self.state = tempfile.mktemp()
+        self.config = tempfile.mktemp()
+        self._config(72)
+
+    def _config(self, mtime):
+        with open(self.config, 'w') as fh:
+            fh.write(self.config_fmt % (self.temp, self.state, self.temp, mtime))
+
+    def _age(self, path, days):
+        """
+        Change file(dir)'s mtime to past
+        """
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime - 24*3600*days))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        for root, dirs, files in os.walk(self.temp, topdown=False):
+            for f in files:
+                os.unlink(os.path.join(root, f))
+
+            for d in dirs:
+                os.rmdir(os.path.join(root, d))
+        os.rmdir(self.temp)
+
+        os.unlink(self.config)
+        os.unlink(self.state)
+
+    def test_index(self):
+        first = IndexCleaner(self.config)
+        first.run()
+        self.assertEqual(first.cached, [])
+
+        # Unchanged directories are taken from index with their statistics
+        second = IndexCleaner(self.config)
+        second.run()
+        self.assertEqual(sorted(second.cached), sorted(
+            [self.temp] + ['%s/%s' % (self.temp, i) for i in range(1, 5)]))
+        self.assertEqual(first.get_summary(), second.get_summary())
+        self.assertEqual(
+            second.summary['test-def']['existing']['files'], 16)
+
+        # Changed directory is listed again
+        with open('%s/2/new' % self.temp, 'w') as fh:
+            fh.write('new')
+        third = IndexCleaner(self.config)
+        third.run()
+        self.assertFalse('%s/2' % self.temp in third.cached)
+        self.assertEqual(
+            third.summary['test-def']['existing']['files'], 17)
+
+        # Index is invalidated by change of definitions, old file is removed
+        self._config(24)
+        fourth = IndexCleaner(self.config)
+        fourth.run()
+        self.assertEqual(fourth.cached, [])
+        self.assertFalse(os.path.exists(self.old))
+        self.assertEqual(
+            fourth.summary['test-def']['removed']['files'], 1)
+
+class TestThrottle(unittest.TestCase):
+    def test_rate(self):
+        throttle = gdctmpcleaner.throttle.Throttle(rate=100)
+        time_start = time.time()
+        waited = sum(throttle.acquire() for _ in range(21))
+        self.assertTrue(time.time() - time_start >= 0.19)
+        # Oversleeping shortens following waits
+        self.assertTrue(waited > 0)
+
+    def test_adaptive(self):
+        throttle = gdctmpcleaner.throttle.Throttle(latency=0.01)
+        for _ in range(5):
+            throttle.observe(0.1)
+        self.assertTrue(throttle.delay > throttle.delay_min)
+        for _ in range(50):
+            throttle.observe(0.001)
+        self.assertEqual(throttle.delay, 0.0)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        spec = gdctmpcleaner.benchmark.Spec(
+            depth=2, fanout=3, files=10, ages=[(1, 1), (48, 1)],
+            rules=[{'name': 'logs', 'share': 0.4, 'mtime': 24},
+                   {'name': 'keep', 'share': 0.2, 'noRemove': True}])
+        results = gdctmpcleaner.benchmark.benchmark(spec)
+        dry, real = results['results']
+
+        self.assertTrue(dry['dry'])
+        self.assertFalse(real['dry'])
+        for result in (dry, real):
+            self.assertEqual(result['dirs'], 3 + 9)
+            self.assertEqual(result['files'], 120)
+            self.assertEqual(sum(result['rules'].values()), 120)
+            self.assertTrue(result['entries_per_second'] > 0)
+            self.assertTrue(result['syscalls_per_entry'] >= 1)
+            self.assertTrue(result['peak_rss_kb'] > 0)
+        # Trees are generated from the same seed
+        self.assertEqual(dry['summary']['logs'], real['summary']['logs'])
+        removed = real['summary']['logs']['removed']['files']
+        self.assertTrue(0 < removed < real['rules']['logs'])
+        self.assertEqual(real['operations']['unlink']['count'], removed)
+        self.assertEqual(json.loads(json.dumps(results)), results)
+
+    def test_definitions(self):
+        # Metacharacters of root don't change matched files
+        spec = gdctmpcleaner.benchmark.Spec(rules=[{'name': 'logs', 'share': 1}])
+        regex = re.compile(spec.definitions('/tmp/bench.a+b')[0]['pathMatch'])
+        self.assertTrue(regex.match('/tmp/bench.a+b/1/x.logs'))
+        self.assertFalse(regex.match('/tmp/benchXaab/1/x.logs'))
+
+
+class TestFilesystem(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure
+        """
+
+        self.config = {
+            'pidfile': '',
+            'definitions': [{'name': 'test-def', 'mtime': 1}],
+        }
+        self.temp = tempfile.mkdtemp()
+        self.config['path'] = self.temp
+        for i in range(1, 4):
+            os.mkdir('%s/%s' % (self.temp, i))
+            for f in range(1, 5):
+                path = '%s/%s/%s' % (self.temp, i, f)
+                with open(path, 'w') as fh:
+                    fh.write(str(f))
+                st = os.stat(path)
+                os.utime(path, (st.st_atime, st.st_mtime - 2 * 3600))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        for root, dirs, files in os.walk(self.temp, topdown=False):
+            for f in files:
+                os.unlink(os.path.join(root, f))
+
+            for d in dirs:
+                os.rmdir(os.path.join(root, d))
+        os.rmdir(self.temp)
+
+    def _run(self, **options):
+        config = dict(self.config, filesystem=dict(backend='faulty', **options))
+        cleaner = gdctmpcleaner.TmpCleaner(config)
+        cleaner.run()
+        return cleaner
+
+    def test_latency(self):
+        cleaner = self._run(latency={'lstat': 0.002}, jitter=0.001)
+        operations = cleaner.get_metrics()['operations']
+        # Files are lstat'ed when listed, emptied directories stat'ed
+        self.assertEqual(operations['stat']['count'], 12 + 3)
+        self.assertTrue(operations['stat']['time'] >= 12 * 0.002)
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 12)
+
+    def test_errors(self):
+        # Permission denied is counted as failed
+        cleaner = self._run(errors={'unlink': {'EACCES': 1}})
+        self.assertEqual(cleaner.summary['test-def']['failed']['files'], 12)
+        self.assertEqual(len(os.listdir('%s/1' % self.temp)), 4)
+        # Vanished files are neither removed nor counted
+        cleaner = self._run(errors={'unlink': {'ENOENT': 1}})
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 0)
+        self.assertEqual(cleaner.summary['test-def']['failed']['files'], 0)
+        # Listing errors are logged and directory is skipped
+        cleaner = self._run(errors={'scandir': {'EIO': 1}})
+        self.assertEqual(cleaner.summary['test-def']['existing']['dirs'], 0)
+        # Other removal errors stop cleanup
+        self.assertRaises(OSError, self._run, errors={'unlink': {'EIO': 1}})
+
+    def test_dirfd(self):
+        for i in range(1, 4):
+            os.makedirs('%s/%s/a/b/c' % (self.temp, i))
+            with open('%s/%s/a/b/c/1' % (self.temp, i), 'w') as fh:
+                fh.write('1')
+        fds = len(os.listdir('/proc/self/fd'))
+        config = dict(self.config, filesystem={'backend': 'dirfd', 'maxOpen': 2})
+        cleaner = gdctmpcleaner.TmpCleaner(config)
+        cleaner.walk_tree(self.temp)
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 12)
+        self.assertEqual(os.listdir('%s/1/a/b/c' % self.temp), ['1'])
+        # Descriptors are closed after walk
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_dirfd_moved(self):
+        # Directory replaced by symlink after it was opened, entries of the
+        # open directory are removed
+        fs = gdctmpcleaner.fs.DirFilesystem(maxOpen=2)
+        fs.scandir('%s/1' % self.temp)
+        os.rename('%s/1' % self.temp, '%s/moved' % self.temp)
+        os.symlink('%s/2' % self.temp, '%s/1' % self.temp)
+        fs.unlink('%s/1/1' % self.temp)
+        self.assertEqual(sorted(os.listdir('%s/moved' % self.temp)), ['2', '3', '4'])
+        self.assertEqual(len(os.listdir('%s/2' % self.temp)), 4)
+        # Symlink isn't entered when opened relative to parent
+        fs.scandir(self.temp)
+        fs.close()
+        fs.scandir(self.temp)
+        self.assertRaises(OSError, fs.scandir, '%s/1' % self.temp)
+        fs.close()
+        os.unlink('%s/1' % self.temp)
+        self.assertRaises(ValueError, gdctmpcleaner.fs.DirFilesystem, maxOpen=0)
+
+    def test_dirfd_evicted(self):
+        # Parent closed by LRU is opened again relative to its parent, so
+        # directory replaced by symlink meanwhile isn't entered
+        fs = gdctmpcleaner.fs.DirFilesystem(maxOpen=1)
+        fs.set_top(self.temp)
+        fs.lstat('%s/1/1' % self.temp)
+        fs.lstat('%s/2/1' % self.temp)
+        self.assertFalse('%s/1' % self.temp in fs.fds)
+        os.rename('%s/1' % self.temp, '%s/moved' % self.temp)
+        os.symlink('%s/2' % self.temp, '%s/1' % self.temp)
+        self.assertRaises(OSError, fs.lstat, '%s/1/1' % self.temp)
+        self.assertRaises(OSError, fs.unlink, '%s/1/1' % self.temp)
+        self.assertEqual(len(os.listdir('%s/2' % self.temp)), 4)
+        fs.close()
+        os.unlink('%s/1' % self.temp)
+
+    def test_invalid(self):
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration, self._run,
+                          errors={'unlink': {'EBADF': 1}})
+        config = dict(self.config, filesystem={'backend': 'nfs'})
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration,
+                          gdctmpcleaner.TmpCleaner, config)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure
+        """
+        self.temp = tempfile.mkdtemp()
+        self.checkpoint = tempfile.mktemp()
+        self.config = {
+            'pidfile': '',
+            'path': self.temp,
+            'checkpointFile': self.checkpoint,
+            'definitions': [{'name': 'test-def', 'mtime': 1}],
+        }
+        for i in range(1, 4):
+            os.mkdir('%s/%s' % (self.temp, i))
+            for f in range(1, 5):
+                path = '%s/%s/%s' % (self.temp, i, f)
+                with open(path, 'w') as fh:
+                    fh.write(str(f))
+                st = os.stat(path)
+                os.utime(path, (st.st_atime, st.st_mtime - 2 * 3600))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        shutil.rmtree(self.temp)
+        for path in (self.checkpoint, self.checkpoint + '.dry'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_resume(self):
+        # Budget runs out after every directory
+        runs = 0
+        while True:
+            cleaner = gdctmpcleaner.TmpCleaner(self.config, max_runtime=1e-9)
+            cleaner.run()
+            runs += 1
+            if not os.path.exists(self.checkpoint):
+                break
+            self.assertEqual(cleaner.interrupted,
+                             os.path.join(self.temp, str(runs)))
+            # Finished directories are emptied, but they are evaluated
+            # only with their parent
+            for i in range(1, 4):
+                self.assertEqual(len(os.listdir(os.path.join(self.temp, str(i)))),
+                                 0 if i <= runs else 4)
+
+        self.assertEqual(runs, 4)
+        self.assertEqual(cleaner.interrupted, None)
+        # The last run reports statistics of the whole sweep and evaluates
+        # directories emptied by previous runs, they were just modified
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 12)
+        self.assertEqual(cleaner.summary[None]['existing']['dirs'], 3)
+
+    def test_finished(self):
+        checkpoint = gdctmpcleaner.checkpoint.Checkpoint(
+            self.checkpoint, '/tmp', [])
+        checkpoint.cursor = ('b', 'c')
+        for path, finished in (('/tmp/a', True), ('/tmp/b', False),
+                               ('/tmp/b/a', True), ('/tmp/b/c', True),
+                               ('/tmp/b/c/a', True), ('/tmp/b/d', False),
+                               ('/tmp/c', False)):
+            self.assertEqual(checkpoint.finished(path), finished, path)
+
+    def test_dry(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config, dry=True,
+                                           max_runtime=1e-9)
+        cleaner.run()
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertTrue(os.path.exists(self.checkpoint + '.dry'))
+        # Walk without budget finishes the sweep
+        gdctmpcleaner.TmpCleaner(self.config, dry=True).run()
+        self.assertFalse(os.path.exists(self.checkpoint + '.dry'))
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure, files expire in two seconds
+        """
+        self.temp = tempfile.mkdtemp()
+        self.config = {
+            'pidfile': '',
+            'path': self.temp,
+            'definitions': [{'name': 'test-def', 'mtime': 1}],
+        }
+        for i in range(1, 4):
+            os.mkdir('%s/%s' % (self.temp, i))
+            for f in range(1, 3):
+                self._create('%s/%s/%s' % (self.temp, i, f), 3600 - 2)
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        shutil.rmtree(self.temp)
+
+    @staticmethod
+    def _create(path, age):
+        with open(path, 'w') as fh:
+            fh.write('x')
+        now = time.time()
+        os.utime(path, (now, now - age))
+
+    def _start(self, **config):
+        cleaner = gdctmpcleaner.TmpCleaner(dict(self.config, **config))
+        daemon = gdctmpcleaner.daemon.Daemon(cleaner)
+        daemon.tick = 0.1
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(daemon.stop)
+        return cleaner, daemon
+
+    def _wait(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < deadline, "Timed out")
+            time.sleep(0.05)
+
+    def _files(self):
+        return sum(len(files) for _, _, files in os.walk(self.temp))
+
+    def test_daemon(self):
+        cleaner, daemon = self._start()
+        self._wait(lambda: daemon.watches)
+        # Files are kept by initial pass and removed once they expire
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 0)
+        self._wait(lambda: self._files() == 0)
+        self.assertEqual(len(daemon.watches), 4)
+
+        # Old file and directory created after initial pass
+        self._create('%s/1/new' % self.temp, 2 * 3600)
+        os.mkdir('%s/4' % self.temp)
+        self._create('%s/4/new' % self.temp, 2 * 3600)
+        self._wait(lambda: self._files() == 0)
+        self._wait(lambda: len(daemon.watches) == 5)
+
+        # Directory removed by other process isn't watched anymore
+        os.rmdir('%s/4' % self.temp)
+        self._wait(lambda: len(daemon.watches) == 4)
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 8)
+
+    def test_directories(self):
+        os.mkdir('%s/kept' % self.temp)
+        self._create('%s/kept/new' % self.temp, 0)
+        cleaner, daemon = self._start()
+        self._wait(lambda: len(daemon.watches) == 5)
+
+        # Old empty directory moved into tree after initial pass
+        outside = tempfile.mkdtemp(dir=os.path.dirname(self.temp))
+        os.mkdir('%s/old' % outside)
+        os.utime('%s/old' % outside, (time.time(), time.time() - 2 * 3600))
+        os.rename('%s/old' % outside, '%s/1/old' % self.temp)
+        os.rmdir(outside)
+        self._wait(lambda: not os.path.exists('%s/1/old' % self.temp))
+
+        # Directory emptied by other process is tracked by its expiry
+        self.assertFalse('%s/kept' % self.temp in daemon.expiry)
+        os.unlink('%s/kept/new' % self.temp)
+        self._wait(lambda: '%s/kept' % self.temp in daemon.expiry)
+
+    def test_rescan(self):
+        cleaner, daemon = self._start(maxWatches=1, rescanInterval=0.2)
+        self._wait(lambda: daemon.rescan is not None)
+        self.assertEqual(len(daemon.watches), 1)
+        unwatched = [path for path in ('%s/%s' % (self.temp, i) for i in range(1, 4))
+                     if path not in daemon.watches][0]
+        self._create('%s/new' % unwatched, 2 * 3600)
+        # File in unwatched directory is removed by next pass
+        self._wait(lambda: not os.path.exists('%s/new' % unwatched))
+
+    def test_invalid(self):
+        cleaner = gdctmpcleaner.TmpCleaner(dict(self.config, maxRuntime=10))
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration,
+                          gdctmpcleaner.daemon.Daemon, cleaner)
+
+
+class CountedWatermark(gdctmpcleaner.watermark.Watermark):
+    """
+    Watermark missing given number of inodes instead of filesystem state
+    """
+    needed = 3
+
+    def measure(self):
+        removed = sum(statuses['removed']['files']
+                      for statuses in self.cleaner.summary.values())
+        self.missing_bytes = 0
+        self.missing_inodes = max(0, self.needed - removed)
+        return self.met()
+
+
+class TestWatermark(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure, files are aged by 1 to 12
+        hours
+        """
+        self.temp = tempfile.mkdtemp()
+        self.config = {
+            'pidfile': '',
+            'path': self.temp,
+            'definitions': [
+                {'name': 'keep', 'pathMatch': '%s/3/.*' % self.temp,
+                 'noRemove': True},
+                {'name': 'test-def', 'pathMatch': '%s/.*' % self.temp,
+                 'mtime': 100},
+            ],
+        }
+        now = time.time()
+        self.ages = {}
+        for i in range(1, 4):
+            os.mkdir('%s/%s' % (self.temp, i))
+            for f in range(1, 5):
+                path = '%s/%s/%s' % (self.temp, i, f)
+                with open(path, 'w') as fh:
+                    fh.write(str(f))
+                # The oldest files are kept by noRemove
+                self.ages[path] = (4 * (3 - i) + f) * 3600
+                os.utime(path, (now, now - self.ages[path]))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        shutil.rmtree(self.temp)
+
+    def test_oldest(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        self.assertTrue(CountedWatermark(cleaner, inodes=10).run())
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 3)
+        removed = [path for path in self.ages if not os.path.exists(path)]
+        removable = sorted((path for path in self.ages
+                            if not path.startswith('%s/3/' % self.temp)),
+                           key=self.ages.get, reverse=True)
+        self.assertEqual(sorted(removed), sorted(removable[:3]))
+
+    def test_batches(self):
+        # Each candidate is removed in its own batch, walk stops at target
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        watermark = CountedWatermark(cleaner, inodes=10, candidates=1,
+                                     batch=1)
+        self.assertTrue(watermark.run())
+        self.assertEqual(watermark.batches, 3)
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 3)
+        self.assertTrue(cleaner.get_metrics()['operations']['listdir']['count'] < 4)
+
+    def test_met(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        self.assertTrue(gdctmpcleaner.watermark.Watermark(
+            cleaner, free=1e-9).run())
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 0)
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration,
+                          gdctmpcleaner.watermark.Watermark, cleaner)
+
+
+class ListHandler(logging.Handler):
+    """
+    Keep formatted messages of records
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure and capture verbose log
+        """
+        self.temp = tempfile.mkdtemp()
+        self.config = {
+            'pidfile': '',
+            'path': self.temp,
+            'definitions': [
+                {'name': 'test-def', 'pathMatch': '%s/[12]/.*' % self.temp,
+                 'mtime': 1},
+            ],
+        }
+        old = time.time() - 7200
+        for i in range(1, 4):
+            os.mkdir('%s/%s' % (self.temp, i))
+            for f in range(1, 5):
+                path = '%s/%s/%s' % (self.temp, i, f)
+                with open(path, 'w') as fh:
+                    fh.write(str(f))
+                os.utime(path, (old, old))
+
+        self.lg = logging.getLogger('tmpcleaner')
+        self.level = self.lg.level
+        self.lg.setLevel(logging.INFO)
+        self.handler = ListHandler()
+        self.lg.addHandler(self.handler)
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure and logger
+        """
+        self.lg.removeHandler(self.handler)
+        self.lg.setLevel(self.level)
+        shutil.rmtree(self.temp)
+
+    def removals(self):
+        return [message for message in self.handler.messages
+                if message.startswith('Removing')]
+
+    def test_entries(self):
+        gdctmpcleaner.TmpCleaner(self.config, dry=True).run()
+        self.assertEqual(len(self.removals()), 8)
+
+    def test_aggregate(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config, aggregate_log=True)
+        cleaner.run()
+        self.assertEqual(sorted(self.removals()), [
+            'Removing 4 files in %s/%s, matching definition test-def'
+            % (self.temp, i) for i in (1, 2)])
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 8)
+        self.assertEqual(cleaner.removals, {})
+
+    def test_queue(self):
+        stdout = StringIO.StringIO()
+        stderr = StringIO.StringIO()
+        console = gdctmpcleaner.logger.level_handler.LevelHandler(
+            stream_greater_or_equal=stderr, stream_lower=stdout)
+        console.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        handler = gdctmpcleaner.logger.queue_handler.QueueHandler(
+            [console], batch=10)
+        lg = logging.getLogger('tmpcleaner.test_queue')
+        lg.propagate = False
+        lg.addHandler(handler)
+        try:
+            args = ['value']
+            for i in range(25):
+                lg.warn('Record %d %s', i, args)
+            # Message is formatted when record is queued
+            args.append('changed')
+            lg.error('Failed')
+        finally:
+            lg.removeHandler(handler)
+            handler.close()
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            "WARNING: Record %d ['value']" % i for i in range(25)])
+        self.assertEqual(stderr.getvalue(), 'ERROR: Failed\n')
+
+    def test_full(self):
+        target = ListHandler()
+        started = threading.Event()
+        release = threading.Event()
+
+        def emit(record):
+            started.set()
+            release.wait()
+            target.messages.append(record.getMessage())
+        target.emit = emit
+        handler = gdctmpcleaner.logger.queue_handler.QueueHandler(
+            [target], batch=1, size=1)
+        lg = logging.getLogger('tmpcleaner.test_full')
+        lg.propagate = False
+        lg.setLevel(logging.INFO)
+        lg.addHandler(handler)
+        try:
+            lg.warn('First')
+            started.wait(5)
+            for i in range(3):
+                lg.info('Info %d', i)
+            # Error waits for free space in queue instead of being dropped
+            threading.Timer(0.2, release.set).start()
+            lg.error('Failed')
+        finally:
+            lg.removeHandler(handler)
+            handler.close()
+        self.assertEqual(target.messages, [
+            'First', 'Info 0',
+            '2 log records were dropped, logging can\'t keep up', 'Failed'])
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure, files of 1 and 2 are old
+        """
+        self.temp = tempfile.mkdtemp()
+        self.tree = os.path.join(self.temp, 'tree')
+        self.config = {
+            'pidfile': '',
+            'path': self.tree,
+            'journalFile': os.path.join(self.temp, 'journal'),
+            'definitions': [
+                {'name': 'test-def', 'pathMatch': '%s/[12]/.*' % self.tree,
+                 'mtime': 1},
+            ],
+        }
+        old = time.time() - 7200
+        for i in range(1, 4):
+            os.makedirs('%s/%s' % (self.tree, i))
+            for f in range(1, 5):
+                path = '%s/%s/%s' % (self.tree, i, f)
+                with open(path, 'w') as fh:
+                    fh.write(str(f))
+                os.utime(path, (old, old))
+        self.old = old
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        shutil.rmtree(self.temp)
+
+    def check(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        cleaner.run()
+        cleaner.journal.close()
+        records = list(gdctmpcleaner.journal.read(self.config['journalFile']))
+        self.assertEqual(sorted(record['path'] for record in records), sorted(
+            '%s/%s/%s' % (self.tree, i, f) for i in (1, 2) for f in range(1, 5)))
+        for record in records:
+            self.assertEqual(record['definition'], 'test-def')
+            self.assertEqual(record['outcome'], 'removed')
+            self.assertEqual(record['type'], 'file')
+            self.assertEqual(record['size'], 1)
+            self.assertEqual(int(record['mtime']), int(self.old))
+
+    def test_ndjson(self):
+        self.check()
+        with open(self.config['journalFile']) as fh:
+            self.assertEqual(len(fh.readlines()), 8)
+
+    def test_binary(self):
+        self.config['journalFormat'] = 'binary'
+        self.check()
+
+    def test_dry(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config, dry=True)
+        cleaner.run()
+        self.assertEqual(cleaner.journal, None)
+        self.assertFalse(os.path.exists(self.config['journalFile']))
+
+    def test_rotate(self):
+        path = self.config['journalFile']
+        journal = gdctmpcleaner.journal.Journal(path, fmt='binary', batch=1,
+                                                max_size=1, backups=2)
+        for i in range(1, 5):
+            journal.record(gdctmpcleaner.File('%s/3/%s' % (self.tree, i)))
+            journal.flush()
+        journal.close()
+        # The oldest journal was dropped, the current one is empty
+        self.assertFalse(os.path.exists(path + '.3'))
+        self.assertEqual(list(gdctmpcleaner.journal.read(path)), [])
+        self.assertEqual(
+            [record['path'] for name in (path + '.2', path + '.1')
+             for record in gdctmpcleaner.journal.read(name)],
+            ['%s/3/%s' % (self.tree, i) for i in (3, 4)])
+
+    def test_processes(self):
+        # Batches of processes sharing binary journal don't interleave
+        path = self.config['journalFile']
+        curr = gdctmpcleaner.File('%s/3/1' % self.tree)
+        curr.definition = 'test-def'
+        # Processes start writing when pipe is closed
+        start, ready = os.pipe()
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if not pid:
+                try:
+                    os.close(ready)
+                    journal = gdctmpcleaner.journal.Journal(
+                        path, fmt='binary', batch=100000, interval=60)
+                    for _ in range(20000):
+                        journal.record(curr)
+                    os.read(start, 1)
+                    journal.close()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        os.close(start)
+        os.close(ready)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        records = list(gdctmpcleaner.journal.read(path))
+        self.assertEqual(len(records), 4 * 20000)
+        self.assertEqual(set(record['path'] for record in records),
+                         set([curr.path]))
+
+    def test_unnamed(self):
+        # Ids of unnamed definitions are read as strings from both formats
+        curr = gdctmpcleaner.File('%s/3/1' % self.tree)
+        curr.definition = 7
+        for fmt in gdctmpcleaner.journal.FORMATS:
+            path = '%s.%s' % (self.config['journalFile'], fmt)
+            journal = gdctmpcleaner.journal.Journal(path, fmt=fmt)
+            journal.record(curr)
+            journal.close()
+            self.assertEqual(
+                [record['definition'] for record in gdctmpcleaner.journal.read(path)],
+                [u'7'])
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare testing directory structure, everything in 1 and 2 is old
+        """
+        self.temp = tempfile.mkdtemp()
+        self.tree = os.path.join(self.temp, 'tree')
+        self.plan = os.path.join(self.temp, 'plan')
+        self.config = {
+            'pidfile': '',
+            'path': self.tree,
+            'definitions': [
+                {'name': 'test-def', 'pathMatch': '%s/[12](/.*|$)' % self.tree,
+                 'mtime': 1},
+            ],
+        }
+        old = time.time() - 7200
+        for i in range(1, 4):
+            os.makedirs('%s/%s' % (self.tree, i))
+            for f in range(1, 5):
+                path = '%s/%s/%s' % (self.tree, i, f)
+                with open(path, 'w') as fh:
+                    fh.write(str(f))
+                os.utime(path, (old, old))
+            os.utime('%s/%s' % (self.tree, i), (old, old))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        shutil.rmtree(self.temp)
+
+    def write(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config, dry=True)
+        cleaner.plan = gdctmpcleaner.plan.PlanWriter(self.plan, cleaner)
+        cleaner.run()
+        cleaner.plan.close()
+        return cleaner
+
+    def test_plan(self):
+        cleaner = self.write()
+        header, records = gdctmpcleaner.plan.read(self.plan)
+        self.assertEqual(header['definitions'], ['test-def'])
+        paths = [record[0] for record in records]
+        self.assertEqual(len(paths), 10)
+        # Content of directory precedes it
+        for i in (1, 2):
+            directory = '%s/%s' % (self.tree, i)
+            self.assertTrue(all(paths.index(path) < paths.index(directory)
+                                for path in paths
+                                if path.startswith(directory + '/')))
+        self.assertEqual(sorted(os.listdir(self.tree)), ['1', '2', '3'])
+
+        # Changed, replaced and missing files are kept
+        with open('%s/1/1' % self.tree, 'a') as fh:
+            fh.write('changed')
+        os.unlink('%s/2/1' % self.tree)
+        os.unlink('%s/2/2' % self.tree)
+        with open('%s/2/2' % self.tree, 'w') as fh:
+            fh.write('2')
+        old = time.time() - 7200
+        os.utime('%s/2/2' % self.tree, (old, old))
+
+        cleaner = gdctmpcleaner.TmpCleaner(self.config)
+        counts = gdctmpcleaner.plan.apply(cleaner, self.plan)
+        self.assertEqual(counts, {'removed': 5, 'failed': 0, 'skipped': 5})
+        self.assertEqual(sorted(os.listdir('%s/1' % self.tree)), ['1'])
+        self.assertEqual(sorted(os.listdir('%s/2' % self.tree)), ['2'])
+        self.assertEqual(len(os.listdir('%s/3' % self.tree)), 4)
+        self.assertEqual(cleaner.summary['test-def']['removed']['files'], 5)
+        self.assertEqual(cleaner.get_metrics()['operations'].get('listdir'), None)
+
+    def test_invalid(self):
+        self.write()
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration,
+                          gdctmpcleaner.plan.PlanWriter, self.plan,
+                          gdctmpcleaner.TmpCleaner(self.config))
+        config = dict(self.config, path=self.temp)
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration,
+                          gdctmpcleaner.plan.apply,
+                          gdctmpcleaner.TmpCleaner(config), self.plan)
+        config = dict(self.config, definitions=[{'name': 'other'}])
+        self.assertRaises(gdctmpcleaner.InvalidConfiguration,
+                          gdctmpcleaner.plan.apply,
+                          gdctmpcleaner.TmpCleaner(config), self.plan)
+
+
+class TestSubtree(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare two identical testing directory structures
+        """
+        self.temp = tempfile.mkdtemp()
+        for tree in ('per-entry', 'subtree'):
+            for user in ('u1', 'u2'):
+                for path in ('test/a/b', 'test/a/.snapshot', 'test/c', 'data'):
+                    os.makedirs(os.path.join(self.temp, tree, user, path))
+                    for f in range(1, 4):
+                        with open(os.path.join(self.temp, tree, user, path, str(f)), 'w') as fh:
+                            fh.write(str(f))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        shutil.rmtree(self.temp)
+
+    def config(self, tree):
+        return {
+            'pidfile': '',
+            'path': os.path.join(self.temp, tree),
+            'pathIgnore': r'.*/\.snapshot$',
+            'removeSubtrees': tree == 'subtree',
+            'definitions': [
+                {'name': 'keep', 'noRemove': True,
+                 'pathMatch': os.path.join(self.temp, tree, 'u2/')},
+                {'name': 'test', 'pathMatch': '.*/test/'},
+                {'name': 'old', 'mtime': 1},
+            ],
+        }
+
+    def listing(self, tree):
+        top = os.path.join(self.temp, tree)
+        return sorted(os.path.relpath(os.path.join(root, name), top)
+                      for root, dirs, files in os.walk(top)
+                      for name in dirs + files)
+
+    def test_subtree(self):
+        matcher = gdctmpcleaner.Matcher(
+            [gdctmpcleaner.Definition(**definition)
+             for definition in self.config('subtree')['definitions']])
+        self.assertEqual(matcher.subtree('%s/subtree/u1/test' % self.temp).name, 'test')
+        self.assertEqual(matcher.subtree('%s/subtree/u1' % self.temp), None)
+        self.assertEqual(matcher.subtree('%s/subtree/u2/test' % self.temp), None)
+
+        cleaners = {}
+        for tree in ('per-entry', 'subtree'):
+            cleaners[tree] = gdctmpcleaner.TmpCleaner(self.config(tree))
+            cleaners[tree].run()
+        self.assertEqual(self.listing('per-entry'), self.listing('subtree'))
+        self.assertTrue('u1/test/a/.snapshot/1' in self.listing('subtree'))
+        self.assertFalse('u1/test/c' in self.listing('subtree'))
+        self.assertEqual(cleaners['per-entry'].summary['test'],
+                         cleaners['subtree'].summary['test'])
+        self.assertEqual(cleaners['subtree'].summary['test']['removed'],
+                         {'dirs': 2, 'files': 6, 'size': 6})
+        # Entries below test aren't matched
+        operations = [cleaners[tree].get_metrics()['operations']['match']['count']
+                      for tree in ('per-entry', 'subtree')]
+        self.assertTrue(operations[1] < operations[0])
+
+    def test_workers(self):
+        # Directories pruned by listing threads are counted
+        cleaner = gdctmpcleaner.TmpCleaner(self.config('subtree'), workers=4,
+                                           prune_report=True)
+        cleaner.run()
+        self.assertEqual(cleaner.pruned_dirs, 2)
+        self.assertEqual(sorted(cleaner.pruned), [
+            ('%s/subtree/%s/test/a/.snapshot' % (self.temp, user), 'pathIgnore')
+            for user in ('u1', 'u2')])
+        self.assertEqual(cleaner.summary['test']['removed'],
+                         {'dirs': 2, 'files': 6, 'size': 6})
+
+    def test_dry(self):
+        cleaner = gdctmpcleaner.TmpCleaner(self.config('subtree'), dry=True)
+        cleaner.run()
+        self.assertEqual(cleaner.summary['test']['removed'],
+                         {'dirs': 2, 'files': 6, 'size': 6})
+        self.assertEqual(self.listing('per-entry'), self.listing('subtree'))
+
+
+class TestVectorize(unittest.TestCase):
+    def setUp(self):
+        """
+        Prepare two identical testing directory structures with files of
+        different age
+        """
+        self.temp = tempfile.mkdtemp()
+        now = time.time()
+        for tree in ('per-entry', 'vectorized'):
+            for directory in ('a', 'b', 'keep'):
+                os.makedirs(os.path.join(self.temp, tree, directory))
+                for age in range(10):
+                    for suffix in ('log', 'dat'):
+                        path = os.path.join(self.temp, tree, directory,
+                                            '%d.%s' % (age, suffix))
+                        with open(path, 'w') as fh:
+                            fh.write('x' * age)
+                        mtime = now - 6 * 3600 * age - 60
+                        os.utime(path, (now, mtime))
+
+    def tearDown(self):
+        """
+        Cleanup testing directory structure
+        """
+        shutil.rmtree(self.temp)
+
+    def config(self, tree, **options):
+        config = {
+            'pidfile': '',
+            'path': os.path.join(self.temp, tree),
+            'vectorize': tree == 'vectorized',
+            'definitions': [
+                {'name': 'hold', 'noRemove': True, 'mtime': 30},
+                {'name': 'logs', 'pathMatch': r'.*\.log$',
+                 'pathExclude': '.*/keep/', 'mtime': 12},
+                {'name': 'old', 'mtime': 24},
+            ],
+        }
+        config.update(options)
+        return config
+
+    def listing(self, tree):
+        top = os.path.join(self.temp, tree)
+        return sorted(os.path.relpath(os.path.join(root, name), top)
+                      for root, dirs, files in os.walk(top)
+                      for name in dirs + files)
+
+    def compare(self, **options):
+        cleaners = {}
+        for tree in ('per-entry', 'vectorized'):
+            cleaners[tree] = gdctmpcleaner.TmpCleaner(self.config(tree, **options))
+            cleaners[tree].run()
+        self.assertEqual(cleaners['per-entry'].summary,
+                         cleaners['vectorized'].summary)
+        self.assertEqual(cleaners['per-entry'].stats_skipped,
+                         cleaners['vectorized'].stats_skipped)
+        self.assertEqual(self.listing('per-entry'), self.listing('vectorized'))
+        return cleaners['vectorized']
+
+    def test_combined(self):
+        cleaner = self.compare()
+        self.assertTrue(cleaner.matcher.combined)
+        # Files older than 30 hours are counted to hold, but removed by
+        # following definitions
+        self.assertEqual(cleaner.summary['hold']['removed']['files'], 6 * 5)
+        self.assertEqual(cleaner.summary['logs']['removed']['files'], 2 * 3)
+        self.assertEqual(cleaner.summary['old']['removed']['files'], 4)
+
+    def test_sequential(self):
+        definitions = self.config('per-entry')['definitions']
+        # Backreference prevents combining of expressions
+        definitions.insert(0, {'name': 'repeated', 'pathMatch': r'(.*)/\1$'})
+        cleaner = self.compare(definitions=definitions)
+        self.assertFalse(cleaner.matcher.combined)
+
+    def test_minimal(self):
+        definitions = [{'name': 'logs', 'pathMatch': r'.*\.log$', 'mtime': 12}]
+        cleaner = self.compare(definitions=definitions, statistics='minimal')
+        self.assertEqual(cleaner.stats_skipped, 3 * 10)
+        self.assertEqual(cleaner.summary['logs']['removed']['files'], 3 * 8)
+
+    def test_time(self):
+        definition = gdctmpcleaner.Definition(mtime=1)
+        curr = gdctmpcleaner.File(os.path.join(self.temp, 'per-entry', 'a', '0.log'))
+        self.assertFalse(definition.match_time(curr))
+        self.assertTrue(definition.match_time(curr, time.time() + 3600))
+        self.assertEqual(definition.cutoffs(7200), [('st_mtime', 3600)])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,8 +8,8 @@ Group:		Development/Libraries
 BuildRoot:	%{_tmppath}/%{name}-%{version}-%{release}-buildroot
 BuildArch:	noarch
 Vendor:		GoodData Corporation <root@gooddata.com>
-Requires:	PyYAML python-argparse python-dateutil
-BuildRequires:	python2-devel python-setuptools-devel python-argparse PyYAML python-py pytest
+Requires:	PyYAML python-argparse python-dateutil python-scandir
+BuildRequires:	python2-devel python-setuptools-devel python-argparse PyYAML python-scandir python-py pytest
 Url:		https://github.com/gooddata/tmpcleaner
 Obsoletes:	gdc-python-tools < 2
 
@@ -40,3 +40,5 @@ make build
 %{python_sitelib}/*.egg-info
 %{python_sitelib}/gdctmpcleaner
 /usr/bin/tmpcleaner.py
+/usr/bin/tmpcleaner-benchmark.py
+/usr/bin/tmpcleaner-journal.py